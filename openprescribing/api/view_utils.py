@@ -1,6 +1,13 @@
 import itertools
 from django.db import connection
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from rest_framework.response import Response
+from rest_framework_csv.renderers import CSVStreamingRenderer
+
+
+# Number of rows rendered at a time by `streaming_response`
+STREAMING_CHUNK_SIZE = 1000
 
 
 def param_to_list(str):
@@ -60,3 +67,72 @@ def get_bnf_codes_from_number_str(codes):
             # it's a presentation, not a section
             converted.append(code)
     return converted
+
+
+def streaming_response(renderer, rows, accepted_media_type=None, renderer_context=None):
+    """
+    Return a response which renders the dicts in `rows` as they are generated,
+    rather than building the entire list in memory first. The output is the
+    same as we'd get by passing `list(rows)` to a `Response` and letting DRF
+    render it with the JSON or CSV `renderer`, given the `accepted_media_type`
+    and `renderer_context` it would be passed (so that, for instance, any
+    `indent` in the Accept header is honoured).
+
+    All rows must have the same keys.
+    """
+    rows = iter(rows)
+    # Fetching the first row means any exceptions raised while setting up the
+    # generator happen here, before we've started sending a response
+    first_row = next(rows, None)
+    if first_row is None:
+        return Response([])
+    rows = itertools.chain([first_row], rows)
+    renderer_context = renderer_context or {}
+    if renderer.format == "csv":
+        # The CSV renderer would normally examine every row to find all the
+        # column names before sorting them
+        header = sorted(first_row.keys())
+        content = _stream_csv(
+            rows, accepted_media_type, dict(renderer_context, header=header)
+        )
+    elif renderer.format == "json":
+        content = _stream_json(renderer, rows, accepted_media_type, renderer_context)
+    else:
+        raise ValueError("Can't stream format: {}".format(renderer.format))
+    content_type = renderer.media_type
+    if renderer.charset:
+        content_type = "{}; charset={}".format(content_type, renderer.charset)
+    return StreamingHttpResponse(content, content_type=content_type)
+
+
+def _stream_csv(rows, accepted_media_type, renderer_context):
+    # The renderer treats anything other than a list or a generator as a single
+    # row, so we wrap our iterator in a generator
+    rows = (row for row in rows)
+    lines = CSVStreamingRenderer().render(rows, accepted_media_type, renderer_context)
+    for chunk in _chunked(lines):
+        yield b"".join(chunk)
+
+
+def _stream_json(renderer, rows, accepted_media_type, renderer_context):
+    # We render each chunk of rows as a JSON array and then splice these
+    # together into one big array. When the output is indented, each array
+    # ends with a newline before its closing bracket, which we only want once.
+    closing = b"]"
+    yield b"["
+    for n, chunk in enumerate(_chunked(rows)):
+        if n > 0:
+            yield b","
+        content = renderer.render(chunk, accepted_media_type, renderer_context)
+        if content.endswith(b"\n]"):
+            closing = b"\n]"
+        yield content[: -len(closing)][1:]
+    yield closing
+
+
+def _chunked(iterable):
+    while True:
+        chunk = list(itertools.islice(iterable, STREAMING_CHUNK_SIZE))
+        if not chunk:
+            break
+        yield chunk
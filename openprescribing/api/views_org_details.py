@@ -2,6 +2,7 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
 from django.db.models import Q
+import numpy
 
 from frontend.models import Practice, PCT, STP, RegionalTeam, PCN
 from . import view_utils as utils
@@ -84,32 +85,49 @@ def _get_practice_stats_entries(keys, org_type, orgs):
     if org_type == "all_practices":
         org_offsets = [(None, 0)]
     date_offsets = sorted(db.date_offsets.items())
+    orgs = [org for org, _ in org_offsets]
+    dates = [date for date, _ in date_offsets]
+    row_offsets = numpy.array([offset for _, offset in org_offsets], dtype=int)
+    col_offsets = numpy.array([offset for _, offset in date_offsets], dtype=int)
+    # We only return entries where at least one statistic has a non-zero value.
+    # Matrices are transposed so that these are found in date order, and then
+    # organisation order within each date
+    index = numpy.ix_(row_offsets, col_offsets)
+    has_value = numpy.zeros((len(dates), len(orgs)), dtype=bool)
+    for _, matrix in practice_stats:
+        has_value |= matrix[index].T != 0
+    date_indices, org_indices = numpy.nonzero(has_value)
+    index = (row_offsets[org_indices], col_offsets[date_indices])
+    names = []
+    columns = []
+    for name, matrix in practice_stats:
+        values = matrix[index]
+        if name == "nothing":
+            values = [1] * len(values)
+        elif issubclass(values.dtype.type, float):
+            values = numpy.round(values, 2).tolist()
+        else:
+            values = values.tolist()
+        names.append(name)
+        columns.append(values)
     # Yield entries for each organisation on each date
-    for date, col_offset in date_offsets:
-        for org, row_offset in org_offsets:
-            entry = {"date": date}
-            if org is not None:
-                entry["row_id"] = org.pk
-                entry["row_name"] = org.name
-            index = (row_offset, col_offset)
-            star_pu = {}
-            has_value = False
-            for name, matrix in practice_stats:
-                value = matrix[index]
-                if value != 0:
-                    has_value = True
-                if name == "nothing":
-                    value = 1
-                if isinstance(value, float):
-                    value = round(value, 2)
-                if name.startswith("star_pu."):
-                    star_pu[name[8:]] = value
-                else:
-                    entry[name] = value
-            if star_pu:
-                entry["star_pu"] = star_pu
-            if has_value:
-                yield entry
+    for date_index, org_index, *values in zip(
+        date_indices.tolist(), org_indices.tolist(), *columns
+    ):
+        entry = {"date": dates[date_index]}
+        org = orgs[org_index]
+        if org is not None:
+            entry["row_id"] = org.pk
+            entry["row_name"] = org.name
+        star_pu = {}
+        for name, value in zip(names, values):
+            if name.startswith("star_pu."):
+                star_pu[name[8:]] = value
+            else:
+                entry[name] = value
+        if star_pu:
+            entry["star_pu"] = star_pu
+        yield entry
 
 
 def _get_query_and_params(keys):
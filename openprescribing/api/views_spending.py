@@ -1,7 +1,11 @@
 from django.shortcuts import get_object_or_404
+import numpy
+import pyarrow
 
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.renderers import BaseRenderer, BrowsableAPIRenderer, JSONRenderer
 from rest_framework.response import Response
+from rest_framework_csv.renderers import CSVRenderer
 from rest_framework.exceptions import APIException, NotFound
 
 from common.utils import nhs_titlecase, parse_date
@@ -19,6 +23,7 @@ from frontend.ghost_branded_generics import (
     get_ghost_branded_generic_spending,
     get_total_ghost_branded_generic_spending,
 )
+from matrixstore.build.precalculate_totals import BNF_PREFIX_LENGTHS
 from matrixstore.db import get_db, get_row_grouper
 
 from . import view_utils as utils
@@ -401,13 +406,41 @@ def tariff(request, format=None):
     return response
 
 
+class ArrowRenderer(BaseRenderer):
+    """
+    Renders a `pyarrow.Table` in Arrow's IPC file format
+
+    Anything else (i.e. error messages) is rendered as JSON, with the
+    appropriate Content-Type, so that clients can read it.
+    """
+
+    media_type = "application/vnd.apache.arrow.file"
+    format = "arrow"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, pyarrow.Table):
+            response = (renderer_context or {}).get("response")
+            if response is not None:
+                response["Content-Type"] = JSONRenderer.media_type
+            return JSONRenderer().render(data)
+        sink = pyarrow.BufferOutputStream()
+        writer = pyarrow.ipc.new_file(sink, data.schema)
+        writer.write_table(data)
+        writer.close()
+        return sink.getvalue().to_pybytes()
+
+
 @api_view(["GET"])
+@renderer_classes([JSONRenderer, BrowsableAPIRenderer, CSVRenderer, ArrowRenderer])
 def spending_by_org(request, format=None, org_type=None):
     codes = utils.param_to_list(request.query_params.get("code", []))
     codes = utils.get_bnf_codes_from_number_str(codes)
     org_ids = utils.param_to_list(request.query_params.get("org", []))
     org_type = request.query_params.get("org_type", org_type)
     date = request.query_params.get("date", None)
+    output_format = request.accepted_renderer.format
 
     # Accept both cases of CCG (better to fix this specific string rather than
     # make the whole API case-insensitive)
@@ -419,8 +452,9 @@ def spending_by_org(request, format=None, org_type=None):
         # Translate any CCG codes into the codes of all practices in that CCG
         org_ids = utils.get_practice_ids_from_org(org_ids)
         # Due to the number of practices we only return data for all practices
-        # if a single date is specified
-        if not date and not org_ids:
+        # if a single date is specified (unless the compact Arrow format is
+        # requested)
+        if not date and not org_ids and output_format != "arrow":
             return Response(
                 "Error: You must supply either a list of practice IDs or a date "
                 "parameter, e.g. date=2015-04-01",
@@ -455,11 +489,26 @@ def spending_by_org(request, format=None, org_type=None):
     if org_type != "practice":
         orgs = orgs.only(code_field, "name")
 
-    data = list(_get_prescribing_entries(codes, orgs, org_type, date=date))
-
-    response = Response(data)
-    if request.accepted_renderer.format == "csv":
-        filename = "spending-by-{}-{}.csv".format(org_type, "-".join(codes))
+    if output_format == "arrow":
+        table = _get_prescribing_table(codes, orgs, org_type, date=date)
+        response = Response(table)
+    # For practices there can be many thousands of entries per date, so where
+    # possible we render them as they're generated
+    elif output_format in ("json", "csv"):
+        entries = _get_prescribing_entries(codes, orgs, org_type, date=date)
+        response = utils.streaming_response(
+            request.accepted_renderer,
+            entries,
+            accepted_media_type=request.accepted_media_type,
+            renderer_context={"request": request},
+        )
+    else:
+        entries = _get_prescribing_entries(codes, orgs, org_type, date=date)
+        response = Response(list(entries))
+    if output_format in ("csv", "arrow"):
+        filename = "spending-by-{}-{}.{}".format(
+            org_type, "-".join(codes), output_format
+        )
         response["content-disposition"] = "attachment; filename={}".format(filename)
     return response
 
@@ -472,28 +521,102 @@ def _get_prescribing_entries(bnf_code_prefixes, orgs, org_type, date=None):
     If a date is supplied then data for just that date is returned, otherwise
     all available dates are returned.
     """
-    db = get_db()
-    items_matrix, quantity_matrix, actual_cost_matrix = _get_prescribing_for_codes(
-        db, bnf_code_prefixes
+    columns = _get_prescribing_columns(bnf_code_prefixes, orgs, org_type, date=date)
+    dates, orgs, date_indices, org_indices, items, quantity, actual_cost = columns
+    rows = zip(
+        date_indices.tolist(),
+        org_indices.tolist(),
+        items.tolist(),
+        quantity.tolist(),
+        actual_cost.tolist(),
     )
-    # If no data at all was found, return early which results in an empty
-    # iterator
+    # Yield entries for each organisation on each date
+    for date_index, org_index, items, quantity, actual_cost in rows:
+        org = orgs[org_index]
+        entry = {
+            "items": items,
+            "quantity": quantity,
+            "actual_cost": actual_cost,
+            "date": dates[date_index],
+            "row_id": org.pk,
+            "row_name": org.name,
+        }
+        # Practices get some extra attributes in the existing API
+        if org_type == "practice":
+            entry["ccg"] = org.ccg_id
+            entry["setting"] = org.setting
+        yield entry
+
+
+def _get_prescribing_table(bnf_code_prefixes, orgs, org_type, date=None):
+    """
+    Return a `pyarrow.Table` with the same columns as the entries returned by
+    `_get_prescribing_entries`, built directly from the numpy arrays. Dates and
+    organisation attributes are dictionary encoded.
+    """
+    columns = _get_prescribing_columns(bnf_code_prefixes, orgs, org_type, date=date)
+    dates, orgs, date_indices, org_indices, items, quantity, actual_cost = columns
+    date_indices = date_indices.astype(numpy.int32)
+    org_indices = org_indices.astype(numpy.int32)
+
+    def org_column(values, value_type=pyarrow.string()):
+        dictionary = pyarrow.array(values, type=value_type)
+        return pyarrow.DictionaryArray.from_arrays(org_indices, dictionary)
+
+    arrays = {
+        "items": pyarrow.array(items, type=pyarrow.int64()),
+        "quantity": pyarrow.array(quantity, type=pyarrow.float64()),
+        "actual_cost": pyarrow.array(actual_cost, type=pyarrow.float64()),
+        "date": pyarrow.DictionaryArray.from_arrays(
+            date_indices, pyarrow.array(dates, type=pyarrow.string())
+        ),
+        "row_id": org_column([org.pk for org in orgs]),
+        "row_name": org_column([org.name for org in orgs]),
+    }
+    if org_type == "practice":
+        arrays["ccg"] = org_column([org.ccg_id for org in orgs])
+        arrays["setting"] = org_column(
+            [org.setting for org in orgs], value_type=pyarrow.int64()
+        )
+    return pyarrow.table(arrays)
+
+
+def _get_prescribing_columns(bnf_code_prefixes, orgs, org_type, date=None):
+    """
+    Return the totals for all prescribing matching the supplied BNF code
+    prefixes for each date and organisation, as a tuple of:
+
+        dates, orgs, date_indices, org_indices, items, quantity, actual_cost
+
+    where `dates` and `orgs` are lists, and the remaining values are arrays
+    with one element per entry. Entries where there was no prescribing are
+    excluded and the remainder are ordered by date and then by organisation.
+    """
+    db = get_db()
+    # Where the file contains data already grouped by this org type we use that
+    # directly, otherwise we group together practice level data
+    offsets = db.get_org_offsets(org_type)
+    if offsets is not None:
+        matrices = _get_prescribing_for_codes(db, bnf_code_prefixes, org_type)
+    else:
+        matrices = _get_prescribing_for_codes(db, bnf_code_prefixes)
+    items_matrix, quantity_matrix, actual_cost_matrix = matrices
+    # If no data at all was found, return early with no entries
     if items_matrix is None:
-        return
-    # Group together practice level data to the appropriate organisation level
-    group_by_org = get_row_grouper(org_type)
-    items_matrix = group_by_org.sum(items_matrix)
-    quantity_matrix = group_by_org.sum(quantity_matrix)
-    actual_cost_matrix = group_by_org.sum(actual_cost_matrix)
-    # `group_by_org.offsets` maps each organisation's primary key to its row
-    # offset within the matrices. We pair each organisation with its row
-    # offset, ignoring those organisations which aren't in the mapping (which
-    # implies that they did not prescribe in this period)
-    org_offsets = [
-        (org, group_by_org.offsets[org.pk])
-        for org in orgs
-        if org.pk in group_by_org.offsets
-    ]
+        indices = numpy.array([], dtype=int)
+        totals = numpy.array([], dtype=float)
+        return [], [], indices, indices, indices, totals, totals
+    if offsets is None:
+        group_by_org = get_row_grouper(org_type)
+        items_matrix = group_by_org.sum(items_matrix)
+        quantity_matrix = group_by_org.sum(quantity_matrix)
+        actual_cost_matrix = group_by_org.sum(actual_cost_matrix)
+        offsets = group_by_org.offsets
+    # `offsets` maps each organisation's primary key to its row offset within
+    # the matrices. We pair each organisation with its row offset, ignoring
+    # those organisations which aren't in the mapping (which implies that they
+    # did not prescribe in this period)
+    org_offsets = [(org, offsets[org.pk]) for org in orgs if org.pk in offsets]
     # Pair each date with its column offset (either all available dates or just
     # the specified one)
     if date:
@@ -503,59 +626,127 @@ def _get_prescribing_entries(bnf_code_prefixes, orgs, org_type, date=None):
             raise BadDate(date)
     else:
         date_offsets = sorted(db.date_offsets.items())
-    # Yield entries for each organisation on each date
-    for date, col_offset in date_offsets:
-        for org, row_offset in org_offsets:
-            index = (row_offset, col_offset)
-            items = items_matrix[index]
-            # Mimicking the behaviour of the existing API, we don't return
-            # entries where there was no prescribing
-            if items == 0:
-                continue
-            entry = {
-                "items": items,
-                "quantity": quantity_matrix[index],
-                "actual_cost": round(actual_cost_matrix[index], 2),
-                "date": date,
-                "row_id": org.pk,
-                "row_name": org.name,
-            }
-            # Practices get some extra attributes in the existing API
-            if org_type == "practice":
-                entry["ccg"] = org.ccg_id
-                entry["setting"] = org.setting
-            yield entry
-
-
-def _get_prescribing_for_codes(db, bnf_code_prefixes):
+    orgs = [org for org, _ in org_offsets]
+    dates = [date for date, _ in date_offsets]
+    row_offsets = numpy.array([offset for _, offset in org_offsets], dtype=int)
+    col_offsets = numpy.array([offset for _, offset in date_offsets], dtype=int)
+    # Mimicking the behaviour of the existing API, we don't return entries where
+    # there was no prescribing. We transpose the items so that the non-zero
+    # values are found in date order, and then organisation order within each
+    # date
+    items = items_matrix[numpy.ix_(row_offsets, col_offsets)].T
+    date_indices, org_indices = numpy.nonzero(items)
+    index = (row_offsets[org_indices], col_offsets[date_indices])
+    return (
+        dates,
+        orgs,
+        date_indices,
+        org_indices,
+        items_matrix[index],
+        quantity_matrix[index],
+        numpy.round(actual_cost_matrix[index], 2),
+    )
+
+
+def _get_prescribing_for_codes(db, bnf_code_prefixes, org_type=None):
     """
     Return items, quantity and actual_cost matrices giving the totals for all
     prescribing which matches any of the supplied BNF code prefixes. If no
     prefixes are supplied then the totals will be over all prescribing for all
     presentations.
+
+    If `org_type` is supplied then the matrices are taken from the tables
+    grouped by that org type (see `MatrixStore.get_org_offsets`) and so have
+    one row per organisation, rather than one per practice.
     """
+    if org_type is None:
+        presentation_table = "presentation"
+    else:
+        presentation_table = "presentation_by_" + org_type
     if bnf_code_prefixes:
-        where_clause = " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes))
-        params = [code + "%" for code in bnf_code_prefixes]
+        bnf_code_prefixes = _remove_overlapping_prefixes(bnf_code_prefixes)
+        # Where we have precalculated totals for a prefix we use those, and
+        # only sum over individual presentations for the remainder
+        if org_type is None and db.has_table("bnf_prefix_totals"):
+            precalculated = [
+                code for code in bnf_code_prefixes if len(code) in BNF_PREFIX_LENGTHS
+            ]
+        else:
+            precalculated = []
+        remainder = [code for code in bnf_code_prefixes if code not in precalculated]
+        subqueries = []
+        params = []
+        if precalculated:
+            subqueries.append(
+                """
+                SELECT items, quantity, actual_cost FROM bnf_prefix_totals
+                WHERE bnf_code_prefix IN ({})
+                """.format(
+                    ",".join("?" * len(precalculated))
+                )
+            )
+            params.extend(precalculated)
+        if remainder:
+            subqueries.append(
+                """
+                SELECT items, quantity, actual_cost FROM {}
+                WHERE {}
+                """.format(
+                    presentation_table,
+                    " OR ".join(["bnf_code LIKE ?"] * len(remainder)),
+                )
+            )
+            params.extend(code + "%" for code in remainder)
         sql = """
             SELECT
-                matrix_sum(items) AS items,
-                matrix_sum(quantity) AS quantity,
-                matrix_sum(actual_cost) AS actual_cost
+                matrix_sum_many(items, quantity, actual_cost)
             FROM
-                presentation
-            WHERE
-                {}
+                ({})
             """.format(
-            where_clause
+            " UNION ALL ".join(subqueries)
         )
-    else:
+    elif org_type is None:
         # As summing over all presentations can be quite slow we use the
-        # precalculated results table
-        sql = "SELECT items, quantity, actual_cost FROM all_presentations"
+        # precalculated results table (we pass the values through
+        # `matrix_sum_many` just so they're returned in the same form)
+        sql = """
+            SELECT
+                matrix_sum_many(items, quantity, actual_cost)
+            FROM
+                all_presentations
+            """
         params = []
-    items, quantity, actual_cost = db.query_one(sql, params)
+    else:
+        # The grouped totals may be stored in sparse form, so we pass them
+        # through `matrix_sum_many` to get the same dense output as elsewhere
+        sql = """
+            SELECT
+                matrix_sum_many(items, quantity, actual_cost)
+            FROM
+                all_presentations_by_{}
+            """.format(
+            org_type
+        )
+        params = []
+    (matrices,) = db.query_one(sql, params)
+    # We get None if there were no matching rows at all
+    items, quantity, actual_cost = matrices or (None, None, None)
     # Convert from pence to pounds
     if actual_cost is not None:
         actual_cost = actual_cost / 100.0
     return items, quantity, actual_cost
+
+
+def _remove_overlapping_prefixes(bnf_code_prefixes):
+    """
+    Return the supplied prefixes, sorted and without any which are redundant
+    because a shorter prefix also in the list matches everything they do
+    """
+    prefixes = []
+    for prefix in sorted(set(bnf_code_prefixes)):
+        # Sorting guarantees that any shorter prefix of this one will have
+        # been seen already, and will be the most recent one kept
+        if prefixes and prefix.startswith(prefixes[-1]):
+            continue
+        prefixes.append(prefix)
+    return prefixes
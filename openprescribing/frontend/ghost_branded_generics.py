@@ -11,6 +11,7 @@ price is; the BSA's internal version doesn't always match the published
 version. So we attempt to infer the correct price by looking at all prescribing
 of that drug and finding the median price.
 """
+from collections import defaultdict
 import numpy
 import hashlib
 
@@ -18,14 +19,18 @@ from django.db import connection
 
 from frontend.models import Presentation
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix
 from matrixstore.cachelib import memoize
+from matrixstore.matrix_ops import nanpercentile_by_column
 
 # Minimum difference (positive or negative) between a practice's net costs for
 # a drug and our calculated tariff costs. Any differences below this level we
 # ignore. Value in pence.
 MIN_GHOST_GENERIC_DELTA = 200
 
+# Number of presentations handled at once when calculating spending for every
+# org. Limits the size of the (practices x presentations) matrices involved.
+PRESENTATIONS_PER_BLOCK = 500
+
 
 class SetWithCacheKey(set):
     """
@@ -60,42 +65,115 @@ def get_ghost_branded_generic_spending(date, org_type, org_ids):
     differs significantly from the tariff price
     """
     db = get_db()
-    prices = get_inferred_tariff_prices(db, date, PRESENTATIONS_TO_IGNORE)
-    bnf_codes = list(prices.keys())
-    prescribing = get_prescribing_for_orgs(db, bnf_codes, date, org_type, org_ids)
-    results = []
-    bnf_codes_used = set()
-    for org_id, bnf_code, quantities, net_costs in prescribing:
-        tariff_price = prices[bnf_code]
-        tariff_costs = quantities * tariff_price
-        possible_savings = net_costs - tariff_costs
-        savings_above_threshold = (
-            numpy.absolute(possible_savings) >= MIN_GHOST_GENERIC_DELTA
+    # There's nothing to compare against if we don't have any tariff data for
+    # this month
+    if not get_inferred_tariff_prices(db, date, PRESENTATIONS_TO_IGNORE):
+        return []
+    group_by_org = get_row_grouper(org_type)
+    spending = get_ghost_branded_generic_spending_for_org_type(
+        db, date, group_by_org, PRESENTATIONS_TO_IGNORE, MIN_GHOST_GENERIC_DELTA
+    )
+    # Select the spending for just the orgs we want, ordered by presentation
+    # and then by the position of the org in `org_ids`
+    positions = numpy.full(len(group_by_org.ids), -1)
+    for position, org_id in enumerate(org_ids):
+        positions[group_by_org.offsets[org_id]] = position
+    org_positions = positions[spending["org_offset"]]
+    selected = numpy.nonzero(org_positions != -1)[0]
+    presentation_indices = spending["presentation_index"][selected]
+    order = numpy.lexsort((org_positions[selected], presentation_indices))
+    selected = selected[order]
+    presentation_indices = presentation_indices[order]
+    bnf_codes = spending["bnf_codes"]
+    results = [
+        {
+            "date": date,
+            "org_type": org_type,
+            "org_id": org_ids[position],
+            "bnf_code": bnf_codes[presentation_index],
+            "median_ppu": tariff_price / 100,
+            "price_per_unit": net_cost / quantity / 100,
+            "quantity": quantity,
+            "possible_savings": possible_saving / 100,
+        }
+        for (
+            presentation_index,
+            position,
+            quantity,
+            net_cost,
+            possible_saving,
+            tariff_price,
+        ) in zip(
+            presentation_indices.tolist(),
+            org_positions[selected].tolist(),
+            spending["quantity"][selected].tolist(),
+            spending["net_cost"][selected].tolist(),
+            spending["possible_savings"][selected].tolist(),
+            spending["tariff_price"][presentation_indices].tolist(),
         )
-        total_savings = possible_savings.sum(where=savings_above_threshold)
-        if total_savings != 0:
-            bnf_codes_used.add(bnf_code)
-            total_net_cost = net_costs.sum()
-            total_quantity = quantities.sum()
-            results.append(
-                {
-                    "date": date,
-                    "org_type": org_type,
-                    "org_id": org_id,
-                    "bnf_code": bnf_code,
-                    "median_ppu": tariff_price / 100,
-                    "price_per_unit": total_net_cost / total_quantity / 100,
-                    "quantity": total_quantity,
-                    "possible_savings": total_savings / 100,
-                }
-            )
-    names = Presentation.names_for_bnf_codes(bnf_codes_used)
+    ]
+    names = Presentation.names_for_bnf_codes({r["bnf_code"] for r in results})
     for result in results:
         result["product_name"] = names.get(result["bnf_code"], "unknown")
     results.sort(key=lambda i: i["possible_savings"], reverse=True)
     return results
 
 
+@memoize()
+def get_ghost_branded_generic_spending_for_org_type(
+    db, date, group_by_org, presentations_to_ignore, min_delta
+):
+    """
+    Return all spending on generics by every org of a given type in this month
+    which differs significantly from the tariff price, as a dict of arrays:
+
+        bnf_codes: BNF code of each presentation for which we have a price
+        tariff_price: inferred tariff price of each presentation (indexed by
+            `presentation_index`, rather than having one value per entry)
+        presentation_index: offset of the presentation in `bnf_codes`
+        org_offset: offset of the org in `group_by_org`
+        quantity: total quantity prescribed by the org
+        net_cost: total net cost for the org
+        possible_savings: total difference between net cost and tariff cost
+            over those practices where this is at least `min_delta`
+
+    Entries are ordered by presentation and then by org, and only included
+    where the org prescribed the presentation and the possible savings are
+    non-zero.
+
+    This calculates the same values as handling each org and presentation in
+    turn would, but treats each block of presentations as the columns of a
+    single matrix which is much faster when there are many orgs.
+    """
+    prices = get_inferred_tariff_prices(db, date, presentations_to_ignore)
+    bnf_codes = sorted(prices.keys())
+    results = defaultdict(list)
+    for start in range(0, len(bnf_codes), PRESENTATIONS_PER_BLOCK):
+        block = bnf_codes[start : start + PRESENTATIONS_PER_BLOCK]
+        quantities, net_costs = get_quantities_and_net_costs(db, block, date)
+        tariff_costs = quantities * [prices[bnf_code] for bnf_code in block]
+        possible_savings = net_costs - tariff_costs
+        savings_above_threshold = numpy.absolute(possible_savings) >= min_delta
+        possible_savings[~savings_above_threshold] = 0
+        savings_for_orgs = group_by_org.sum(possible_savings)
+        # Only include presentations which the org actually prescribed
+        prescribed = group_by_org.sum(numpy.absolute(quantities)) != 0
+        # We transpose so that entries are found in order of presentation
+        presentation_indices, org_offsets = numpy.nonzero(
+            (savings_for_orgs != 0).T & prescribed.T
+        )
+        index = (org_offsets, presentation_indices)
+        results["presentation_index"].append(presentation_indices + start)
+        results["org_offset"].append(org_offsets)
+        results["quantity"].append(group_by_org.sum(quantities)[index])
+        results["net_cost"].append(group_by_org.sum(net_costs)[index])
+        results["possible_savings"].append(savings_for_orgs[index])
+    results = {key: numpy.concatenate(arrays) for key, arrays in results.items()}
+    results["bnf_codes"] = bnf_codes
+    results["tariff_price"] = numpy.array([prices[code] for code in bnf_codes])
+    return results
+
+
 def get_total_ghost_branded_generic_spending(date, org_type, org_id):
     """
     Get the total spend on generics (by this org and in this month) over and
@@ -210,33 +288,42 @@ def infer_tariff_price_for_presentations(db, bnf_codes, date):
         # which we use elsewhere) because this matches the behaviour of
         # Postgres's PERCENTILE_DISC function on which this calculation was
         # originally based
-        median_ppu = numpy.nanpercentile(ppu, axis=0, q=50, interpolation="lower")[0]
+        median_ppu = nanpercentile_by_column(ppu, q=50, interpolation="lower")[0]
         prices[bnf_code] = median_ppu
     # Restore numpy warnings
     numpy.seterr(**numpy_err)
     return prices
 
 
-def get_prescribing_for_orgs(db, bnf_codes, date, org_type, org_ids):
+def get_quantities_and_net_costs(db, bnf_codes, date):
     """
-    Get all prescribing for a given set of presentations by the given
-    organisation on the given date.
-
-    Results are returned as practice level matrices, but containing only the
-    practices in the given organisations. Presentations for which there is no
-    relevant prescribing are omitted.
-
-    Yields tuples of the form:
-
-        org_id, bnf_code, quantity_matrix, net_cost_matrix
+    Return quantity and net cost matrices for just the specified date, with a
+    row for each practice and a column for each of the supplied BNF codes
     """
-    group_by_org = get_row_grouper(org_type)
-    for bnf_code, quantities, net_costs in get_prescribing(db, bnf_codes, date):
-        for org_id in org_ids:
-            quantities_for_org = group_by_org.get_group(quantities, org_id)
-            if numpy.any(quantities_for_org):
-                net_costs_for_org = group_by_org.get_group(net_costs, org_id)
-                yield org_id, bnf_code, quantities_for_org, net_costs_for_org
+    shape = (len(db.practice_offsets), len(bnf_codes))
+    quantities = numpy.zeros(shape, order="F")
+    net_costs = numpy.zeros(shape, order="F")
+    offsets = {bnf_code: n for n, bnf_code in enumerate(bnf_codes)}
+    date_column = db.date_offsets[date]
+    results = db.query(
+        """
+        SELECT
+          bnf_code,
+          MATRIX_SUM_COLS(quantity, ?, ?),
+          MATRIX_SUM_COLS(net_cost, ?, ?)
+        FROM
+          presentation
+        WHERE
+          bnf_code IN ({})
+        """.format(
+            ",".join(["?"] * len(offsets))
+        ),
+        [date_column, date_column + 1] * 2 + list(offsets),
+    )
+    for bnf_code, quantity, net_cost in results:
+        quantities[:, offsets[bnf_code]] = quantity[:, 0]
+        net_costs[:, offsets[bnf_code]] = net_cost[:, 0]
+    return quantities, net_costs
 
 
 def get_prescribing(db, bnf_codes, date):
@@ -248,17 +335,8 @@ def get_prescribing(db, bnf_codes, date):
     date_column = db.date_offsets[date]
     date_slice = slice(date_column, date_column + 1)
 
-    results = db.query(
-        """
-        SELECT bnf_code, quantity, net_cost FROM presentation WHERE bnf_code IN ({})
-        """.format(
-            ",".join("?" * len(bnf_codes))
-        ),
-        bnf_codes,
+    results = db.query_presentations(
+        bnf_codes, ["quantity", "net_cost"], cols=date_slice
     )
     for bnf_code, quantity, net_cost in results:
-        yield (
-            bnf_code,
-            get_submatrix(quantity, cols=date_slice),
-            get_submatrix(net_cost, cols=date_slice),
-        )
+        yield bnf_code, quantity, net_cost
@@ -6,33 +6,50 @@ the alternative, which is looping over thousands of practices
 individually with a custom SQL query. However, the tradeoff is that
 most of the logic now lives in SQL which is harder to read and test
 clearly.
+
+Measures whose numerators and denominators are simple sums over
+prescribing of lists of BNF codes, or practice statistics, can instead
+be calculated from the MatrixStore with numpy, without touching
+BigQuery at all. This happens for measures whose definitions set
+`use_matrixstore`, or for all such measures with `--use_matrixstore`.
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 import csv
 from datetime import datetime
+from functools import partial
 import glob
 import json
 import logging
 import os
+import queue
 import re
 import tempfile
+import threading
 from urllib.parse import urlencode
 
 from dateutil.relativedelta import relativedelta
+import numpy
+import scipy.sparse
 
 from django.conf import settings
 from django.core.management import BaseCommand
 from django.urls import reverse
 from django.db import connection
 from django.db import transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, Q
 
 from gcutils.bigquery import Client
 
 from common import utils
 
-from frontend.models import MeasureGlobal, MeasureValue, Measure, ImportLog
+from frontend.models import MeasureGlobal, MeasureValue, Measure, ImportLog, Practice
 from frontend.utils.bnf_hierarchy import get_all_bnf_codes, simplify_bnf_codes
+from matrixstore.db import get_db
+from matrixstore.matrix_ops import nanpercentile_by_column
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.sql_functions import MatrixSumMany
 
 from google.api_core.exceptions import BadRequest
 
@@ -40,6 +57,19 @@ logger = logging.getLogger(__name__)
 
 CENTILES = [10, 20, 30, 40, 50, 60, 70, 80, 90]
 
+# Organisation types, in the order in which their centiles are added to the
+# global table
+ORG_TYPES = ["pcn", "ccg", "stp", "regtm"]
+
+# The table each type of organisation's ratios are summed from (see
+# `measure_sql/<org_type>_ratios.sql`)
+ORG_RATIOS_SOURCES = {
+    "pcn": "practice",
+    "ccg": "practice",
+    "stp": "ccg",
+    "regtm": "ccg",
+}
+
 MEASURE_FIELDNAMES = [
     "measure_id",
     "regional_team_id",
@@ -55,6 +85,33 @@ MEASURE_FIELDNAMES = [
     "cost_savings",
 ]
 
+MEASURE_GLOBAL_FIELDNAMES = [
+    "measure_id",
+    "month",
+    "numerator",
+    "denominator",
+    "calc_value",
+    "percentiles",
+    "cost_savings",
+]
+
+# Numerator and denominator types which can be calculated from the
+# MatrixStore, mapped to the `presentation` or `practice_statistic` matrices
+# they are summed from
+MATRIXSTORE_PRESCRIBING_FIELDS = {
+    "bnf_items": "items",
+    "bnf_quantity": "quantity",
+    "bnf_cost": "actual_cost",
+}
+MATRIXSTORE_PRACTICE_STATISTICS = {
+    "list_size": "total_list_size",
+    "star_pu_antibiotics": "star_pu.oral_antibacterials_item",
+}
+
+# Number of BNF codes we fetch from the MatrixStore in a single query, to stay
+# well within SQLite's limit on the number of query parameters
+BNF_CODES_PER_QUERY = 500
+
 
 class Command(BaseCommand):
     """
@@ -62,7 +119,9 @@ class Command(BaseCommand):
     and more than one with a comma-delimited list.
     """
 
-    def check_definitions(self, measure_defs, start_date, end_date, verbose):
+    def check_definitions(
+        self, measure_defs, start_date, end_date, verbose, use_matrixstore=False
+    ):
         """Checks SQL definitions for measures."""
 
         # We don't validate JSON here, as this is already done as a
@@ -71,8 +130,13 @@ class Command(BaseCommand):
         for measure_def in measure_defs:
             measure_id = measure_def["id"]
             try:
-                measure = create_or_update_measure(measure_def, end_date)
-                calculation = MeasureCalculation(
+                calculation_class = get_calculation_class(measure_def, use_matrixstore)
+                measure = create_or_update_measure(
+                    measure_def,
+                    end_date,
+                    use_matrixstore=calculation_class.uses_matrixstore,
+                )
+                calculation = calculation_class(
                     measure, start_date=start_date, end_date=end_date, verbose=verbose
                 )
                 calculation.check_definition()
@@ -80,6 +144,10 @@ class Command(BaseCommand):
                 errors.append("* SQL error in `{}`: {}".format(measure_id, e.args[0]))
             except TypeError as e:
                 errors.append("* JSON error in `{}`: {}".format(measure_id, e.args[0]))
+            except ValueError as e:
+                errors.append(
+                    "* MatrixStore error in `{}`: {}".format(measure_id, e.args[0])
+                )
         if errors:
             raise BadRequest("\n".join(errors))
 
@@ -93,18 +161,30 @@ class Command(BaseCommand):
             and not options["bigquery_only"]
         )
         with conditional_constraint_and_index_reconstructor(drop_and_rebuild_indices):
+            if options["parallel"] and not options["definitions_only"]:
+                measure_defs = self.build_bigquery_measures_in_parallel(
+                    measure_defs, start_date, end_date, verbose, options
+                )
             for measure_def in measure_defs:
                 measure_id = measure_def["id"]
                 logger.info("Updating measure: %s" % measure_id)
                 measure_start = datetime.now()
 
+                calculation_class = get_calculation_class(
+                    measure_def, options["use_matrixstore"]
+                )
+
                 with transaction.atomic():
-                    measure = create_or_update_measure(measure_def, end_date)
+                    measure = create_or_update_measure(
+                        measure_def,
+                        end_date,
+                        use_matrixstore=calculation_class.uses_matrixstore,
+                    )
 
                     if options["definitions_only"]:
                         continue
 
-                    calcuation = MeasureCalculation(
+                    calcuation = calculation_class(
                         measure,
                         start_date=start_date,
                         end_date=end_date,
@@ -123,6 +203,75 @@ class Command(BaseCommand):
                     "Elapsed time for %s: %s seconds" % (measure_id, elapsed.seconds)
                 )
 
+    def build_bigquery_measures_in_parallel(
+        self, measure_defs, start_date, end_date, verbose, options
+    ):
+        """Build measures which are calculated in BigQuery, running the jobs for
+        up to `options["parallel"]` steps at once.
+
+        Each measure is calculated in steps, which are run as soon as the
+        steps they depend on have finished (see `MeasureCalculation.get_steps`)
+        and may be interleaved with those of other measures.  Everything
+        which touches the local database happens in this thread: once all of
+        a measure's steps have finished, its definition is updated and its
+        values are replaced in a single transaction, as they are when
+        measures are built one at a time.  So if a step fails, the measures
+        which haven't finished are left as they were.
+
+        Measures calculated from the MatrixStore don't run any BigQuery jobs,
+        and are returned to be built one at a time as usual.
+        """
+        matrixstore_measure_defs = []
+        calculations = {}
+        for measure_def in measure_defs:
+            calculation_class = get_calculation_class(
+                measure_def, options["use_matrixstore"]
+            )
+            if calculation_class.uses_matrixstore:
+                matrixstore_measure_defs.append(measure_def)
+                continue
+            # The updated definition isn't saved until the measure's values
+            # are written
+            measure = build_measure(measure_def, end_date)
+            calculations[measure.id] = calculation_class(
+                measure, start_date=start_date, end_date=end_date, verbose=verbose
+            )
+
+        steps = {}
+        measure_ids = list(calculations)
+        for ix, (measure_id, calculation) in enumerate(calculations.items()):
+            for step_name, (function, dependencies) in calculation.get_steps().items():
+                dependencies = [(measure_id, dependency) for dependency in dependencies]
+                if step_name == "practice" and calculation.reads_other_measures():
+                    # Its practice ratios are calculated from the practice
+                    # tables of the measures which come before it (see
+                    # `load_measure_defs`)
+                    dependencies.extend(
+                        (other_measure_id, "practice")
+                        for other_measure_id in measure_ids[:ix]
+                    )
+                steps[(measure_id, step_name)] = (function, dependencies)
+
+        remaining_steps = {measure_id: 0 for measure_id in calculations}
+        for measure_id, _ in steps:
+            remaining_steps[measure_id] += 1
+        # Steps carry on being scheduled while finished measures are written
+        # to the database
+        for measure_id, _ in run_steps_in_background(steps, options["parallel"]):
+            remaining_steps[measure_id] -= 1
+            if remaining_steps[measure_id] > 0:
+                continue
+            calculation = calculations[measure_id]
+            with transaction.atomic():
+                calculation.measure.save()
+                if not options["bigquery_only"]:
+                    MeasureValue.objects.filter(measure_id=measure_id).delete()
+                    MeasureGlobal.objects.filter(measure_id=measure_id).delete()
+                    calculation.write_to_database()
+            logger.info("Updated measure %s in database", measure_id)
+
+        return matrixstore_measure_defs
+
     def handle(self, *args, **options):
         start = datetime.now()
 
@@ -137,7 +286,13 @@ class Command(BaseCommand):
 
         verbose = options["verbosity"] > 1
         if options["check"]:
-            self.check_definitions(measure_defs, start_date, end_date, verbose)
+            self.check_definitions(
+                measure_defs,
+                start_date,
+                end_date,
+                verbose,
+                use_matrixstore=options["use_matrixstore"],
+            )
         else:
             self.build_measures(measure_defs, start_date, end_date, verbose, options)
 
@@ -148,6 +303,18 @@ class Command(BaseCommand):
         parser.add_argument("--definitions_only", action="store_true")
         parser.add_argument("--bigquery_only", action="store_true")
         parser.add_argument("--check", action="store_true")
+        parser.add_argument(
+            "--use_matrixstore",
+            action="store_true",
+            help="Calculate every measure which can be calculated from the "
+            "MatrixStore that way, and not just those whose definitions ask for it",
+        )
+        parser.add_argument(
+            "--parallel",
+            type=int,
+            metavar="N",
+            help="Calculate measures in BigQuery with up to N jobs running at once",
+        )
 
 
 def load_measure_defs(measure_ids=None):
@@ -187,6 +354,69 @@ def load_measure_defs(measure_ids=None):
     return measures
 
 
+def get_calculation_class(measure_def, use_matrixstore=False):
+    """Return the class which should be used to calculate the measure.
+
+    Measures are calculated from the MatrixStore if their definitions set
+    `use_matrixstore`, or if `use_matrixstore` is passed here and they can be.
+    """
+    if measure_def.get("use_matrixstore"):
+        if not can_use_matrixstore(measure_def):
+            raise ValueError(
+                "Measure {} can't be calculated from the MatrixStore".format(
+                    measure_def["id"]
+                )
+            )
+        return MatrixStoreMeasureCalculation
+    if use_matrixstore and can_use_matrixstore(measure_def):
+        return MatrixStoreMeasureCalculation
+    return MeasureCalculation
+
+
+def can_use_matrixstore(measure_def):
+    """Return whether the measure's numerator and denominator can be calculated
+    directly from the MatrixStore.
+
+    This is the case where they're sums over prescribing of BNF codes selected
+    by `*_bnf_codes_filter` alone (any `*_bnf_codes_query` has to be run in
+    BigQuery), or where the denominator is a practice statistic.
+
+    Measures whose practice-level tables in BigQuery are read by other
+    measures (such as the low-priority measures which make up lpzomnibus)
+    have to be calculated in BigQuery so that those tables are kept up to
+    date.
+    """
+    if measure_def["id"] in get_measure_ids_used_by_bigquery_views():
+        return False
+    for num_or_denom in ["numerator", "denominator"]:
+        if measure_def[num_or_denom + "_type"] in MATRIXSTORE_PRESCRIBING_FIELDS:
+            if measure_def.get(num_or_denom + "_bnf_codes_query"):
+                return False
+            if not measure_def.get(num_or_denom + "_bnf_codes_filter"):
+                return False
+    if measure_def["numerator_type"] not in MATRIXSTORE_PRESCRIBING_FIELDS:
+        return False
+    denominator_type = measure_def["denominator_type"]
+    if denominator_type in MATRIXSTORE_PRESCRIBING_FIELDS:
+        return True
+    if denominator_type in MATRIXSTORE_PRACTICE_STATISTICS:
+        # Cost savings for percentage measures need the cost and quantity of
+        # the prescribing in the denominator
+        return not (measure_def["is_cost_based"] and measure_def["is_percentage"])
+    return False
+
+
+def get_measure_ids_used_by_bigquery_views():
+    """Return IDs of measures whose practice-level tables are read by the views
+    defined in `measure_sql`."""
+    sql_path = os.path.join(
+        os.path.dirname(__file__), "measure_sql", "practice_data_all_low_priority.sql"
+    )
+    with open(sql_path) as f:
+        sql = f.read()
+    return set(re.findall(r"\{measures\}\.practice_data_(\w+)", sql))
+
+
 # Utility methods
 
 
@@ -270,8 +500,21 @@ def arrays_to_strings(measure_def):
     return measure_def
 
 
-def create_or_update_measure(measure_def, end_date):
-    """Create a measure object based on a measure definition"""
+def create_or_update_measure(measure_def, end_date, use_matrixstore=False):
+    """Create a measure object based on a measure definition, and save it
+
+    If `use_matrixstore` is set then the BNF codes for the measure are found
+    from the MatrixStore rather than BigQuery.
+    """
+    m = build_measure(measure_def, end_date, use_matrixstore=use_matrixstore)
+    m.save()
+    return m
+
+
+def build_measure(measure_def, end_date, use_matrixstore=False):
+    """Create or update a measure object based on a measure definition, without
+    saving it (see `create_or_update_measure`)
+    """
     measure_id = measure_def["id"]
     v = arrays_to_strings(measure_def)
 
@@ -325,9 +568,14 @@ def create_or_update_measure(measure_def, end_date):
 
         m.numerator_bnf_codes_filter = v.get("numerator_bnf_codes_filter")
         m.numerator_bnf_codes_query = v.get("numerator_bnf_codes_query")
-        m.numerator_bnf_codes = get_bnf_codes(
-            m.numerator_bnf_codes_query, m.numerator_bnf_codes_filter
-        )
+        if use_matrixstore:
+            m.numerator_bnf_codes = get_bnf_codes_from_matrixstore(
+                m.numerator_bnf_codes_filter
+            )
+        else:
+            m.numerator_bnf_codes = get_bnf_codes(
+                m.numerator_bnf_codes_query, m.numerator_bnf_codes_filter
+            )
 
         m.numerator_where = build_where(m.numerator_bnf_codes)
         m.numerator_is_list_of_bnf_codes = True
@@ -375,9 +623,14 @@ def create_or_update_measure(measure_def, end_date):
 
         m.denominator_bnf_codes_filter = v.get("denominator_bnf_codes_filter")
         m.denominator_bnf_codes_query = v.get("denominator_bnf_codes_query")
-        m.denominator_bnf_codes = get_bnf_codes(
-            m.denominator_bnf_codes_query, m.denominator_bnf_codes_filter
-        )
+        if use_matrixstore:
+            m.denominator_bnf_codes = get_bnf_codes_from_matrixstore(
+                m.denominator_bnf_codes_filter
+            )
+        else:
+            m.denominator_bnf_codes = get_bnf_codes(
+                m.denominator_bnf_codes_query, m.denominator_bnf_codes_filter
+            )
 
         m.denominator_where = build_where(m.denominator_bnf_codes)
         m.denominator_is_list_of_bnf_codes = True
@@ -385,8 +638,6 @@ def create_or_update_measure(measure_def, end_date):
     if not v.get("no_analyse_url"):
         m.analyse_url = build_analyse_url(m)
 
-    m.save()
-
     return m
 
 
@@ -491,6 +742,60 @@ def build_bnf_codes_query_fragment(element):
     return fragment.format(element)
 
 
+def get_bnf_codes_from_matrixstore(filter_):
+    """Return list of BNF codes used to calculate measure numerator/denominator
+    values, by applying `filter_` (as described in `get_bnf_codes`) to all the
+    BNF codes in the MatrixStore.
+
+    This gives the same results as `get_bnf_codes(None, filter_)` without
+    querying BigQuery.
+    """
+    includes = []
+    excludes = []
+
+    for element in filter_:
+        element = element.split("#")[0].strip()
+        if element[0] == "~":
+            excludes.append(build_bnf_codes_regex(element[1:]))
+        else:
+            includes.append(build_bnf_codes_regex(element))
+
+    def matches(bnf_code, regexes):
+        return any(regex.fullmatch(bnf_code) for regex in regexes)
+
+    return sorted(
+        bnf_code
+        for bnf_code in get_all_bnf_codes()
+        if (not includes or matches(bnf_code, includes))
+        and not matches(bnf_code, excludes)
+    )
+
+
+def build_bnf_codes_regex(element):
+    """Return a regex which matches the same BNF codes as the SQL built by
+    `build_bnf_codes_query_fragment`."""
+    if element[:2] <= "19":
+        # this is a drug
+        full_code_length = 15
+    else:
+        # this is an appliance
+        full_code_length = 11
+
+    if "%" in element:
+        pattern = like_pattern_to_regex(element)
+    elif len(element) == full_code_length:
+        pattern = re.escape(element)
+    else:
+        pattern = like_pattern_to_regex(element + "%")
+
+    return re.compile(pattern)
+
+
+def like_pattern_to_regex(like_pattern):
+    wildcards = {"%": ".*", "_": "."}
+    return "".join(wildcards.get(char) or re.escape(char) for char in like_pattern)
+
+
 def build_where(bnf_codes):
     if not bnf_codes:
         # hackety hack: this is for the end-to-end tests, where we don't import
@@ -594,6 +899,8 @@ def get_num_or_denom_bnf_codes(measure, num_or_denom, end_date):
 class MeasureCalculation(object):
     """Logic for measure calculations in BQ."""
 
+    uses_matrixstore = False
+
     def __init__(self, measure, start_date=None, end_date=None, verbose=False):
         self.verbose = verbose
         self.fpath = os.path.dirname(__file__)
@@ -612,12 +919,69 @@ class MeasureCalculation(object):
 
     def calculate(self, bigquery_only=False):
         self.calculate_practices(bigquery_only=bigquery_only)
-        self.calculate_orgs("pcn", bigquery_only=bigquery_only)
-        self.calculate_orgs("ccg", bigquery_only=bigquery_only)
-        self.calculate_orgs("stp", bigquery_only=bigquery_only)
-        self.calculate_orgs("regtm", bigquery_only=bigquery_only)  # Regional Team
+        for org_type in ORG_TYPES:
+            self.calculate_orgs(org_type, bigquery_only=bigquery_only)
         self.calculate_global(bigquery_only=bigquery_only)
 
+    def get_steps(self):
+        """Return the steps which `calculate` goes through, without writing
+        anything to the database, as a dict mapping each step's name to a pair
+        of the function which runs it and the names of the steps it depends on.
+
+        The ratios for PCNs and CCGs are calculated from the practice table,
+        and those for STPs and regional teams from the CCG table (see
+        `ORG_RATIOS_SOURCES`), so each type of organisation's ratios can be
+        calculated as soon as the table it's calculated from is ready.  But
+        each organisation's centiles are added to the global table by a query
+        which copies the centiles already there (see `global_deciles_ccgs.sql`),
+        so these have to be added one at a time, in order.
+        """
+        steps = {
+            "practice": (partial(self.calculate_practices, bigquery_only=True), []),
+        }
+        # Maps each org type to the step which calculates its table
+        ratios_steps = {"practice": "practice"}
+        previous_centiles_step = "practice"
+        for org_type in ORG_TYPES:
+            ratios_step = "{}_ratios".format(org_type)
+            centiles_step = "{}_centiles".format(org_type)
+            steps[ratios_step] = (
+                partial(self.calculate_org_ratios_and_percent_rank, org_type),
+                [ratios_steps[ORG_RATIOS_SOURCES[org_type]]],
+            )
+            ratios_steps[org_type] = ratios_step
+            steps[centiles_step] = (
+                partial(self.calculate_global_centiles_for_orgs, org_type),
+                [ratios_step, previous_centiles_step],
+            )
+            if self.measure.is_cost_based:
+                steps["{}_cost_savings".format(org_type)] = (
+                    partial(self.calculate_cost_savings_for_orgs, org_type),
+                    [centiles_step],
+                )
+            previous_centiles_step = centiles_step
+        steps["global"] = (
+            partial(self.calculate_global, bigquery_only=True),
+            [step for step in steps if step != "global"],
+        )
+        return steps
+
+    def reads_other_measures(self):
+        """Return whether the measure is calculated from the BigQuery tables of
+        other measures."""
+        return any(
+            "{measures}.practice_data_" in (from_ or "")
+            for from_ in [self.measure.numerator_from, self.measure.denominator_from]
+        )
+
+    def write_to_database(self):
+        """Write everything calculated by the steps returned by `get_steps` to
+        the database."""
+        self.write_practice_ratios_to_database()
+        for org_type in ORG_TYPES:
+            self.write_org_ratios_to_database(org_type)
+        self.write_global_centiles_to_database()
+
     def calculate_practices(self, bigquery_only=False):
         """Calculate ratios, centiles and (optionally) cost savings at a
         practice level, and write these to the database.
@@ -720,38 +1084,24 @@ class MeasureCalculation(object):
         load time performance.
 
         """
-        f = tempfile.TemporaryFile(mode="r+")
-        writer = csv.DictWriter(f, fieldnames=MEASURE_FIELDNAMES)
-        # Write the data we want to load into a file
-        for datum in self.get_rows_as_dicts(self.table_name("practice")):
-            datum["measure_id"] = self.measure.id
-            if self.measure.is_cost_based:
-                datum["cost_savings"] = json.dumps(convertSavingsToDict(datum))
-            datum["percentile"] = normalisePercentile(datum["percentile"])
-            datum = {fn: datum[fn] for fn in MEASURE_FIELDNAMES if fn in datum}
-            writer.writerow(datum)
-        # load data
-        copy_str = "COPY frontend_measurevalue(%s) FROM STDIN "
-        copy_str += "WITH (FORMAT CSV)"
-        self.log(copy_str % ", ".join(MEASURE_FIELDNAMES))
-        f.seek(0)
-        with connection.cursor() as cursor:
-            cursor.copy_expert(copy_str % ", ".join(MEASURE_FIELDNAMES), f)
-        f.close()
+        self.write_measure_values_to_database("practice")
 
     def calculate_orgs(self, org_type, bigquery_only=False):
         """Calculate ratios, centiles and (optionally) cost savings at a
         organisation level, and write these to the database.
 
         """
-        self.calculate_org_ratios(org_type)
-        self.add_org_percent_rank(org_type)
+        self.calculate_org_ratios_and_percent_rank(org_type)
         self.calculate_global_centiles_for_orgs(org_type)
         if self.measure.is_cost_based:
             self.calculate_cost_savings_for_orgs(org_type)
         if not bigquery_only:
             self.write_org_ratios_to_database(org_type)
 
+    def calculate_org_ratios_and_percent_rank(self, org_type):
+        self.calculate_org_ratios(org_type)
+        self.add_org_percent_rank(org_type)
+
     def calculate_org_ratios(self, org_type):
         """Sums all the fields in the per-practice table, grouped by
         organisation. Stores in a new table.
@@ -813,13 +1163,28 @@ class MeasureCalculation(object):
 
     def write_org_ratios_to_database(self, org_type):
         """Create measure values for organisation ratios."""
+        self.write_measure_values_to_database(org_type)
+
+    def write_measure_values_to_database(self, org_type):
+        """Copy the ratios for the given type of organisation to MeasureValue
+        with COPY (see `copy_rows_to_table`)."""
+        self.log(
+            "Copying %s values from %s to database"
+            % (org_type, self.table_name(org_type))
+        )
+        copy_rows_to_table(
+            MeasureValue._meta.db_table,
+            MEASURE_FIELDNAMES,
+            self.get_measure_value_rows(org_type),
+        )
+
+    def get_measure_value_rows(self, org_type):
         for datum in self.get_rows_as_dicts(self.table_name(org_type)):
             datum["measure_id"] = self.measure.id
             if self.measure.is_cost_based:
                 datum["cost_savings"] = convertSavingsToDict(datum)
             datum["percentile"] = normalisePercentile(datum["percentile"])
-            datum = {fn: datum[fn] for fn in MEASURE_FIELDNAMES if fn in datum}
-            MeasureValue.objects.create(**datum)
+            yield datum
 
     def calculate_global(self, bigquery_only=False):
         if self.measure.is_cost_based:
@@ -841,6 +1206,17 @@ class MeasureCalculation(object):
         self.log(
             "Writing global centiles from %s to database" % self.table_name("global")
         )
+        fieldnames = list(MEASURE_GLOBAL_FIELDNAMES)
+        if not self.measure.is_cost_based:
+            fieldnames.remove("cost_savings")
+        upsert_rows_into_table(
+            MeasureGlobal._meta.db_table,
+            ["measure_id", "month"],
+            fieldnames,
+            self.get_measure_global_rows(fieldnames),
+        )
+
+    def get_measure_global_rows(self, fieldnames):
         for d in self.get_rows_as_dicts(self.table_name("global")):
             regtm_cost_savings = {}
             stp_cost_savings = {}
@@ -856,9 +1232,7 @@ class MeasureCalculation(object):
                 new_d[attr.replace("global_", "")] = value
             d = new_d
 
-            mg, _ = MeasureGlobal.objects.get_or_create(
-                measure_id=self.measure.id, month=d["month"]
-            )
+            mg = MeasureGlobal(measure_id=self.measure.id, month=d["month"])
 
             # Coerce decile-based values into JSON objects
             if self.measure.is_cost_based:
@@ -891,7 +1265,8 @@ class MeasureCalculation(object):
             # on the model
             for attr, value in d.items():
                 setattr(mg, attr, value)
-            mg.save()
+            mg.update_calc_value()
+            yield {fn: getattr(mg, fn) for fn in fieldnames}
 
     def insert_rows_from_query(self, query_id, table_name, ctx, dry_run=False):
         """Interpolate values from ctx into SQL identified by query_id, and
@@ -959,6 +1334,558 @@ class MeasureCalculation(object):
         return val
 
 
+class MatrixStoreMeasureCalculation(MeasureCalculation):
+    """Logic for measure calculations using the MatrixStore.
+
+    This replicates the calculations done by the SQL in `measure_sql/` with
+    numpy, for measures whose numerators and denominators can be taken
+    directly from the MatrixStore (see `can_use_matrixstore`). Each step
+    produces the same values as the corresponding BigQuery table, but they're
+    held in memory and handed to the methods which write to the database by
+    `get_rows_as_dicts`.
+
+    Values are held as matrices with a row for each organisation and a column
+    for each month, in a dict for each org type.
+    """
+
+    uses_matrixstore = True
+
+    def __init__(self, measure, start_date=None, end_date=None, verbose=False):
+        super(MatrixStoreMeasureCalculation, self).__init__(
+            measure, start_date=start_date, end_date=end_date, verbose=verbose
+        )
+        # Maps org types to the values for each org and month
+        self.values = {}
+        # Maps org types to a list giving the MeasureValue fields which
+        # identify the org in each row of its values
+        self.orgs = {}
+        # Maps org types to a matrix with a row of values for each centile
+        self.centiles = {}
+        # Maps names to the global value for each month
+        self.global_values = {}
+
+    def check_definition(self):
+        """Check that the measure's numerator and denominator can be found in
+        the MatrixStore, and that it has data for the end date, without
+        calculating anything.
+        """
+        db = get_db()
+        if str(self.end_date) not in db.date_offsets:
+            raise ValueError("No data in MatrixStore for {}".format(self.end_date))
+        for num_or_denom in ["numerator", "denominator"]:
+            type_ = getattr(self.measure, num_or_denom + "_type")
+            if type_ in MATRIXSTORE_PRESCRIBING_FIELDS:
+                if not getattr(self.measure, num_or_denom + "_bnf_codes"):
+                    raise ValueError(
+                        "No BNF codes in MatrixStore match {} filter".format(
+                            num_or_denom
+                        )
+                    )
+            else:
+                statistic = MATRIXSTORE_PRACTICE_STATISTICS[type_]
+                results = db.query(
+                    "SELECT 1 FROM practice_statistic WHERE name=?", [statistic]
+                )
+                if not list(results):
+                    raise ValueError(
+                        "No practice statistic in MatrixStore named {}".format(
+                            statistic
+                        )
+                    )
+
+    def calculate_practice_ratios(self, dry_run=False):
+        """Find numerators and denominators for practices in the MatrixStore,
+        and compute their ratios.
+
+        See practice_ratios.sql.
+        """
+        db = get_db()
+        self.dates = [
+            date
+            for date in db.dates
+            if str(self.start_date) <= date <= str(self.end_date)
+        ]
+        self.practices = get_measure_practices()
+        # These are the values which get summed over organisations
+        self.practice_totals = get_practice_values(
+            db, self.measure, [p["practice_id"] for p in self.practices], self.dates
+        )
+        values = dict(self.practice_totals)
+        calc_value = divide(values["numerator"], values["denominator"])
+        calc_value[numpy.isinf(calc_value)] = numpy.nan
+        values["calc_value"] = calc_value
+        self.values["practice"] = values
+        self.orgs["practice"] = self.practices
+
+    def add_practice_percent_rank(self):
+        self.add_percent_rank("practice")
+
+    def calculate_global_centiles_for_practices(self):
+        """Compute overall sums and centiles for practices.
+
+        See global_deciles_practices.sql.
+        """
+        totals = {
+            name: values.sum(axis=0) for name, values in self.practice_totals.items()
+        }
+        self.global_values["numerator"] = totals["numerator"]
+        self.global_values["denominator"] = totals["denominator"]
+        if self.measure.is_cost_based and self.measure.is_percentage:
+            # Cost calculations for percentage measures use the global costs
+            # per unit
+            self.cost_per_denom = divide(
+                totals["denom_cost"] - totals["num_cost"],
+                totals["denom_quantity"] - totals["num_quantity"],
+            )
+            self.cost_per_num = divide(totals["num_cost"], totals["num_quantity"])
+        self.add_centiles("practice")
+
+    def calculate_cost_savings_for_practices(self):
+        self.add_cost_savings("practice")
+
+    def calculate_org_ratios(self, org_type):
+        """Sum the practice values for each organisation and compute their
+        ratios.
+
+        See `org_type`_ratios.sql.
+        """
+        row_grouper, self.orgs[org_type] = self.get_org_grouping(org_type)
+        values = {
+            name: row_grouper.sum(practice_values)
+            for name, practice_values in self.practice_totals.items()
+        }
+        # Unlike practices, organisations with no denominator keep their
+        # infinite ratios
+        values["calc_value"] = divide(values["numerator"], values["denominator"])
+        self.values[org_type] = values
+
+    def add_org_percent_rank(self, org_type):
+        self.add_percent_rank(org_type)
+
+    def calculate_global_centiles_for_orgs(self, org_type):
+        self.add_centiles(org_type)
+
+    def calculate_cost_savings_for_orgs(self, org_type):
+        self.add_cost_savings(org_type)
+
+    def calculate_global_cost_savings(self):
+        """Sum positive cost savings for each org type.
+
+        See global_cost_savings.sql.
+        """
+        for org_type, values in self.values.items():
+            for centile in CENTILES:
+                cost_savings = values["cost_savings_{}".format(centile)]
+                key = "{}_cost_savings_{}".format(org_type, centile)
+                self.global_values[key] = numpy.where(
+                    cost_savings > 0, cost_savings, 0
+                ).sum(axis=0)
+
+    def add_percent_rank(self, org_type):
+        """See practice_percent_rank.sql."""
+        values = self.values[org_type]
+        values["percentile"] = percent_rank_by_column(values["calc_value"])
+
+    def add_centiles(self, org_type):
+        """See global_deciles_practices.sql."""
+        calc_value = self.values[org_type]["calc_value"]
+        centiles = numpy.array(
+            [nanpercentile_by_column(calc_value, centile) for centile in CENTILES]
+        )
+        self.centiles[org_type] = centiles
+        for centile, values in zip(CENTILES, centiles):
+            self.global_values["{}_{}th".format(org_type, centile)] = values
+
+    def add_cost_savings(self, org_type):
+        """See practice_percentage_measure_cost_savings.sql and
+        practice_list_size_measure_cost_savings.sql."""
+        values = self.values[org_type]
+        # Add an axis so that we calculate savings for every centile at once
+        centiles = self.centiles[org_type][:, numpy.newaxis, :]
+        if self.measure.is_percentage:
+            cost_savings = get_percentage_measure_cost_savings(
+                values, centiles, self.cost_per_num, self.cost_per_denom
+            )
+        else:
+            cost_savings = values["numerator"] - centiles * values["denominator"]
+        # Savings which are NULL in BigQuery end up as zero in the database
+        cost_savings[numpy.isnan(cost_savings)] = 0
+        for centile, org_cost_savings in zip(CENTILES, cost_savings):
+            values["cost_savings_{}".format(centile)] = org_cost_savings
+
+    def get_org_grouping(self, org_type):
+        """Return a RowGrouper which groups the rows of practice values into
+        organisations of the given type, along with a list giving the
+        MeasureValue fields which identify each organisation.
+
+        As in BigQuery, organisations are made up of the practices for which we
+        calculate measures, which is why we don't use
+        `matrixstore.db.get_row_grouper`. Practices not in a CCG (with
+        org_type "CCG") don't count towards STPs or regional teams either.
+        """
+        if org_type == "pcn":
+            org_fields = ["pcn_id"]
+        elif org_type == "ccg":
+            org_fields = ["pct_id", "stp_id", "regional_team_id"]
+        elif org_type == "stp":
+            org_fields = ["stp_id"]
+        elif org_type == "regtm":
+            org_fields = ["regional_team_id"]
+        else:
+            assert False, org_type
+        orgs = {}
+        group_assignments = []
+        for row, practice in enumerate(self.practices):
+            if org_type != "pcn" and not practice["in_ccg"]:
+                continue
+            org = tuple(practice[field] for field in org_fields)
+            if org[0] is None:
+                continue
+            orgs[org[0]] = dict(zip(org_fields, org))
+            group_assignments.append((row, org[0]))
+        row_grouper = RowGrouper(group_assignments)
+        return row_grouper, [orgs[org_id] for org_id in row_grouper.ids]
+
+    def get_rows_as_dicts(self, table_name):
+        """Iterate over the values which would be in the specified BigQuery
+        table, returning a dict for each row of data.
+        """
+        if table_name == self.table_name("global"):
+            # The global table has a single row for each month, but otherwise
+            # we treat it just like the others
+            orgs = [{}]
+            values = {
+                name: value[numpy.newaxis, :]
+                for name, value in self.global_values.items()
+            }
+        else:
+            for org_type in self.values:
+                if table_name == self.table_name(org_type):
+                    orgs = self.orgs[org_type]
+                    values = self.values[org_type]
+                    break
+            else:
+                raise ValueError("Unknown table: {}".format(table_name))
+        # Convert to lists of Python values up front, with NULLs for NaNs,
+        # rather than converting each value in turn
+        values = {
+            name: [[nan_to_none(value) for value in row] for row in matrix.tolist()]
+            for name, matrix in values.items()
+        }
+        for row, org in enumerate(orgs):
+            for column, date in enumerate(self.dates):
+                datum = dict(org, month=date)
+                for name, matrix in values.items():
+                    datum[name] = matrix[row][column]
+                yield datum
+
+
+def get_measure_practices():
+    """Return details of the practices for which we calculate measures, with
+    the MeasureValue fields which identify each practice and the organisations
+    it belongs to, ordered by code.
+
+    As in practice_ratios.sql, these are standard GP practices which belong to
+    a CCG (or other PCT).
+    """
+    return list(
+        Practice.objects.filter(setting=4, ccg__isnull=False)
+        .annotate(
+            practice_id=F("code"),
+            pct_id=F("ccg_id"),
+            stp_id=F("ccg__stp_id"),
+            regional_team_id=F("ccg__regional_team_id"),
+            in_ccg=ExpressionWrapper(Q(ccg__org_type="CCG"), BooleanField()),
+        )
+        .order_by("code")
+        .values(
+            "practice_id", "pcn_id", "pct_id", "stp_id", "regional_team_id", "in_ccg"
+        )
+    )
+
+
+def get_practice_values(db, measure, practice_codes, dates):
+    """Return a dict mapping names to matrices with a row for each practice
+    and a column for each date, giving the numerator and denominator of the
+    measure for each practice and month.
+
+    For cost-based percentage measures we also include the costs and quantities
+    of the prescribing in the numerator and denominator, which are needed to
+    calculate cost savings.
+
+    Practices with no data in the MatrixStore get zeros, as they do in BigQuery.
+    """
+    rows = numpy.array([db.practice_offsets.get(code, -1) for code in practice_codes])
+    columns = numpy.array([db.date_offsets[date] for date in dates], dtype=int)
+    found = rows != -1
+
+    def select(matrix):
+        values = numpy.zeros((len(rows), len(columns)))
+        if matrix is not None:
+            if scipy.sparse.issparse(matrix):
+                matrix = matrix.toarray()
+            values[found] = matrix[numpy.ix_(rows[found], columns)]
+        return values
+
+    values = {}
+    include_costs = measure.is_cost_based and measure.is_percentage
+    for num_or_denom, prefix in [("numerator", "num"), ("denominator", "denom")]:
+        type_ = getattr(measure, num_or_denom + "_type")
+        if type_ in MATRIXSTORE_PRESCRIBING_FIELDS:
+            bnf_codes = getattr(measure, num_or_denom + "_bnf_codes")
+            totals = get_prescribing_totals(db, bnf_codes)
+            values[num_or_denom] = select(totals[MATRIXSTORE_PRESCRIBING_FIELDS[type_]])
+            if include_costs:
+                values[prefix + "_cost"] = select(totals["actual_cost"])
+                values[prefix + "_quantity"] = select(totals["quantity"])
+        else:
+            statistic = MATRIXSTORE_PRACTICE_STATISTICS[type_]
+            values[num_or_denom] = select(get_practice_statistic(db, statistic))
+            if type_ == "list_size":
+                values[num_or_denom] /= 1000.0
+    return values
+
+
+def get_prescribing_totals(db, bnf_codes):
+    """Return a dict mapping "items", "quantity" and "actual_cost" to matrices
+    giving the total prescribing of all the supplied BNF codes, or to None if
+    there is no such prescribing.
+
+    Costs are converted from pence to pounds.
+    """
+    fields = ["items", "quantity", "actual_cost"]
+    matrix_sum = MatrixSumMany()
+    for n in range(0, len(bnf_codes), BNF_CODES_PER_QUERY):
+        results = db.query_presentations(bnf_codes[n : n + BNF_CODES_PER_QUERY], fields)
+        for bnf_code, *matrices in results:
+            matrix_sum.add(*matrices)
+    if matrix_sum.sums is None:
+        totals = dict.fromkeys(fields)
+    else:
+        totals = dict(zip(fields, matrix_sum.value()))
+    if totals["actual_cost"] is not None:
+        totals["actual_cost"] = totals["actual_cost"] / 100.0
+    return totals
+
+
+def get_practice_statistic(db, name):
+    """Return the matrix for the named practice statistic, or None if there
+    is no data for it."""
+    results = list(
+        db.query("SELECT value FROM practice_statistic WHERE name=?", [name])
+    )
+    return results[0][0] if results else None
+
+
+def divide(numerator, denominator):
+    """Divide arrays as BigQuery's IEEE_DIVIDE does, giving infinities and NaNs
+    rather than raising errors on division by zero."""
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.true_divide(numerator, denominator)
+
+
+def percent_rank_by_column(matrix):
+    """Return a matrix giving the percent rank (as calculated by BigQuery's
+    PERCENT_RANK) of each value within its column, ignoring NaNs.
+
+    This is the number of other values in the column which are strictly less
+    than the value, divided by the number of other values. NaNs get NaN.
+    """
+    percent_ranks = numpy.full(matrix.shape, numpy.nan)
+    for column in range(matrix.shape[1]):
+        values = matrix[:, column]
+        present = ~numpy.isnan(values)
+        values = values[present]
+        if len(values) == 0:
+            continue
+        ranks = numpy.searchsorted(numpy.sort(values), values, side="left")
+        percent_ranks[present, column] = ranks / max(len(values) - 1, 1)
+    return percent_ranks
+
+
+def get_percentage_measure_cost_savings(values, centiles, cost_per_num, cost_per_denom):
+    """Return the cost savings which could be made if the ratio for each org
+    were at each of the given centiles.
+
+    See practice_percentage_measure_cost_savings.sql.
+    """
+    num_cost = values["num_cost"]
+    num_quantity = values["num_quantity"]
+    denom_cost = values["denom_cost"]
+    denom_quantity = values["denom_quantity"]
+    # Where the org doesn't prescribe anything in the numerator (or anything
+    # outside it) we use the global costs per unit
+    other_quantity = denom_quantity - num_quantity
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        num_unit_cost = numpy.where(
+            num_quantity > 0, num_cost / num_quantity, cost_per_num
+        )
+        other_unit_cost = numpy.where(
+            other_quantity == 0,
+            cost_per_denom,
+            (denom_cost - num_cost) / other_quantity,
+        )
+        target_cost = (
+            centiles * denom_quantity * num_unit_cost
+            + (denom_quantity - denom_quantity * centiles) * other_unit_cost
+        )
+    return denom_cost - target_cost
+
+
+def nan_to_none(value):
+    return None if value != value else value
+
+
+def run_steps(steps, max_workers):
+    """Run steps in a pool of `max_workers` threads, starting each as soon as
+    all the steps it depends on have finished, and yield each step's name once
+    it has finished.
+
+    `steps` maps each step's name to a pair of the function which runs it and
+    the names of the steps it depends on.  If any step fails, no further steps
+    are started, and its exception is raised once the running steps have
+    finished.
+    """
+    pending = dict(steps)
+    finished = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, (function, dependencies) in list(pending.items()):
+                if finished.issuperset(dependencies):
+                    del pending[name]
+                    running[executor.submit(time_step, name, function)] = name
+            if not running:
+                raise ValueError(
+                    "Steps have unsatisfiable dependencies: {}".format(
+                        ", ".join(map(str, pending))
+                    )
+                )
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                future.result()
+                finished.add(name)
+                yield name
+
+
+def run_steps_in_background(steps, max_workers):
+    """Run steps as `run_steps` does, but schedule them from a separate thread,
+    so that steps carry on being started while the caller is handling the
+    ones which have already finished.
+
+    If the caller stops iterating, no further steps are started, and this
+    returns once the running steps have finished.
+    """
+    finished = queue.Queue()
+    stopping = threading.Event()
+
+    def schedule():
+        try:
+            for name in run_steps(steps, max_workers):
+                finished.put((name, None))
+                if stopping.is_set():
+                    break
+        except Exception as e:
+            finished.put((None, e))
+        else:
+            finished.put((None, None))
+
+    thread = threading.Thread(target=schedule)
+    thread.start()
+    try:
+        while True:
+            name, exception = finished.get()
+            if exception is not None:
+                raise exception
+            if name is None:
+                break
+            yield name
+    finally:
+        stopping.set()
+        thread.join()
+
+
+def time_step(name, function):
+    logger.info("Starting step: %s", name)
+    start = datetime.now()
+    function()
+    elapsed = datetime.now() - start
+    logger.info("Elapsed time for step %s: %s seconds", name, elapsed.seconds)
+
+
+def copy_rows_to_table(table_name, fieldnames, rows):
+    """Load `rows`, an iterable of dicts, into the given columns of the given
+    table with COPY.
+
+    The rows are streamed through a temporary CSV file rather than held in
+    memory.  Keys not in `fieldnames` are ignored, and missing keys are
+    loaded as NULL.
+    """
+    with tempfile.TemporaryFile(mode="r+") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        for row in rows:
+            writer.writerow({fn: value_for_copy(row.get(fn)) for fn in fieldnames})
+        f.seek(0)
+        copy_str = "COPY {}({}) FROM STDIN WITH (FORMAT CSV)".format(
+            table_name, ", ".join(fieldnames)
+        )
+        with connection.cursor() as cursor:
+            cursor.copy_expert(copy_str, f)
+
+
+def upsert_rows_into_table(table_name, key_fieldnames, fieldnames, rows):
+    """Insert `rows`, an iterable of dicts, into the given columns of the given
+    table, updating any existing rows with the same values for
+    `key_fieldnames`.
+
+    The rows are loaded into a temporary staging table with COPY (see
+    `copy_rows_to_table`) and upserted from there in a single statement.  This
+    all happens in a transaction, so that the staging table doesn't outlive a
+    failure.
+    """
+    staging_table_name = "staging_{}".format(table_name)
+    columns = ", ".join(fieldnames)
+    updates = ", ".join(
+        "{0} = EXCLUDED.{0}".format(fn) for fn in fieldnames if fn not in key_fieldnames
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE {} AS SELECT {} FROM {} WITH NO DATA".format(
+                staging_table_name, columns, table_name
+            )
+        )
+        copy_rows_to_table(staging_table_name, fieldnames, rows)
+        cursor.execute(
+            """
+            INSERT INTO {table_name} ({columns})
+            SELECT {columns} FROM {staging_table_name}
+            ON CONFLICT ({keys}) DO UPDATE SET {updates}
+            """.format(
+                table_name=table_name,
+                columns=columns,
+                staging_table_name=staging_table_name,
+                keys=", ".join(key_fieldnames),
+                updates=updates,
+            )
+        )
+        cursor.execute("DROP TABLE {}".format(staging_table_name))
+
+
+def value_for_copy(value):
+    """Convert a value to the form in which it should be written to CSV for
+    COPY."""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, float) and not numpy.isfinite(value):
+        # Python writes these as "inf" and "nan", which older versions of
+        # Postgres don't understand
+        if numpy.isnan(value):
+            return "NaN"
+        return "Infinity" if value > 0 else "-Infinity"
+    return value
+
+
 @contextmanager
 def conditional_constraint_and_index_reconstructor(enabled):
     if not enabled:
@@ -729,6 +729,15 @@ class MeasureGlobal(models.Model):
     cost_savings = JSONField(null=True, blank=True)
 
     def save(self, *args, **kwargs):
+        self.update_calc_value()
+        super(MeasureGlobal, self).save(*args, **kwargs)
+
+    def update_calc_value(self):
+        """Set calc_value from the numerator and denominator.
+
+        This is called when saving, and by import_measures, which loads
+        MeasureGlobals without saving them individually.
+        """
         if self.denominator is not None:
             self.denominator = float(self.denominator)
         if self.numerator is not None:
@@ -740,7 +749,6 @@ class MeasureGlobal(models.Model):
                 self.calc_value = self.numerator
         else:
             self.value = None
-        super(MeasureGlobal, self).save(*args, **kwargs)
 
     class Meta:
         unique_together = (("measure", "month"),)
@@ -2,7 +2,6 @@ import numpy
 
 from frontend.models import Presentation
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix
 
 from .substitution_sets import get_substitution_sets
 
@@ -34,26 +33,10 @@ def get_prescribing(generic_code, date):
         return {}
     date_slice = slice(date_column, date_column + 1)
 
-    results = db.query(
-        """
-        SELECT
-          bnf_code, quantity, net_cost
-        FROM
-          presentation
-        WHERE
-          bnf_code IN ({})
-        """.format(
-            ",".join("?" * len(bnf_codes))
-        ),
-        bnf_codes,
+    results = db.query_presentations(
+        bnf_codes, ["quantity", "net_cost"], cols=date_slice
     )
-    return {
-        bnf_code: (
-            get_submatrix(quantity, cols=date_slice),
-            get_submatrix(net_cost, cols=date_slice),
-        )
-        for bnf_code, quantity, net_cost in results
-    }
+    return {bnf_code: (quantity, net_cost) for bnf_code, quantity, net_cost in results}
 
 
 def get_ppu_breakdown(prescribing, org_type, org_id):
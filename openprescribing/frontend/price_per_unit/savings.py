@@ -1,9 +1,11 @@
+from collections import defaultdict
+import hashlib
+
 import numpy
 
 from matrixstore.cachelib import memoize
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix, zeros_like
-from matrixstore.sql_functions import MatrixSum
+from matrixstore.matrix_ops import nanpercentile_by_column
 
 from .substitution_sets import get_substitution_sets
 
@@ -26,19 +28,67 @@ CONFIG_MIN_SAVINGS_FOR_ORG_TYPE = {
     # based on the CCG limit
     "all_standard_practices": 50000 * 100,
 }
+# Number of substitution sets handled together by `get_savings_for_org_type`.
+# Larger blocks mean fewer numpy operations at the cost of more memory.
+SUBSTITUTION_SETS_PER_BLOCK = 100
 
 
 def get_all_savings_for_orgs(date, org_type, org_ids):
     """
     Get all available savings through presentation switches for the given orgs
     """
-    min_saving = CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type]
-    results = []
-    for generic_code in get_substitution_sets().keys():
-        savings = get_savings_for_orgs(
-            generic_code, date, org_type, org_ids, min_saving=min_saving
+    substitution_sets = get_substitution_sets()
+    if not substitution_sets:
+        return []
+    group_by_org = get_row_grouper(org_type)
+    savings = get_savings_for_org_type(
+        db=get_db(),
+        substitution_sets=substitution_sets,
+        date=date,
+        group_by_org=group_by_org,
+        min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
+        practice_group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
+        target_centile=CONFIG_TARGET_CENTILE,
+    )
+    # Select the savings for just the orgs we want, ordered by substitution set
+    # and then by the position of the org in `org_ids`
+    positions = numpy.full(len(group_by_org.ids), -1)
+    for position, org_id in enumerate(org_ids):
+        positions[group_by_org.offsets[org_id]] = position
+    org_positions = positions[savings["org_offset"]]
+    selected = numpy.nonzero(org_positions != -1)[0]
+    order = numpy.lexsort((org_positions[selected], savings["set_index"][selected]))
+    selected = selected[order]
+    substitution_sets = list(substitution_sets.values())
+    set_indices = savings["set_index"][selected]
+    results = [
+        {
+            "date": date,
+            "org_id": org_ids[position],
+            "price_per_unit": net_cost / quantity / 100,
+            "possible_savings": possible_saving / 100,
+            "quantity": quantity,
+            "lowest_decile": target_ppu / 100,
+            "presentation": substitution_sets[set_index].id,
+            "formulation_swap": substitution_sets[set_index].formulation_swaps,
+            "name": substitution_sets[set_index].name,
+        }
+        for (
+            set_index,
+            position,
+            quantity,
+            net_cost,
+            possible_saving,
+            target_ppu,
+        ) in zip(
+            set_indices.tolist(),
+            org_positions[selected].tolist(),
+            savings["quantity"][selected].tolist(),
+            savings["net_cost"][selected].tolist(),
+            savings["possible_savings"][selected].tolist(),
+            savings["target_ppu"][set_indices].tolist(),
         )
-        results.extend(savings)
+    ]
     results.sort(key=lambda i: i["possible_savings"], reverse=True)
     return results
 
@@ -55,9 +105,18 @@ def get_savings_for_orgs(generic_code, date, org_type, org_ids, min_saving=1):
     except KeyError:
         return []
 
-    quantities, net_costs = get_quantities_and_net_costs_at_date(
-        get_db(), substitution_set, date
+    db = get_db()
+    practice_group_by_org = get_row_grouper(CONFIG_TARGET_PEER_GROUP)
+    precalculated = get_precalculated_savings_for_sets(
+        db, [substitution_set], date, practice_group_by_org, CONFIG_TARGET_CENTILE
     )
+    if precalculated:
+        quantities, net_costs, target_ppu, practice_savings = precalculated[0]
+    else:
+        quantities, net_costs = get_quantities_and_net_costs_at_date(
+            db, substitution_set, date
+        )
+        target_ppu = None
 
     group_by_org = get_row_grouper(org_type)
     quantities_for_orgs = group_by_org.sum(quantities, org_ids)
@@ -67,13 +126,14 @@ def get_savings_for_orgs(generic_code, date, org_type, org_ids, min_saving=1):
     net_costs_for_orgs = group_by_org.sum(net_costs, org_ids)
     ppu_for_orgs = net_costs_for_orgs / quantities_for_orgs
 
-    target_ppu = get_target_ppu(
-        quantities,
-        net_costs,
-        group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
-        target_centile=CONFIG_TARGET_CENTILE,
-    )
-    practice_savings = get_savings(quantities, net_costs, target_ppu)
+    if target_ppu is None:
+        target_ppu = get_target_ppu(
+            quantities,
+            net_costs,
+            group_by_org=practice_group_by_org,
+            target_centile=CONFIG_TARGET_CENTILE,
+        )
+        practice_savings = get_savings(quantities, net_costs, target_ppu)
 
     savings_for_orgs = group_by_org.sum(practice_savings, org_ids)
 
@@ -101,14 +161,27 @@ def get_total_savings_for_org(date, org_type, org_id):
     """
     Get total available savings through presentation switches for the given org
     """
-    group_by_org = get_row_grouper(org_type)
-    substitution_sets = get_substitution_sets()
+    totals = get_total_savings_for_all_orgs(date, org_type)
     # This only happens during testing where a test case might not have enough
     # different presentations to generate any substitutions. If this is the
     # case then their are, obviously, zero savings available.
-    if not substitution_sets:
+    if totals is None:
         return 0.0
-    totals = get_total_savings_for_org_type(
+    offset = get_row_grouper(org_type).offsets[org_id]
+    return totals[offset, 0] / 100
+
+
+def get_total_savings_for_all_orgs(date, org_type):
+    """
+    Return a matrix giving total savings for all orgs of the given type (with
+    rows in the order given by `get_row_grouper(org_type)`) or None if there
+    are no substitution sets
+    """
+    substitution_sets = get_substitution_sets()
+    if not substitution_sets:
+        return None
+    group_by_org = get_row_grouper(org_type)
+    savings = get_savings_for_org_type(
         db=get_db(),
         substitution_sets=substitution_sets,
         date=date,
@@ -117,14 +190,18 @@ def get_total_savings_for_org(date, org_type, org_id):
         practice_group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
         target_centile=CONFIG_TARGET_CENTILE,
     )
-    offset = group_by_org.offsets[org_id]
-    return totals[offset, 0] / 100
+    totals = numpy.bincount(
+        savings["org_offset"],
+        weights=savings["possible_savings"],
+        minlength=len(group_by_org.ids),
+    )
+    return totals.reshape((-1, 1))
 
 
 # Increment the version number if the logic of this function changes such that
 # the same inputs no longer produce the same outputs
 @memoize(version=1)
-def get_total_savings_for_org_type(
+def get_savings_for_org_type(
     db,
     substitution_sets,
     date,
@@ -134,21 +211,71 @@ def get_total_savings_for_org_type(
     target_centile,
 ):
     """
-    Return a matrix giving total savings for all orgs of a given type
+    Return all savings of at least `min_saving` for every substitution set and
+    every org of a given type, as a dict of arrays:
+
+        set_index: offset of the substitution set in `substitution_sets`
+        org_offset: offset of the org in `group_by_org`
+        quantity: total quantity prescribed by the org
+        net_cost: total net cost for the org
+        possible_savings: savings available to the org
+        target_ppu: target price-per-unit for each substitution set (indexed
+            by `set_index`, rather than having one value per saving)
+
+    Savings are ordered by substitution set and then by org.
 
-    This duplicates some of the logic in `get_savings_for_orgs` but it gives us
-    much better caching behaviour to calculate savings for all orgs of a given
-    type together in a single, cacheable matrix than it does to do them one by
-    one.
+    This duplicates the logic in `get_savings_for_orgs` but calculates savings
+    for many substitution sets at once, treating each set as a column of a
+    single matrix, which is much faster than handling them one by one. It also
+    gives us much better caching behaviour to calculate savings for all orgs of
+    a given type together.
 
     Because we want this function to be cacheable it needs to touch no global
     state or configuration and have eveything passed into it, hence the
     slightly convoluted call signature.
     """
-    totals = None
-    for substitution_set in substitution_sets.values():
-        quantities, net_costs = get_quantities_and_net_costs_at_date(
-            db, substitution_set, date
+    substitution_sets = list(substitution_sets.values())
+    results = defaultdict(list)
+    for start in range(0, len(substitution_sets), SUBSTITUTION_SETS_PER_BLOCK):
+        block = substitution_sets[start : start + SUBSTITUTION_SETS_PER_BLOCK]
+        quantities, net_costs, target_ppu, practice_savings = get_savings_for_sets(
+            db, block, date, practice_group_by_org, target_centile
+        )
+        savings_for_orgs = group_by_org.sum(practice_savings)
+        # We transpose so that savings are found in order of substitution set
+        set_indices, org_offsets = numpy.nonzero(savings_for_orgs.T >= min_saving)
+        index = (org_offsets, set_indices)
+        results["set_index"].append(set_indices + start)
+        results["org_offset"].append(org_offsets)
+        results["quantity"].append(group_by_org.sum(quantities)[index])
+        results["net_cost"].append(group_by_org.sum(net_costs)[index])
+        results["possible_savings"].append(savings_for_orgs[index])
+        results["target_ppu"].append(target_ppu)
+    return {key: numpy.concatenate(arrays) for key, arrays in results.items()}
+
+
+def get_savings_for_sets(
+    db, substitution_sets, date, practice_group_by_org, target_centile
+):
+    """
+    Return a tuple of:
+
+        quantities, net_costs, target_ppu, practice_savings
+
+    for the specified date, where `target_ppu` is an array with an element for
+    each of the supplied substitution sets and the others are matrices with a
+    row for each practice and a column for each substitution set
+
+    Precalculated savings are used where available and the rest are calculated
+    here.
+    """
+    precalculated = get_precalculated_savings_for_sets(
+        db, substitution_sets, date, practice_group_by_org, target_centile
+    )
+    remaining = [n for n in range(len(substitution_sets)) if n not in precalculated]
+    if remaining:
+        quantities, net_costs = get_quantities_and_net_costs_for_sets(
+            db, [substitution_sets[n] for n in remaining], date
         )
         target_ppu = get_target_ppu(
             quantities,
@@ -157,13 +284,116 @@ def get_total_savings_for_org_type(
             target_centile=target_centile,
         )
         practice_savings = get_savings(quantities, net_costs, target_ppu)
-        savings_for_orgs = group_by_org.sum(practice_savings)
-        savings_above_threshold = savings_for_orgs >= min_saving
-        if totals is None:
-            totals = zeros_like(savings_for_orgs)
-        numpy.add(totals, savings_for_orgs, out=totals, where=savings_above_threshold)
-    assert totals is not None
-    return totals
+        if not precalculated:
+            return quantities, net_costs, target_ppu, practice_savings
+    # Combine the precalculated values with any we've just calculated
+    shape = (len(db.practice_offsets), len(substitution_sets))
+    results = [
+        numpy.zeros(shape, order="F"),
+        numpy.zeros(shape, order="F"),
+        numpy.zeros(len(substitution_sets)),
+        numpy.zeros(shape, order="F"),
+    ]
+    if remaining:
+        calculated = [quantities, net_costs, target_ppu, practice_savings]
+        for result, values in zip(results, calculated):
+            result[..., remaining] = values
+    for n, values in precalculated.items():
+        for result, value in zip(results, values):
+            # Each precalculated value has just a single column
+            result[..., n] = value[..., 0]
+    return tuple(results)
+
+
+def get_precalculated_savings_for_sets(
+    db, substitution_sets, date, practice_group_by_org, target_centile
+):
+    """
+    Return a dict mapping the offset of each of the supplied substitution sets
+    for which we have precalculated savings (see
+    `matrixstore.build.precalculate_savings`) to a tuple of:
+
+        quantities, net_costs, target_ppu, practice_savings
+
+    for the specified date. Values precalculated with different inputs (e.g.
+    because the configuration has changed since the file was built) are
+    ignored.
+    """
+    if not db.has_table("ppu_savings"):
+        return {}
+    offsets = {
+        get_savings_key(substitution_set, practice_group_by_org, target_centile): n
+        for n, substitution_set in enumerate(substitution_sets)
+    }
+    date_column = db.date_offsets[date]
+    results = db.query(
+        """
+        SELECT
+          savings_key,
+          MATRIX_SUM_COLS(quantity, ?, ?),
+          MATRIX_SUM_COLS(net_cost, ?, ?),
+          MATRIX_SUM_COLS(target_ppu, ?, ?),
+          MATRIX_SUM_COLS(savings, ?, ?)
+        FROM
+          ppu_savings
+        WHERE
+          savings_key IN ({})
+        """.format(
+            ",".join(["?"] * len(offsets))
+        ),
+        [date_column, date_column + 1] * 4 + list(offsets),
+    )
+    return {
+        offsets[key]: (quantities, net_costs, target_ppu[0], practice_savings)
+        for key, quantities, net_costs, target_ppu, practice_savings in results
+    }
+
+
+def get_savings_key(substitution_set, practice_group_by_org, target_centile):
+    """
+    Return a string identifying all the inputs, other than the prescribing
+    data itself, used in calculating savings for a substitution set
+    """
+    hashobj = hashlib.md5(substitution_set.cache_key)
+    hashobj.update(practice_group_by_org.cache_key)
+    hashobj.update(str(target_centile).encode("utf8"))
+    return hashobj.hexdigest()
+
+
+def get_quantities_and_net_costs_for_sets(db, substitution_sets, date):
+    """
+    Return quantity and net cost matrices for just the specified date, with a
+    row for each practice and a column for each of the supplied substitution
+    sets giving the totals over all the presentations in that set
+    """
+    shape = (len(db.practice_offsets), len(substitution_sets))
+    quantities = numpy.zeros(shape, order="F")
+    net_costs = numpy.zeros(shape, order="F")
+    set_indices = defaultdict(list)
+    for set_index, substitution_set in enumerate(substitution_sets):
+        for bnf_code in substitution_set.presentations:
+            set_indices[bnf_code].append(set_index)
+    date_column = db.date_offsets[date]
+    results = db.query(
+        """
+        SELECT
+          bnf_code,
+          MATRIX_SUM_COLS(quantity, ?, ?),
+          MATRIX_SUM_COLS(net_cost, ?, ?)
+        FROM
+          presentation
+        WHERE
+          bnf_code IN ({})
+        """.format(
+            ",".join(["?"] * len(set_indices))
+        ),
+        [date_column, date_column + 1] * 2 + list(set_indices),
+    )
+    for bnf_code, quantity, net_cost in results:
+        for set_index in set_indices[bnf_code]:
+            quantities[:, set_index] += quantity[:, 0]
+            net_costs[:, set_index] += net_cost[:, 0]
+    return quantities, net_costs
 
 
 def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
@@ -174,7 +404,7 @@ def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
     quantities = group_by_org.sum(quantities)
     net_costs = group_by_org.sum(net_costs)
     ppu = net_costs / quantities
-    target_ppu = numpy.nanpercentile(ppu, axis=0, q=target_centile)
+    target_ppu = nanpercentile_by_column(ppu, q=target_centile)
     return target_ppu
 
 
@@ -201,25 +431,25 @@ def get_quantities_and_net_costs_at_date(db, substitution_set, date):
     """
     bnf_codes = substitution_set.presentations
     date_column = db.date_offsets[date]
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
+    cols = [date_column, date_column + 1]
+    # Selecting the column and summing inside SQLite means we never build the
+    # full matrices in Python, only the single-column totals
+    (totals,) = db.query_one(
         """
         SELECT
-          quantity, net_cost
+          MATRIX_SUM_MANY(
+            MATRIX_SUM_COLS(quantity, ?, ?),
+            MATRIX_SUM_COLS(net_cost, ?, ?)
+          )
         FROM
           presentation
         WHERE
           bnf_code IN ({})
         """.format(
-            ",".join("?" * len(bnf_codes))
+            ",".join(["?"] * len(bnf_codes))
         ),
-        bnf_codes,
+        cols + cols + list(bnf_codes),
     )
-
-    quantity_sum = MatrixSum()
-    net_cost_sum = MatrixSum()
-    for quantity, net_cost in results:
-        quantity_sum.add(get_submatrix(quantity, cols=date_slice))
-        net_cost_sum.add(get_submatrix(net_cost, cols=date_slice))
-    return quantity_sum.value(), net_cost_sum.value()
+    if totals is None:
+        raise ValueError("No values added")
+    return totals
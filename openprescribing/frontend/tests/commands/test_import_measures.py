@@ -1,11 +1,13 @@
 from __future__ import print_function
 
 import csv
+from functools import partial
 import itertools
 import json
 import os
 import re
 import tempfile
+import threading
 from mock import patch
 from random import Random
 from urllib.parse import parse_qs
@@ -32,9 +34,19 @@ from frontend.models import (
     RegionalTeam,
 )
 from frontend.management.commands.import_measures import (
+    MEASURE_FIELDNAMES,
+    MeasureCalculation,
+    copy_rows_to_table,
     load_measure_defs,
     build_bnf_codes_query,
+    build_bnf_codes_regex,
+    can_use_matrixstore,
+    percent_rank_by_column,
+    run_steps,
+    run_steps_in_background,
+    upsert_rows_into_table,
 )
+from frontend.tests.data_factory import DataFactory as FrontendDataFactory
 from gcutils.bigquery import Client
 from matrixstore.tests.contextmanagers import (
     patched_global_matrixstore_from_data_factory,
@@ -50,6 +62,8 @@ from matrixstore.tests.data_factory import DataFactory
 
 
 class ImportMeasuresTests(TestCase):
+    import_measures_options = {}
+
     @classmethod
     def setUpTestData(cls):
         random = Random()
@@ -60,8 +74,13 @@ class ImportMeasuresTests(TestCase):
         create_organisations(random)
         upload_ccgs_and_practices()
         upload_presentations()
-        cls.prescriptions = upload_prescribing(random.randint)
-        cls.practice_stats = upload_practice_statistics(random.randint)
+        prescribing_rows = generate_prescribing(random.randint)
+        upload_prescribing(prescribing_rows)
+        cls.prescriptions = build_prescriptions_dataframe(prescribing_rows)
+        practice_statistics_rows, cls.practice_stats = generate_practice_statistics(
+            random.randint
+        )
+        upload_practice_statistics(practice_statistics_rows)
         cls.factory = build_factory()
         create_old_measure_value()
 
@@ -74,7 +93,9 @@ class ImportMeasuresTests(TestCase):
 
         # Do the work.
         with patched_global_matrixstore_from_data_factory(self.factory):
-            call_command("import_measures", measure="desogestrel")
+            call_command(
+                "import_measures", measure="desogestrel", **self.import_measures_options
+            )
 
         # Check that old MeasureValue and MeasureGlobal objects have been deleted.
         self.assertFalse(MeasureValue.objects.filter(month__lt="2011-01-01").exists())
@@ -127,7 +148,9 @@ class ImportMeasuresTests(TestCase):
 
         # Do the work.
         with patched_global_matrixstore_from_data_factory(self.factory):
-            call_command("import_measures", measure="coproxamol")
+            call_command(
+                "import_measures", measure="coproxamol", **self.import_measures_options
+            )
 
         # Check that numerator_bnf_codes has, and denominator_bnf_codes has not, been
         # set.
@@ -165,7 +188,9 @@ class ImportMeasuresTests(TestCase):
 
         # Do the work.
         with patched_global_matrixstore_from_data_factory(self.factory):
-            call_command("import_measures", measure="glutenfree")
+            call_command(
+                "import_measures", measure="glutenfree", **self.import_measures_options
+            )
 
         # Check calculations by redoing calculations with Pandas, and asserting
         # that results match.
@@ -378,6 +403,254 @@ class ImportMeasuresTests(TestCase):
             self.assertAlmostEqual(mv.cost_savings["10"], series["cost_saving_10"])
 
 
+class ImportMeasuresMatrixStoreTests(ImportMeasuresTests):
+    """Runs the same tests as above, but calculating the measures from the
+    MatrixStore rather than in BigQuery."""
+
+    import_measures_options = {"use_matrixstore": True}
+
+    @classmethod
+    def setUpTestData(cls):
+        random = Random()
+        random.seed(1980)
+
+        create_import_log()
+        create_organisations(random)
+        prescribing_rows = generate_prescribing(random.randint)
+        cls.prescriptions = build_prescriptions_dataframe(prescribing_rows)
+        _, cls.practice_stats = generate_practice_statistics(random.randint)
+        cls.factory = build_factory_with_prescribing(
+            prescribing_rows, cls.practice_stats
+        )
+        create_old_measure_value(use_matrixstore=True)
+
+
+class ImportMeasuresParallelTests(ImportMeasuresTests):
+    """Runs the same tests as above, but running the BigQuery jobs for several
+    steps at once."""
+
+    import_measures_options = {"parallel": 3}
+
+
+class ImportMeasuresParallelFailureTests(TestCase):
+    def test_measure_definitions_are_unchanged_when_a_step_fails(self):
+        create_import_log()
+
+        def fail():
+            raise RuntimeError("Step failed")
+
+        with patched_global_matrixstore_from_data_factory(build_factory()), patch(
+            "frontend.management.commands.import_measures.get_bnf_codes",
+            return_value=["0703021Q0BBAAAA"],
+        ), patch.object(
+            MeasureCalculation, "get_steps", return_value={"practice": (fail, [])}
+        ):
+            with self.assertRaisesRegex(RuntimeError, "Step failed"):
+                call_command("import_measures", measure="desogestrel", parallel=2)
+
+        self.assertFalse(Measure.objects.filter(id="desogestrel").exists())
+
+
+class RunStepsTests(TestCase):
+    def test_steps_run_after_their_dependencies(self):
+        started = []
+        lock = threading.Lock()
+
+        def step(name):
+            with lock:
+                started.append(name)
+
+        steps = {
+            "a": (partial(step, "a"), []),
+            "b": (partial(step, "b"), ["a"]),
+            "c": (partial(step, "c"), ["a"]),
+            "d": (partial(step, "d"), ["b", "c"]),
+        }
+        finished = list(run_steps(steps, 2))
+
+        self.assertEqual(sorted(finished), ["a", "b", "c", "d"])
+        for name, (_, dependencies) in steps.items():
+            for dependency in dependencies:
+                self.assertLess(finished.index(dependency), started.index(name))
+
+    def test_no_more_steps_run_after_failure(self):
+        started = []
+
+        def step(name):
+            started.append(name)
+            if name == "a":
+                raise RuntimeError("Step a failed")
+
+        steps = {
+            "a": (partial(step, "a"), []),
+            "b": (partial(step, "b"), ["a"]),
+        }
+        with self.assertRaisesRegex(RuntimeError, "Step a failed"):
+            list(run_steps(steps, 2))
+        self.assertEqual(started, ["a"])
+
+    def test_unsatisfiable_dependencies(self):
+        steps = {"a": (lambda: None, ["b"])}
+        with self.assertRaises(ValueError):
+            list(run_steps(steps, 2))
+
+
+class RunStepsInBackgroundTests(TestCase):
+    def test_steps_start_while_caller_handles_finished_steps(self):
+        b_started = threading.Event()
+        steps = {
+            "a": (lambda: None, []),
+            "b": (b_started.set, ["a"]),
+        }
+        finished = []
+        for name in run_steps_in_background(steps, 2):
+            if name == "a":
+                # With `run_steps`, b can't start until we ask for the next
+                # finished step
+                self.assertTrue(b_started.wait(timeout=10))
+            finished.append(name)
+        self.assertEqual(finished, ["a", "b"])
+
+    def test_step_failure_is_raised(self):
+        def fail():
+            raise RuntimeError("Step a failed")
+
+        steps = {"a": (fail, [])}
+        with self.assertRaisesRegex(RuntimeError, "Step a failed"):
+            list(run_steps_in_background(steps, 2))
+
+    def test_no_more_steps_run_after_caller_stops(self):
+        started = []
+        b_started = threading.Event()
+        b_released = threading.Event()
+
+        def b():
+            started.append("b")
+            b_started.set()
+            b_released.wait(timeout=10)
+
+        steps = {
+            "a": (partial(started.append, "a"), []),
+            "b": (b, ["a"]),
+            "c": (partial(started.append, "c"), ["b"]),
+        }
+        with self.assertRaisesRegex(RuntimeError, "Write failed"):
+            for name in run_steps_in_background(steps, 2):
+                self.assertTrue(b_started.wait(timeout=10))
+                # Let b finish once we've stopped iterating
+                threading.Timer(0.5, b_released.set).start()
+                raise RuntimeError("Write failed")
+        self.assertEqual(started, ["a", "b"])
+
+
+class GetStepsTests(TestCase):
+    def test_steps_depend_on_the_steps_which_write_the_tables_they_read(self):
+        for is_cost_based, is_percentage in itertools.product([True, False], repeat=2):
+            measure = Measure(
+                id="x",
+                numerator_columns="SUM(quantity) AS numerator",
+                denominator_columns="SUM(quantity) AS denominator",
+                is_cost_based=is_cost_based,
+                is_percentage=is_percentage,
+            )
+            calculation = MeasureCalculation(measure)
+            steps = calculation.get_steps()
+
+            # Run each step with the queries replaced by recording which
+            # tables each one reads from and writes to
+            tables_read = {}
+            tables_written = {}
+
+            def insert_rows_from_query(query_id, table_name, ctx, dry_run=False):
+                path = os.path.join(calculation.fpath, "measure_sql", query_id + ".sql")
+                with open(path) as f:
+                    sql = f.read()
+                tables_read[step_name].update(
+                    re.findall(r"\{measures\}\.(\w+)_\{measure_id\}", sql)
+                )
+                tables_written[step_name].add(table_name[: -len("_x")])
+
+            with patch.object(
+                calculation, "insert_rows_from_query", insert_rows_from_query
+            ):
+                for step_name, (function, _) in steps.items():
+                    tables_read[step_name] = set()
+                    tables_written[step_name] = set()
+                    function()
+
+            for step_name in steps:
+                ancestors = set()
+                to_visit = [step_name]
+                while to_visit:
+                    for dependency in steps[to_visit.pop()][1]:
+                        if dependency not in ancestors:
+                            ancestors.add(dependency)
+                            to_visit.append(dependency)
+                for table in tables_read[step_name] - tables_written[step_name]:
+                    writers = {name for name in steps if table in tables_written[name]}
+                    self.assertTrue(
+                        writers & ancestors,
+                        "{} reads {}, which is written by {}".format(
+                            step_name, table, sorted(writers)
+                        ),
+                    )
+
+
+class WriteToDatabaseTests(TestCase):
+    def setUp(self):
+        self.measure = FrontendDataFactory().create_measure()
+
+    def test_copy_rows_to_table(self):
+        rows = [
+            {
+                "measure_id": self.measure.id,
+                "month": "2018-08-01",
+                "numerator": 1.0,
+                "denominator": 0.0,
+                "calc_value": float("inf"),
+                "cost_savings": {"10": 1.5},
+                # Keys which aren't columns are ignored
+                "cost_savings_10": 1.5,
+            },
+            {"measure_id": self.measure.id, "month": "2018-09-01"},
+        ]
+        copy_rows_to_table("frontend_measurevalue", MEASURE_FIELDNAMES, iter(rows))
+
+        mv1, mv2 = MeasureValue.objects.order_by("month")
+        self.assertEqual(mv1.calc_value, float("inf"))
+        self.assertEqual(mv1.cost_savings, {"10": 1.5})
+        self.assertIsNone(mv2.numerator)
+        self.assertIsNone(mv2.cost_savings)
+
+    def test_upsert_rows_into_table(self):
+        self.measure.measureglobal_set.create(
+            month="2018-08-01", numerator=1.0, denominator=2.0, percentiles={}
+        )
+        rows = [
+            {
+                "measure_id": self.measure.id,
+                "month": "2018-08-01",
+                "numerator": 3.0,
+                "denominator": 4.0,
+                "percentiles": {"practice": {"10": 0.5}},
+            },
+            {"measure_id": self.measure.id, "month": "2018-09-01", "numerator": 5.0},
+        ]
+        upsert_rows_into_table(
+            "frontend_measureglobal",
+            ["measure_id", "month"],
+            ["measure_id", "month", "numerator", "denominator", "percentiles"],
+            iter(rows),
+        )
+
+        mg1, mg2 = MeasureGlobal.objects.order_by("month")
+        self.assertEqual(mg1.numerator, 3.0)
+        self.assertEqual(mg1.denominator, 4.0)
+        self.assertEqual(mg1.percentiles, {"practice": {"10": 0.5}})
+        self.assertEqual(mg2.numerator, 5.0)
+        self.assertIsNone(mg2.denominator)
+
+
 class BuildMeasureSQLTests(TestCase):
     def test_build_bnf_codes_query(self):
         base_query = "SELECT bnf_code FROM {hscic}.presentation WHERE name LIKE '% Tab'"
@@ -448,6 +721,68 @@ class BuildMeasureSQLTests(TestCase):
         self.assertEqual(build_bnf_codes_query(base_query, None), base_query)
 
 
+class BuildBNFCodesRegexTests(TestCase):
+    def test_build_bnf_codes_regex(self):
+        cases = [
+            # A full drug code only matches itself
+            ("010101000BBABA0", "010101000BBABA0", True),
+            ("010101000BBABA0", "010101000BBABA1", False),
+            # A partial code matches as a prefix
+            ("010101", "010101000BBABA0", True),
+            ("010101", "010102000BBABA0", False),
+            # A full appliance code only matches itself
+            ("21220000023", "21220000023", True),
+            ("21220000023", "212200000230000", False),
+            # LIKE wildcards are honoured
+            ("0302000N0%AV", "0302000N0AAAVAV", True),
+            ("0302000N0%AV", "0302000N0AAAVAA", False),
+            ("0302000N0_AV", "0302000N0AAAVAV", False),
+        ]
+        for element, bnf_code, expected in cases:
+            with self.subTest(element=element, bnf_code=bnf_code):
+                regex = build_bnf_codes_regex(element)
+                self.assertEqual(bool(regex.fullmatch(bnf_code)), expected)
+
+
+class MatrixStoreCalculationTests(TestCase):
+    def test_can_use_matrixstore(self):
+        measure_defs = {m["id"]: m for m in load_measure_defs()}
+        desogestrel = measure_defs["desogestrel"]
+        coproxamol = measure_defs["coproxamol"]
+        self.assertTrue(can_use_matrixstore(desogestrel))
+        self.assertTrue(can_use_matrixstore(coproxamol))
+        self.assertTrue(can_use_matrixstore(measure_defs["glutenfree"]))
+        for measure_def in [
+            dict(desogestrel, denominator_type="custom"),
+            dict(desogestrel, numerator_bnf_codes_query="SELECT bnf_code FROM x"),
+            dict(desogestrel, numerator_bnf_codes_filter=None),
+            dict(coproxamol, is_cost_based=True, is_percentage=True),
+            # Its practice-level table is read by the lpzomnibus measure
+            dict(coproxamol, id="lpcoprox"),
+        ]:
+            with self.subTest(measure_def=measure_def):
+                self.assertFalse(can_use_matrixstore(measure_def))
+
+    def test_percent_rank_by_column(self):
+        matrix = np.array(
+            [
+                [1.0, 5.0, np.nan],
+                [3.0, 5.0, np.nan],
+                [2.0, np.nan, np.nan],
+                [np.nan, 1.0, 4.0],
+            ]
+        )
+        expected = np.array(
+            [
+                [0.0, 0.5, np.nan],
+                [1.0, 0.5, np.nan],
+                [0.5, np.nan, np.nan],
+                [np.nan, 0.0, 0.0],
+            ]
+        )
+        np.testing.assert_array_equal(percent_rank_by_column(matrix), expected)
+
+
 class ImportMeasuresDefinitionsOnlyTests(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -487,6 +822,38 @@ class CheckMeasureDefinitionsTests(TestCase):
         with patched_global_matrixstore_from_data_factory(build_factory()):
             call_command("import_measures", measure="desogestrel", check=True)
 
+    @patch("frontend.management.commands.import_measures.get_practice_values")
+    def test_check_definition_with_matrixstore(self, get_practice_values):
+        factory = DataFactory()
+        months = factory.create_months("2018-07-01", 2)
+        practice = factory.create_practice()
+        for bnf_code in ["0703021Q0AAAAAA", "0703021Q0BBAAAA", "0407010Q0AAAAAA"]:
+            presentation = factory.create_presentation(bnf_code)
+            factory.create_prescription(presentation, practice, months[-1])
+        factory.create_statistics_for_one_practice_and_month(practice, months[-1])
+
+        with patched_global_matrixstore_from_data_factory(factory):
+            call_command(
+                "import_measures",
+                measure="desogestrel,coproxamol",
+                check=True,
+                use_matrixstore=True,
+            )
+        # Nothing is calculated
+        get_practice_values.assert_not_called()
+
+    def test_check_definition_with_matrixstore_missing_month(self):
+        # This only has data for 2018-10, which is after the latest month
+        with patched_global_matrixstore_from_data_factory(build_factory()):
+            with self.assertRaises(BadRequest) as command_error:
+                call_command(
+                    "import_measures",
+                    measure="desogestrel",
+                    check=True,
+                    use_matrixstore=True,
+                )
+        self.assertIn("MatrixStore error", str(command_error.exception))
+
     @override_settings(
         MEASURE_DEFINITIONS_PATH=os.path.join(
             settings.MEASURE_DEFINITIONS_PATH, "bad", "json"
@@ -653,11 +1020,16 @@ def create_import_log():
     ImportLog.objects.create(category="prescribing", current_at="2018-08-01")
 
 
-def create_old_measure_value():
+def create_old_measure_value(use_matrixstore=False):
     """Create MeasureValue and MeasureGlobal that are to be deleted because they are
     more than five years old."""
     with patched_global_matrixstore_from_data_factory(build_factory()):
-        call_command("import_measures", definitions_only=True, measure="desogestrel")
+        call_command(
+            "import_measures",
+            definitions_only=True,
+            measure="desogestrel",
+            use_matrixstore=use_matrixstore,
+        )
     m = Measure.objects.get(id="desogestrel")
     m.measurevalue_set.create(month="2010-01-01")
     m.measureglobal_set.create(month="2010-01-01")
@@ -742,8 +1114,25 @@ def upload_presentations():
         table.insert_rows_from_csv(f.name, schemas.PRESENTATION_SCHEMA)
 
 
-def upload_prescribing(randint):
-    """Generate prescribing data, and upload to BQ."""
+PRESCRIBING_HEADERS = [
+    "sha",
+    "regional_team_id",
+    "stp_id",
+    "ccg_id",
+    "pcn_id",
+    "practice_id",
+    "bnf_code",
+    "bnf_name",
+    "items",
+    "net_cost",
+    "actual_cost",
+    "quantity",
+    "month",
+]
+
+
+def generate_prescribing(randint):
+    """Generate prescribing data."""
 
     prescribing_rows = []
 
@@ -847,26 +1236,16 @@ def upload_prescribing(randint):
 
                 prescribing_rows.append(row)
 
+    return prescribing_rows
+
+
+def upload_prescribing(prescribing_rows):
+    """Upload prescribing data to BQ."""
+
     # In production, normalised_prescribing is actually a view,
     # but for the tests it's much easier to set it up as a normal table.
     table = Client("hscic").get_table("normalised_prescribing")
 
-    headers = [
-        "sha",
-        "regional_team_id",
-        "stp_id",
-        "ccg_id",
-        "pcn_id",
-        "practice_id",
-        "bnf_code",
-        "bnf_name",
-        "items",
-        "net_cost",
-        "actual_cost",
-        "quantity",
-        "month",
-    ]
-
     headers_to_exclude_from_bq = ["regional_team_id", "stp_id", "pcn_id"]
 
     with tempfile.NamedTemporaryFile("wt") as f:
@@ -874,21 +1253,26 @@ def upload_prescribing(randint):
         for row in prescribing_rows:
             row_to_upload = [
                 item
-                for item, header in zip(row, headers)
+                for item, header in zip(row, PRESCRIBING_HEADERS)
                 if header not in headers_to_exclude_from_bq
             ]
             writer.writerow(row_to_upload)
         f.seek(0)
         table.insert_rows_from_csv(f.name, schemas.PRESCRIBING_SCHEMA)
 
-    prescriptions = pd.DataFrame.from_records(prescribing_rows, columns=headers)
+
+def build_prescriptions_dataframe(prescribing_rows):
+    prescriptions = pd.DataFrame.from_records(
+        prescribing_rows, columns=PRESCRIBING_HEADERS
+    )
     prescriptions["month"] = prescriptions["month"].str[:10]
 
     return prescriptions
 
 
-def upload_practice_statistics(randint):
-    """Generate practice statistics data, and upload to BQ."""
+def generate_practice_statistics(randint):
+    """Generate practice statistics data, returning the rows to upload to BQ along
+    with a DataFrame of the list sizes."""
 
     practice_statistics_rows = []
     seen_practice_with_no_statistics = False
@@ -957,7 +1341,12 @@ def upload_practice_statistics(randint):
 
     assert seen_practice_with_no_statistics
 
-    # Upload practice_statistics_rows to BigQuery.
+    return practice_statistics_rows, practice_stats
+
+
+def upload_practice_statistics(practice_statistics_rows):
+    """Upload practice statistics data to BQ."""
+
     table = Client("hscic").get_table("practice_statistics")
 
     with tempfile.NamedTemporaryFile("wt") as f:
@@ -967,8 +1356,6 @@ def upload_practice_statistics(randint):
         f.seek(0)
         table.insert_rows_from_csv(f.name, schemas.PRACTICE_STATISTICS_SCHEMA)
 
-    return practice_stats
-
 
 def build_factory():
     """Build a MatrixStore DataFactory with prescriptions for several different
@@ -986,3 +1373,55 @@ def build_factory():
     factory = DataFactory()
     factory.create_prescribing_for_bnf_codes(bnf_codes)
     return factory
+
+
+def build_factory_with_prescribing(prescribing_rows, practice_stats):
+    """Build a MatrixStore DataFactory containing the generated prescribing and list
+    sizes, plus prescriptions for the other presentations used by `build_factory`."""
+
+    factory = DataFactory()
+    factory.create_months("2018-07-01", 2)
+    practice = {"code": "P00001"}
+    for bnf_code in [
+        "0407010P0AAAAAA",  # Nefopam HCl_Inj 20mg/ml 1ml Amp
+        "0703021P0AAAAAA",  # Norgestrel_Tab 75mcg
+        "0904010AVBBAAAA",  # Mrs Crimble's_W/F Dutch Apple Cake
+    ]:
+        presentation = factory.create_presentation(bnf_code)
+        factory.create_prescription(presentation, practice, factory.months[0])
+
+    prescriptions = [dict(zip(PRESCRIBING_HEADERS, row)) for row in prescribing_rows]
+    for bnf_code in sorted({p["bnf_code"] for p in prescriptions}):
+        factory.create_presentation(bnf_code)
+
+    for prescription in prescriptions:
+        factory.prescribing.append(
+            {
+                "month": prescription["month"],
+                "practice": prescription["practice_id"],
+                "bnf_code": prescription["bnf_code"],
+                "bnf_name": prescription["bnf_name"],
+                "items": prescription["items"],
+                "quantity": prescription["quantity"],
+                "net_cost": prescription["net_cost"],
+                "actual_cost": prescription["actual_cost"],
+                "sha": None,
+                "pcn": None,
+                "pct": None,
+                "stp": None,
+                "regional_team": None,
+            }
+        )
+
+    for _, row in practice_stats.iterrows():
+        factory.practice_statistics.append(
+            {
+                "month": row["month"] + " 00:00:00 UTC",
+                "practice": row["practice_id"],
+                "pct_id": row["ccg_id"],
+                "star_pu": "{}",
+                "total_list_size": int(round(row["thousand_patients"] * 1000)),
+            }
+        )
+
+    return factory
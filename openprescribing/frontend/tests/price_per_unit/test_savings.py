@@ -6,6 +6,7 @@ import numpy
 
 from django.core.cache import CacheKeyWarning
 from django.test import TestCase, override_settings
+import mock
 
 from matrixstore.tests.data_factory import DataFactory
 from matrixstore.tests.matrixstore_factory import (
@@ -17,6 +18,7 @@ from frontend.price_per_unit.substitution_sets import get_substitution_sets
 from frontend.price_per_unit.savings import (
     CONFIG_MIN_SAVINGS_FOR_ORG_TYPE,
     CONFIG_TARGET_CENTILE,
+    get_all_savings_for_orgs,
     get_total_savings_for_org,
 )
 
@@ -174,6 +176,18 @@ class PricePerUnitSavingsTest(TestCase):
 
         self.assertEqual(round_floats(result), round_floats(expected))
 
+    def test_savings_dont_depend_on_block_size(self):
+        date = self.factory.months[0][:10]
+        practice_codes = [practice["code"] for practice in self.factory.practices]
+        with mock.patch(
+            "frontend.price_per_unit.savings.SUBSTITUTION_SETS_PER_BLOCK", 1
+        ):
+            expected = get_all_savings_for_orgs(date, "practice", practice_codes)
+        results = get_all_savings_for_orgs(date, "practice", practice_codes)
+        # Make sure we've actually got some savings to compare
+        self.assertTrue(results)
+        self.assertEqual(results, expected)
+
     @classmethod
     def tearDownClass(cls):
         cls._remove_patch()
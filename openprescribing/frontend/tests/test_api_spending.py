@@ -2,22 +2,29 @@ from collections import defaultdict
 import csv
 import json
 
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+import pyarrow
 
 from .api_test_base import ApiTestBase
 
+from api.views_spending import _get_prescribing_for_codes, _remove_overlapping_prefixes
+
 from frontend.models import Prescription
 from frontend.models import TariffPrice
 from frontend.tests.data_factory import DataFactory
 from frontend.ghost_branded_generics import MIN_GHOST_GENERIC_DELTA
 from dmd.models import VMPP
+from matrixstore.build.group_by_org import group_by_org_for_db
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.data_factory import DataFactory as MatrixStoreDataFactory
 from matrixstore.tests.decorators import copy_fixtures_to_matrixstore
+from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
 
 import numpy as np
 
 
 def _parse_json_response(response):
-    return json.loads(response.content.decode("utf8"))
+    return json.loads(response.getvalue().decode("utf8"))
 
 
 class TestAPISpendingViewsTariff(ApiTestBase):
@@ -178,7 +185,7 @@ class TestSpendingByCCG(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_total_spending_by_ccg(self):
         rows = self._get_rows({})
@@ -329,7 +336,7 @@ class TestSpendingByPractice(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_spending_by_all_practices_on_product_without_date(self):
         response = self._get({"code": "0204000I0BC"})
@@ -526,7 +533,7 @@ class TestSpendingByOrg(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_spending_by_all_stps(self):
         rows = self._get_rows({"org_type": "stp"})
@@ -636,6 +643,45 @@ class TestSpendingByOrg(ApiTestBase):
             },
         )
 
+    def _get_arrow_rows(self, params):
+        params["format"] = "arrow"
+        rsp = self.client.get("/api/1.0/spending_by_org/", params)
+        self.assertEqual(rsp.status_code, 200)
+        table = pyarrow.ipc.open_file(pyarrow.BufferReader(rsp.content)).read_all()
+        columns = [column.to_pylist() for column in table.columns]
+        return [dict(zip(table.column_names, row)) for row in zip(*columns)]
+
+    def test_spending_by_all_pcns_as_arrow(self):
+        rows = self._get_arrow_rows({"org_type": "pcn", "code": "02"})
+        rsp = self.client.get(
+            "/api/1.0/spending_by_org/",
+            {"org_type": "pcn", "code": "02", "format": "json"},
+        )
+        self.assertEqual(rows, _parse_json_response(rsp))
+
+    def test_spending_by_org_errors_as_arrow_are_json(self):
+        rsp = self.client.get(
+            "/api/1.0/spending_by_org/",
+            {"org_type": "xyz", "code": "02", "format": "arrow"},
+        )
+        self.assertEqual(rsp.status_code, 400)
+        self.assertEqual(rsp["Content-Type"], "application/json")
+        self.assertEqual(rsp.json(), "Error: unrecognised org_type parameter")
+
+    def test_spending_by_all_practices_on_all_dates_as_arrow(self):
+        # Unlike the other formats, we don't require a date for all practices
+        rows = self._get_arrow_rows({"org_type": "practice", "code": "02"})
+        dates = sorted(set(row["date"] for row in rows))
+        self.assertGreater(len(dates), 1)
+        expected = []
+        for date in dates:
+            rsp = self.client.get(
+                "/api/1.0/spending_by_org/",
+                {"org_type": "practice", "code": "02", "date": date, "format": "json"},
+            )
+            expected.extend(_parse_json_response(rsp))
+        self.assertEqual(rows, expected)
+
 
 @copy_fixtures_to_matrixstore
 class TestAPISpendingViewsGhostGenerics(TestCase):
@@ -888,3 +934,94 @@ class TestAPISpendingViewsPPUBubble(ApiTestBase):
                 "plotline": 0.08875,
             },
         )
+
+
+class TestGetPrescribingForCodes(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        factory = MatrixStoreDataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(3)
+        presentations = [
+            factory.create_presentation(bnf_code)
+            for bnf_code in [
+                "0101010A0AAAAAA",
+                "0101010A0AAABAB",
+                "0101020B0AAAAAA",
+                "0202010C0AAAAAA",
+                "0202",
+            ]
+        ]
+        factory.create_prescribing(presentations, practices, months)
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+        cls.ccg_mapping = {
+            practices[0]["code"]: "CCG1",
+            practices[1]["code"]: "CCG2",
+            practices[2]["code"]: "CCG1",
+        }
+        group_by_org_for_db(cls.matrixstore.connection, {"ccg": cls.ccg_mapping})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+        super().tearDownClass()
+
+    def test_precalculated_totals_match_summing_presentations(self):
+        for prefixes in [
+            ["01"],
+            ["0101010A0"],
+            ["0101", "0202"],
+            ["01", "0101010A0AAAAAA"],
+            ["0101010A0AAAAAA", "0202010C0"],
+            ["0202"],
+            ["99"],
+        ]:
+            with self.subTest(prefixes=prefixes):
+                results = _get_prescribing_for_codes(self.matrixstore, prefixes)
+                expected = self.sum_presentations(prefixes)
+                for matrix, expected_matrix in zip(results, expected):
+                    if expected_matrix is None:
+                        self.assertIsNone(matrix)
+                    else:
+                        # Floats may be summed in a different order
+                        self.assertTrue(np.allclose(matrix, expected_matrix))
+
+    def test_grouped_totals_match_grouping_practices(self):
+        row_grouper = RowGrouper(
+            (offset, self.ccg_mapping[code])
+            for code, offset in self.matrixstore.practice_offsets.items()
+        )
+        self.assertEqual(self.matrixstore.get_org_offsets("ccg"), row_grouper.offsets)
+        for prefixes in [["01"], ["0101010A0AAAAAA", "0202"], [], ["99"]]:
+            with self.subTest(prefixes=prefixes):
+                results = _get_prescribing_for_codes(self.matrixstore, prefixes, "ccg")
+                expected = _get_prescribing_for_codes(self.matrixstore, prefixes)
+                for matrix, expected_matrix in zip(results, expected):
+                    if expected_matrix is None:
+                        self.assertIsNone(matrix)
+                    else:
+                        # Avoid overflowing small integer types when summing
+                        expected_matrix = row_grouper.sum(expected_matrix.astype(float))
+                        self.assertTrue(np.allclose(matrix, expected_matrix))
+
+    def sum_presentations(self, prefixes):
+        where_clause = " OR ".join(["bnf_code LIKE ?"] * len(prefixes))
+        items, quantity, actual_cost = self.matrixstore.query_one(
+            """
+            SELECT matrix_sum(items), matrix_sum(quantity), matrix_sum(actual_cost)
+            FROM presentation WHERE {}
+            """.format(
+                where_clause
+            ),
+            [prefix + "%" for prefix in prefixes],
+        )
+        if actual_cost is not None:
+            actual_cost = actual_cost / 100.0
+        return items, quantity, actual_cost
+
+    def test_remove_overlapping_prefixes(self):
+        self.assertEqual(
+            _remove_overlapping_prefixes(["0202", "01", "0101", "02", "01", "03"]),
+            ["01", "02", "03"],
+        )
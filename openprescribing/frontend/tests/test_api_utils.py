@@ -1,4 +1,8 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+import mock
+import numpy
+from rest_framework.renderers import JSONRenderer
+from rest_framework_csv.renderers import CSVRenderer
 
 
 class ApiTestUtils(TestCase):
@@ -9,3 +13,57 @@ class ApiTestUtils(TestCase):
         self.assertEqual(param_to_list("foo,bar"), ["foo", "bar"])
         self.assertEqual(param_to_list(None), [])
         self.assertEqual(param_to_list([]), [])
+
+
+class TestStreamingResponse(SimpleTestCase):
+    rows = [
+        {
+            "items": numpy.int64(n),
+            "quantity": numpy.float64(n * 2.5),
+            "actual_cost": round(numpy.float64(n / 3), 2),
+            "row_name": 'Org\u2028{}, "quoted"'.format(n),
+        }
+        for n in range(1, 8)
+    ]
+
+    def assertMatchesRenderedList(self, renderer, rows, accepted_media_type=None):
+        from api.view_utils import streaming_response
+
+        expected = renderer.render(list(rows), accepted_media_type)
+        # Use a small chunk size so we test joining chunks together
+        with mock.patch("api.view_utils.STREAMING_CHUNK_SIZE", 3):
+            response = streaming_response(
+                renderer, iter(rows), accepted_media_type=accepted_media_type
+            )
+            self.assertTrue(response.streaming)
+            content = response.getvalue()
+        self.assertEqual(content, expected)
+        self.assertTrue(response["content-type"].startswith(renderer.media_type))
+
+    def test_json_matches_rendered_list(self):
+        self.assertMatchesRenderedList(JSONRenderer(), self.rows)
+
+    def test_indented_json_matches_rendered_list(self):
+        self.assertMatchesRenderedList(
+            JSONRenderer(), self.rows, accepted_media_type="application/json; indent=2"
+        )
+
+    def test_csv_matches_rendered_list(self):
+        self.assertMatchesRenderedList(CSVRenderer(), self.rows)
+
+    def test_empty_rows(self):
+        from api.view_utils import streaming_response
+
+        response = streaming_response(JSONRenderer(), iter([]))
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.data, [])
+
+    def test_exceptions_raised_before_streaming(self):
+        from api.view_utils import streaming_response
+
+        def rows():
+            raise ValueError("Bad date")
+            yield {}
+
+        with self.assertRaises(ValueError):
+            streaming_response(JSONRenderer(), rows())
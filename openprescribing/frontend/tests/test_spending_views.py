@@ -1,6 +1,6 @@
 import collections
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.db.models import Max
 
 from dateutil.relativedelta import relativedelta
@@ -17,6 +17,11 @@ from frontend.tests.data_factory import DataFactory
 from matrixstore.tests.decorators import copy_fixtures_to_matrixstore
 
 
+LOCMEM_CACHE_SETTING = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+
+
 @copy_fixtures_to_matrixstore
 class TestSpendingViews(TestCase):
     @classmethod
@@ -79,6 +84,18 @@ class TestSpendingViews(TestCase):
                     entity, entity_type, parse_date(self.months[-1]).date()
                 )
 
+    def test_cached_costs_are_recalculated_when_concessions_change(self):
+        month = parse_date(self.months[-1]).date()
+        with override_settings(CACHES=LOCMEM_CACHE_SETTING):
+            # Populate the cache
+            ncso_spending_for_entity(self.ccg, "CCG", len(self.months))
+            ncso_spending_breakdown_for_entity(self.ccg, "CCG", month)
+            concession = NCSOConcession.objects.filter(date=month).first()
+            concession.price_pence += 100
+            concession.save()
+            self.validate_ncso_spending_for_entity(self.ccg, "CCG", len(self.months))
+            self.validate_ncso_spending_breakdown_for_entity(self.ccg, "CCG", month)
+
     def validate_ncso_spending_for_entity(self, *args, **kwargs):
         with self.subTest(function="_ncso_spending_for_entity"):
             results = ncso_spending_for_entity(*args, **kwargs)
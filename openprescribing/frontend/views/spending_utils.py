@@ -1,4 +1,5 @@
 from collections import namedtuple
+import hashlib
 
 from django.db import connection
 from django.db.models import Max
@@ -6,9 +7,12 @@ from django.db.models import Max
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse as parse_date
 import numpy
+import scipy.sparse
 
 from frontend.models import NCSOConcession, Presentation
+from matrixstore.cachelib import memoize
 from matrixstore.db import get_db, get_row_grouper
+from matrixstore.matrix_ops import sparse_matrix_from_coordinates
 
 
 # The tariff (or concession) price is not what actually gets paid as each CCG
@@ -19,7 +23,7 @@ NATIONAL_AVERAGE_DISCOUNT_PERCENTAGE = 7.2
 
 ConcessionPriceMatrices = namedtuple(
     "ConcessionPriceMatrices",
-    "bnf_code_offsets date_offsets tariff_prices price_increases",
+    "bnf_code_offsets date_offsets tariff_prices price_increases cache_key",
 )
 
 
@@ -29,6 +33,9 @@ ConcessionCostMatrices = namedtuple(
 )
 
 
+ConcessionCostTotals = namedtuple("ConcessionCostTotals", "tariff_costs extra_costs")
+
+
 def ncso_spending_for_entity(entity, entity_type, num_months, current_month=None):
     org_type, org_id = _get_org_type_and_id(entity, entity_type)
     end_date = NCSOConcession.objects.aggregate(Max("date"))["date__max"]
@@ -37,13 +44,21 @@ def ncso_spending_for_entity(entity, entity_type, num_months, current_month=None
     if not end_date:
         return []
     start_date = end_date - relativedelta(months=num_months - 1)
-    last_prescribing_date = parse_date(get_db().dates[-1]).date()
-    costs = _get_concession_cost_matrices(start_date, end_date, org_type, org_id)
-    # Sum together costs over all presentations (i.e. all rows)
-    tariff_costs = numpy.sum(costs.tariff_costs, axis=0)
-    extra_costs = numpy.sum(costs.extra_costs, axis=0)
+    db = get_db()
+    last_prescribing_date = parse_date(db.dates[-1]).date()
+    prices = _get_concession_price_matrices(start_date, end_date)
+    group_by_org = get_row_grouper(org_type)
+    # If this organisation is not in the set of available groups (because it
+    # has no prescribing data) then it has no costs
+    if org_id not in group_by_org.offsets:
+        tariff_costs = extra_costs = numpy.zeros(len(prices.date_offsets))
+    else:
+        totals = _get_concession_cost_totals_for_org_type(db, prices, group_by_org)
+        offset = group_by_org.offsets[org_id]
+        tariff_costs = totals.tariff_costs[offset]
+        extra_costs = totals.extra_costs[offset]
     results = []
-    for date_str, offset in sorted(costs.date_offsets.items()):
+    for date_str, offset in sorted(prices.date_offsets.items()):
         date = parse_date(date_str).date()
         if extra_costs[offset] == 0:
             continue
@@ -126,9 +141,18 @@ def _get_concession_cost_matrices(min_date, max_date, org_type, org_id):
 
     """
     prices = _get_concession_price_matrices(min_date, max_date)
-    quantities = _get_prescribed_quantity_matrix(
-        prices.bnf_code_offsets, prices.date_offsets, org_type, org_id
-    )
+    group_by_org = get_row_grouper(org_type)
+    shape = prices.tariff_prices.shape
+    # If this organisation is not in the set of available groups (because it
+    # has no prescribing data) then we use a zero-valued quantity matrix
+    if org_id not in group_by_org.offsets:
+        quantities = numpy.zeros(shape, dtype=numpy.int_)
+    else:
+        quantities = _get_prescribed_quantities_for_org_type(
+            get_db(), prices, group_by_org
+        )
+        offset = group_by_org.offsets[org_id]
+        quantities = quantities[offset].toarray().reshape(shape)
     return ConcessionCostMatrices(
         bnf_code_offsets=prices.bnf_code_offsets,
         date_offsets=prices.date_offsets,
@@ -138,11 +162,74 @@ def _get_concession_cost_matrices(min_date, max_date, org_type, org_id):
     )
 
 
-def _get_prescribed_quantity_matrix(bnf_code_offsets, date_offsets, org_type, org_id):
+# Increment the version number if the logic of this function changes such that
+# the same inputs no longer produce the same outputs
+@memoize(version=1)
+def _get_prescribed_quantities_for_org_type(db, prices, group_by_org):
+    """
+    Return a sparse matrix with a row for every organisation (in the order
+    given by `group_by_org`) giving the quantities it prescribed of each of the
+    presentations and dates in `prices`
+
+    Each row can be reshaped into a matrix with the same shape as the price
+    matrices (i.e. one row per presentation and one column per date).
+    """
+    num_dates = len(prices.date_offsets)
+    shape = (len(group_by_org.ids), len(prices.bnf_code_offsets) * num_dates)
+    rows, columns, values = [], [], []
+    for bnf_code, quantities in _get_prescribed_quantities_by_org(
+        db, prices, group_by_org
+    ):
+        org_offsets, date_offsets = quantities.nonzero()
+        rows.append(org_offsets)
+        columns.append(prices.bnf_code_offsets[bnf_code] * num_dates + date_offsets)
+        values.append(quantities[org_offsets, date_offsets])
+    if not rows:
+        return scipy.sparse.csr_matrix(shape, dtype=numpy.int_)
+    matrix = sparse_matrix_from_coordinates(
+        shape,
+        numpy.concatenate(rows),
+        numpy.concatenate(columns),
+        numpy.concatenate(values),
+        integer=True,
+    )
+    return matrix.tocsr()
+
+
+# Increment the version number if the logic of this function changes such that
+# the same inputs no longer produce the same outputs
+@memoize(version=1)
+def _get_concession_cost_totals_for_org_type(db, prices, group_by_org):
+    """
+    Return a ConcessionCostTotals object giving, for every organisation (in the
+    order given by `group_by_org`) and every date in `prices`, the total cost
+    over all presentations of the prescriptions affected by price concessions
+
+    This is used for the monthly totals, which can span many months, so we sum
+    as we go rather than keeping costs for every presentation (for which see
+    `_get_prescribed_quantities_for_org_type`).
     """
-    Given a mapping of BNF codes to row offsets and dates to column offsets,
-    return a matrix giving the quantity of those presentations prescribed on
-    those dates by the specified organisation (given by its type and ID).
+    shape = (len(group_by_org.ids), len(prices.date_offsets))
+    tariff_costs = numpy.zeros(shape)
+    extra_costs = numpy.zeros(shape)
+    for bnf_code, quantities in _get_prescribed_quantities_by_org(
+        db, prices, group_by_org
+    ):
+        row_offset = prices.bnf_code_offsets[bnf_code]
+        tariff_costs += prices.tariff_prices[row_offset] * quantities
+        extra_costs += prices.price_increases[row_offset] * quantities
+    return ConcessionCostTotals(tariff_costs=tariff_costs, extra_costs=extra_costs)
+
+
+def _get_prescribed_quantities_by_org(db, prices, group_by_org):
+    """
+    Yield pairs of the form:
+
+        bnf_code, quantities
+
+    for each of the presentations in `prices`, where `quantities` is a matrix
+    giving the quantity prescribed by each organisation (as rows) on each of
+    the dates in `prices` (as columns)
 
     If the dates extend beyond the latest date for which we have prescribing
     data then we just project the last month forwards (e.g. if we only have
@@ -150,27 +237,19 @@ def _get_prescribed_quantity_matrix(bnf_code_offsets, date_offsets, org_type, or
     we just assume the same quantities as for March were prescribed in April
     and May).
     """
-    db = get_db()
-    group_by_org = get_row_grouper(org_type)
-    shape = (len(bnf_code_offsets), len(date_offsets))
-    quantities = numpy.zeros(shape, dtype=numpy.int_)
-    # If this organisation is not in the set of available groups (because it
-    # has no prescribing data) then return the zero-valued quantity matrix
-    if org_id not in group_by_org.offsets:
-        return quantities
     # Find the columns corresponding to the dates we're interested in
-    columns_selector = _get_date_columns_selector(db.date_offsets, date_offsets)
-    prescribing = _get_quantities_for_bnf_codes(db, list(bnf_code_offsets.keys()))
+    columns_selector = _get_date_columns_selector(db.date_offsets, prices.date_offsets)
+    prescribing = _get_quantities_for_bnf_codes(db, list(prices.bnf_code_offsets))
     for bnf_code, quantity in prescribing:
         # Remap the date columns to just the dates we want
         quantity = quantity[columns_selector]
-        # Sum the prescribing for the given organisation
-        quantity = group_by_org.sum_one_group(quantity, org_id)
-        # Write that sum into the quantities matrix at the correct offset for
-        # the current BNF code
-        row_offset = bnf_code_offsets[bnf_code]
-        quantities[row_offset] = quantity
-    return quantities
+        # Depending on the sparsity of the data we may get back either a numpy
+        # ndarray or a scipy sparse matrix, but we want consistent output
+        if not isinstance(quantity, numpy.ndarray):
+            quantity = quantity.toarray()
+        # Sum the prescribing for each organisation, truncating to integer
+        # quantities
+        yield bnf_code, group_by_org.sum(quantity).astype(numpy.int_)
 
 
 def _get_date_columns_selector(available_date_offsets, required_date_offsets):
@@ -213,19 +292,7 @@ def _get_quantities_for_bnf_codes(db, bnf_codes):
     """
     Return the prescribed quantity matrices for the given list of BNF codes
     """
-    return db.query(
-        """
-        SELECT
-          bnf_code, quantity
-        FROM
-          presentation
-        WHERE
-          bnf_code IN ({})
-        """.format(
-            ",".join(["?"] * len(bnf_codes))
-        ),
-        bnf_codes,
-    )
+    return db.query_presentations(bnf_codes, ["quantity"])
 
 
 def _get_concession_price_matrices(min_date, max_date):
@@ -251,32 +318,46 @@ def _get_concession_price_matrices(min_date, max_date):
     """
     # Fetch list of concessions and associated tariff prices from Postgres
     concessions = _get_concession_prices(min_date, max_date)
+    # Unpack the concessions into an array for each column
+    fields = list(zip(*concessions)) if concessions else [()] * 5
+    dates = numpy.array(fields[0], dtype="datetime64[M]")
+    bnf_codes = numpy.array(fields[1], dtype=str)
+    # Convert prices from per-pack into per-unit
+    quantities_per_pack = numpy.array(fields[4], dtype=numpy.float_)
+    concession_tariff_prices = numpy.array(fields[2], dtype=numpy.float_)
+    concession_tariff_prices /= quantities_per_pack
+    concession_price_increases = numpy.array(fields[3], dtype=numpy.float_)
+    concession_price_increases /= quantities_per_pack
     # Construct the BNF code and date indices we need to store these prices in
-    # matrix form
+    # matrix form, and find the row and column of each concession
     date_offsets = {
         str(date): i for (i, date) in enumerate(_get_dates_in_range(min_date, max_date))
     }
-    bnf_codes = {concession[1] for concession in concessions}
+    bnf_codes, rows = numpy.unique(bnf_codes, return_inverse=True)
+    bnf_codes = bnf_codes.tolist()
     bnf_code_offsets = {bnf_code: i for (i, bnf_code) in enumerate(bnf_codes)}
+    columns = (dates - numpy.datetime64(min_date, "M")).astype(numpy.intp)
     # Construct the matrices we need
     shape = (len(bnf_code_offsets), len(date_offsets))
     tariff_prices = numpy.zeros(shape, dtype=numpy.float_)
     price_increases = numpy.zeros(shape, dtype=numpy.float_)
-    # Loop over the concessions and write them into the matrices
-    for date, bnf_code, tariff_price, price_increase, quantity_per_pack in concessions:
-        index = (bnf_code_offsets[bnf_code], date_offsets[str(date)])
-        # Convert prices from per-pack into per-unit
-        tariff_price = tariff_price / quantity_per_pack
-        price_increase = price_increase / quantity_per_pack
-        # Price concessions are defined at the product-pack level but we only
-        # have prescribing data at product level. Occasionally there are
-        # multiple simultaneous concessions for a given product with different
-        # implied prices-per-unit for different pack sizes. As we can't know
-        # from our data which pack size was dispensed we just use the highest
-        # per-unit price.
-        if price_increase > price_increases[index]:
-            price_increases[index] = price_increase
-            tariff_prices[index] = tariff_price
+    # Price concessions are defined at the product-pack level but we only have
+    # prescribing data at product level. Occasionally there are multiple
+    # simultaneous concessions for a given product with different implied
+    # prices-per-unit for different pack sizes. As we can't know from our data
+    # which pack size was dispensed we just use the highest per-unit price. To
+    # find it we sort by matrix cell and then by descending price increase
+    # (keeping the original order of any ties) and take the first concession
+    # for each cell.
+    cells = numpy.ravel_multi_index((rows, columns), shape)
+    order = numpy.lexsort((-concession_price_increases, cells))
+    is_first = numpy.ones(len(order), dtype=numpy.bool_)
+    is_first[1:] = cells[order][1:] != cells[order][:-1]
+    selected = order[is_first]
+    # Cells where no concession increases the price are left at zero
+    selected = selected[concession_price_increases[selected] > 0]
+    price_increases.flat[cells[selected]] = concession_price_increases[selected]
+    tariff_prices.flat[cells[selected]] = concession_tariff_prices[selected]
     # Apply the national average discount to get a better approximation of the
     # actual price paid, and while we're at it convert from pence to pounds to
     # make later calcuations easier
@@ -288,9 +369,27 @@ def _get_concession_price_matrices(min_date, max_date):
         date_offsets=date_offsets,
         tariff_prices=tariff_prices,
         price_increases=price_increases,
+        cache_key=_get_concession_prices_cache_key(
+            min_date, max_date, bnf_codes, tariff_prices, price_increases
+        ),
     )
 
 
+def _get_concession_prices_cache_key(
+    min_date, max_date, bnf_codes, tariff_prices, price_increases
+):
+    """
+    Return a key which identifies the concession prices in the given date
+    range for caching purposes, so that cached costs are recalculated whenever
+    the concessions (or their tariff prices) change
+    """
+    hashobj = hashlib.md5(str((min_date, max_date)).encode("utf8"))
+    hashobj.update(",".join(bnf_codes).encode("utf8"))
+    hashobj.update(tariff_prices.tobytes())
+    hashobj.update(price_increases.tobytes())
+    return hashobj.digest()
+
+
 def _get_dates_in_range(date_start, date_end):
     date = date_start
     while date <= date_end:
@@ -0,0 +1,246 @@
+"""
+Populate a newly initialised SQLite file by taking the data from a previous
+MatrixStore file and appending a single new month, rather than re-importing
+every month from scratch
+
+The new file must already have its `date` and `practice` tables populated (see
+`init_db`) and its dates must be those of the previous file with the earliest
+month(s) dropped and one new month added at the end. Data for all but the new
+month is copied across from the previous file, with rows re-mapped to the new
+set of practices; data for the new month is imported from CSV in the usual
+way.
+
+The result is equivalent to what `import_practice_stats` followed by
+`import_prescribing` would have produced, so the remaining build stages
+(`update_bnf_map`, `precalculate_totals` etc) are run on it as normal. Note
+that presentations and practice statistics which no longer have any
+non-zero values are not carried over from the previous file, and that each
+practice statistic keeps the integer or floating point type it had in the
+previous file.
+"""
+import logging
+import os.path
+import sqlite3
+
+import numpy
+import scipy.sparse
+
+from matrixstore.matrix_ops import (
+    finalise_matrix,
+    is_integer,
+    sparse_matrix_from_coordinates,
+)
+from matrixstore.serializer import deserialize, serialize_compressed
+
+from .import_practice_stats import (
+    get_practice_statistics_for_dates,
+    write_practice_stats,
+)
+from .import_prescribing import (
+    get_prescriptions_for_dates,
+    should_log_message,
+    write_prescribing,
+)
+from .init_db import SCHEMA_SQL, import_dates
+
+
+logger = logging.getLogger(__name__)
+
+
+PRESCRIBING_COLUMNS = ["items", "quantity", "actual_cost", "net_cost"]
+
+
+def append_month(previous_sqlite_path, sqlite_path, workers=1):
+    for path in [previous_sqlite_path, sqlite_path]:
+        if not os.path.exists(path):
+            raise RuntimeError("No SQLite file at: {}".format(path))
+    previous_connection = sqlite3.connect(previous_sqlite_path)
+    connection = sqlite3.connect(sqlite_path)
+    # Trade crash-safety for insert speed
+    connection.execute("PRAGMA synchronous=OFF")
+    new_date = connection.execute("SELECT MAX(date) FROM date").fetchone()[0]
+    prescriptions = get_prescriptions_for_dates([new_date])
+    practice_statistics = get_practice_statistics_for_dates([new_date])
+    append_month_for_db(
+        previous_connection,
+        connection,
+        prescriptions,
+        practice_statistics,
+        workers=workers,
+    )
+    connection.commit()
+    connection.close()
+    previous_connection.close()
+
+
+def append_month_for_db(
+    previous_connection, connection, prescriptions, practice_statistics, workers=1
+):
+    dates = get_dates(connection)
+    previous_dates = get_dates(previous_connection)
+    new_date = dates[-1]
+    months_to_keep = len(dates) - 1
+    if (
+        months_to_keep == 0
+        or previous_dates[-months_to_keep:] != dates[:-1]
+        or new_date in previous_dates
+    ):
+        raise RuntimeError(
+            "Can't build {} to {} by adding a month to a file covering {} to {}; "
+            "a full build is required".format(
+                dates[0], dates[-1], previous_dates[0], previous_dates[-1]
+            )
+        )
+    # Number of columns to drop from the start of each previous matrix
+    columns_to_drop = len(previous_dates) - months_to_keep
+    row_map = get_row_map(previous_connection, connection)
+    num_practices = connection.execute("SELECT COUNT(*) FROM practice").fetchone()[0]
+    logger.info(
+        "Appending data for %s to %s months from previous file",
+        new_date,
+        months_to_keep,
+    )
+    # Import the new month's data into a single-column MatrixStore using the
+    # normal import process, and then combine it with the previous data
+    new_month = get_single_month_connection(connection, new_date)
+    write_practice_stats(new_month, practice_statistics)
+    write_prescribing(new_month, prescriptions, workers=workers)
+    combine = MatrixCombiner(row_map, columns_to_drop, (num_practices, len(dates)))
+    append_table(
+        previous_connection,
+        new_month,
+        connection,
+        "practice_statistic",
+        "name",
+        ["value"],
+        combine,
+    )
+    append_table(
+        previous_connection,
+        new_month,
+        connection,
+        "presentation",
+        "bnf_code",
+        PRESCRIBING_COLUMNS,
+        combine,
+    )
+    new_month.close()
+
+
+def get_dates(connection):
+    return [
+        date for (date,) in connection.execute("SELECT date FROM date ORDER BY date")
+    ]
+
+
+def get_row_map(previous_connection, connection):
+    """
+    Return an array mapping each row offset in the previous file to the row
+    offset of the same practice in the new file, or -1 if the practice is no
+    longer present
+    """
+    practices = dict(connection.execute("SELECT code, offset FROM practice"))
+    previous_practices = list(
+        previous_connection.execute("SELECT code, offset FROM practice")
+    )
+    row_map = numpy.full(len(previous_practices), -1, dtype=numpy.int_)
+    for code, offset in previous_practices:
+        row_map[offset] = practices.get(code, -1)
+    return row_map
+
+
+def get_single_month_connection(connection, date):
+    """
+    Return an in-memory database with the same practices as `connection` but
+    with `date` as its only date
+    """
+    new_month = sqlite3.connect(":memory:")
+    new_month.executescript(SCHEMA_SQL)
+    import_dates(new_month, [date])
+    new_month.executemany(
+        "INSERT INTO practice (offset, code) VALUES (?, ?)",
+        connection.execute("SELECT offset, code FROM practice"),
+    )
+    return new_month
+
+
+def append_table(
+    previous_connection, new_month, connection, table, key_column, columns, combine
+):
+    """
+    Write a row to `table` for every key in either the previous file or the
+    new month's data, combining the matrices from each
+    """
+    keys_sql = "SELECT {} FROM {} WHERE {} IS NOT NULL".format(
+        key_column, table, columns[0]
+    )
+    previous_keys = {key for (key,) in previous_connection.execute(keys_sql)}
+    new_keys = {key for (key,) in new_month.execute(keys_sql)}
+    keys = sorted(previous_keys | new_keys)
+    logger.info("Combining %s rows for %s", len(keys), table)
+    select_sql = "SELECT {} FROM {} WHERE {}=?".format(
+        ", ".join(columns), table, key_column
+    )
+    insert_sql = "INSERT INTO {} ({}, {}) VALUES ({})".format(
+        table, key_column, ", ".join(columns), ", ".join(["?"] * (len(columns) + 1))
+    )
+    empty_row = [None] * len(columns)
+    for n, key in enumerate(keys, start=1):
+        previous_values = empty_row
+        new_values = empty_row
+        if key in previous_keys:
+            previous_values = previous_connection.execute(select_sql, [key]).fetchone()
+        if key in new_keys:
+            new_values = new_month.execute(select_sql, [key]).fetchone()
+        matrices = [
+            combine(previous_value, new_value)
+            for previous_value, new_value in zip(previous_values, new_values)
+        ]
+        # Don't carry over rows which only had data in the months we've dropped
+        if key not in new_keys and not any(matrix.nnz for matrix in matrices):
+            continue
+        connection.execute(
+            insert_sql,
+            [key] + [serialize_compressed(finalise_matrix(m)) for m in matrices],
+        )
+        if should_log_message(n):
+            logger.info("Combined %s %s (%s/%s)", table, key, n, len(keys))
+
+
+class MatrixCombiner(object):
+    """
+    Combines a serialized matrix from the previous file with a serialized
+    single-column matrix for the new month, returning a sparse matrix ready to
+    be passed to `finalise_matrix`
+    """
+
+    def __init__(self, row_map, columns_to_drop, shape):
+        self.row_map = row_map
+        self.columns_to_drop = columns_to_drop
+        self.shape = shape
+
+    def __call__(self, previous_value, new_value):
+        rows, cols, values, integer = [], [], [], None
+        if previous_value is not None:
+            matrix = scipy.sparse.coo_matrix(deserialize(previous_value))
+            integer = is_integer(matrix)
+            new_rows = self.row_map[matrix.row]
+            new_cols = matrix.col - self.columns_to_drop
+            keep = (new_rows != -1) & (new_cols >= 0)
+            rows.append(new_rows[keep])
+            cols.append(new_cols[keep])
+            values.append(matrix.data[keep])
+        if new_value is not None:
+            matrix = scipy.sparse.coo_matrix(deserialize(new_value))
+            if integer is None:
+                integer = is_integer(matrix)
+            rows.append(matrix.row)
+            cols.append(numpy.full(matrix.nnz, self.shape[1] - 1))
+            values.append(matrix.data)
+        return sparse_matrix_from_coordinates(
+            self.shape,
+            numpy.concatenate(rows),
+            numpy.concatenate(cols),
+            numpy.concatenate(values),
+            integer=integer,
+        )
@@ -0,0 +1,34 @@
+"""
+Optionally rewrite every matrix in a SQLite file so that each date column is
+compressed separately (see `matrixstore.serializer.serialize_chunked_by_column`)
+
+This makes the file larger, and reading whole matrices slightly slower, but
+it means that pages which only need a single month of data can read just that
+column rather than decompressing all 60 months. Files are self-describing
+in this respect so the rest of the code works unchanged with either layout.
+"""
+import os.path
+import sqlite3
+
+from matrixstore.serializer import deserialize, serialize_chunked_by_column
+
+from .rewrite_matrices import rewrite_matrices
+
+
+def chunk_matrices_by_date(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Trade crash-safety for insert speed
+    connection.execute("PRAGMA synchronous=OFF")
+    chunk_matrices_by_date_for_db(connection)
+    connection.commit()
+    connection.close()
+
+
+def chunk_matrices_by_date_for_db(connection):
+    rewrite_matrices(
+        connection,
+        lambda value: serialize_chunked_by_column(deserialize(value)),
+        "Chunking matrices by date",
+    )
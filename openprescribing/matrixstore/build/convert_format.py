@@ -0,0 +1,42 @@
+"""
+Rewrite every matrix in a SQLite file using the current serialization format
+
+Files built before we replaced PyArrow's (now deprecated) serialization with
+our own format can only be read with an old version of PyArrow installed. This
+re-encodes their matrices so that they can be read without it. Matrices which
+are chunked by date stay chunked by date.
+"""
+import os.path
+import sqlite3
+
+from matrixstore.serializer import (
+    COLUMN_CHUNKED_MAGIC_NUMBER,
+    deserialize,
+    serialize_chunked_by_column,
+    serialize_compressed,
+)
+
+from .rewrite_matrices import rewrite_matrices
+
+
+def convert_format(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Trade crash-safety for insert speed
+    connection.execute("PRAGMA synchronous=OFF")
+    convert_format_for_db(connection)
+    connection.commit()
+    connection.close()
+
+
+def convert_format_for_db(connection):
+    rewrite_matrices(connection, convert_value, "Converting matrix format")
+
+
+def convert_value(value):
+    matrix = deserialize(value)
+    if value[: len(COLUMN_CHUNKED_MAGIC_NUMBER)] == COLUMN_CHUNKED_MAGIC_NUMBER:
+        return serialize_chunked_by_column(matrix)
+    else:
+        return serialize_compressed(matrix)
@@ -0,0 +1,168 @@
+"""
+Optionally write copies of the prescribing matrices grouped by organisation
+(CCG, PCN, STP and regional team) into `presentation_by_<org_type>` and
+`all_presentations_by_<org_type>` tables
+
+These have one row per organisation rather than one per practice so they are
+much smaller, and queries at organisation level can use them directly without
+having to sum practice level data at runtime.
+
+Practice membership of organisations is taken from the database at build time
+and the resulting org offsets are stored in the `org_offset` table, so that the
+grouped data is always consistent with the snapshot of prescribing data in the
+file, even if the organisation structure has since changed.
+"""
+import logging
+import os.path
+import sqlite3
+
+import numpy
+import scipy.sparse
+
+from matrixstore.db import get_org_mapping
+from matrixstore.matrix_ops import finalise_matrix, is_integer
+from matrixstore.serializer import deserialize, serialize_compressed
+
+from .import_prescribing import should_log_message
+
+
+logger = logging.getLogger(__name__)
+
+
+GROUPED_ORG_TYPES = ("ccg", "pcn", "stp", "regional_team")
+
+PRESCRIBING_COLUMNS = ["items", "quantity", "actual_cost", "net_cost"]
+
+ORG_OFFSET_SCHEMA_SQL = """
+    -- Maps each organisation to its corresponding row offset in the matrices
+    -- in the `presentation_by_<org_type>` tables
+    CREATE TABLE org_offset (
+        org_type TEXT,
+        org_id TEXT,
+        offset INTEGER,
+
+        PRIMARY KEY (org_type, org_id)
+    );
+"""
+
+GROUPED_SCHEMA_SQL = """
+    -- As `presentation` but with one matrix row per organisation
+    CREATE TABLE presentation_by_{org_type} (
+        bnf_code TEXT,
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (bnf_code)
+    );
+
+    -- As `all_presentations` but with one matrix row per organisation
+    CREATE TABLE all_presentations_by_{org_type} (
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB
+    );
+"""
+
+
+def group_by_org(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Trade crash-safety for insert speed
+    connection.execute("PRAGMA synchronous=OFF")
+    mappings = {org_type: get_org_mapping(org_type) for org_type in GROUPED_ORG_TYPES}
+    group_by_org_for_db(connection, mappings)
+    connection.commit()
+    connection.close()
+
+
+def group_by_org_for_db(connection, mappings):
+    """
+    `mappings` is a dict which maps each org type to a dict mapping practice
+    codes to the IDs of organisations of that type
+    """
+    connection.executescript(ORG_OFFSET_SCHEMA_SQL)
+    practice_offsets = dict(connection.execute("SELECT code, offset FROM practice"))
+    for org_type, mapping in sorted(mappings.items()):
+        connection.executescript(GROUPED_SCHEMA_SQL.format(org_type=org_type))
+        org_ids, grouping_matrix = get_grouping_matrix(practice_offsets, mapping)
+        logger.info("Grouping matrices by %s (%s orgs)", org_type, len(org_ids))
+        # Leave the tables empty if there are no orgs, and readers will fall
+        # back to grouping practice level data
+        if not org_ids:
+            continue
+        connection.executemany(
+            "INSERT INTO org_offset (org_type, org_id, offset) VALUES (?, ?, ?)",
+            [(org_type, org_id, offset) for offset, org_id in enumerate(org_ids)],
+        )
+        for table, key_column in [
+            ("presentation", "bnf_code"),
+            ("all_presentations", None),
+        ]:
+            write_grouped_matrices(
+                connection, grouping_matrix, table, key_column, org_type
+            )
+
+
+def get_grouping_matrix(practice_offsets, mapping):
+    """
+    Return a sorted list of org IDs, and a sparse matrix which, when multiplied
+    by a practice level matrix, sums the rows belonging to each org
+    """
+    org_ids = sorted(
+        {mapping[code] for code in practice_offsets.keys() if code in mapping}
+    )
+    org_offsets = {org_id: offset for offset, org_id in enumerate(org_ids)}
+    rows = []
+    cols = []
+    for code, practice_offset in practice_offsets.items():
+        if code in mapping:
+            rows.append(org_offsets[mapping[code]])
+            cols.append(practice_offset)
+    grouping_matrix = scipy.sparse.csr_matrix(
+        (numpy.ones(len(rows), dtype=numpy.int_), (rows, cols)),
+        shape=(len(org_ids), len(practice_offsets)),
+    )
+    return org_ids, grouping_matrix
+
+
+def write_grouped_matrices(connection, grouping_matrix, table, key_column, org_type):
+    columns = ([key_column] if key_column else []) + PRESCRIBING_COLUMNS
+    select_sql = "SELECT {} FROM {} ORDER BY {}".format(
+        ", ".join(columns), table, key_column or "rowid"
+    )
+    insert_sql = "INSERT INTO {}_by_{} ({}) VALUES ({})".format(
+        table, org_type, ", ".join(columns), ", ".join(["?"] * len(columns))
+    )
+    float_grouping_matrix = grouping_matrix.astype(numpy.float_)
+    cursor = connection.cursor()
+    for n, row in enumerate(connection.execute(select_sql), start=1):
+        if key_column:
+            key, matrices = [row[0]], row[1:]
+        else:
+            key, matrices = [], row
+        grouped_values = []
+        for value in matrices:
+            matrix = deserialize(value)
+            if is_integer(matrix):
+                grouped = group_matrix(grouping_matrix, matrix)
+            else:
+                grouped = group_matrix(float_grouping_matrix, matrix)
+            grouped_values.append(serialize_compressed(grouped))
+        cursor.execute(insert_sql, key + grouped_values)
+        if key and should_log_message(n):
+            logger.info("Grouped %s by %s (%s)", key[0], org_type, n)
+
+
+def group_matrix(grouping_matrix, matrix):
+    """
+    Sum the rows of a practice level matrix into org level rows and return the
+    result in a form suitable for storage
+    """
+    grouped = grouping_matrix @ matrix
+    if not scipy.sparse.issparse(grouped):
+        grouped = scipy.sparse.csc_matrix(grouped)
+    return finalise_matrix(grouped)
@@ -1,6 +1,7 @@
 """
 Import practice statistics from downloaded CSV files into SQLite
 """
+from array import array
 import csv
 import gzip
 import json
@@ -8,7 +9,7 @@ import logging
 import os.path
 import sqlite3
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
+from matrixstore.matrix_ops import sparse_matrix_from_coordinates, finalise_matrix
 from matrixstore.serializer import serialize_compressed
 
 from .common import get_practice_stats_filename
@@ -123,7 +124,10 @@ def build_matrices(practice_statistics, practices, dates):
     max_row = max(practices.values())
     max_col = max(dates.values())
     shape = (max_row + 1, max_col + 1)
-    matrices = {}
+    # Rather than assigning values into sparse matrices one at a time, which is
+    # very slow, we accumulate offsets and values for each statistic and then
+    # build each matrix in a single operation
+    coordinates = {}
     for statistic_name, practice, date, value in practice_statistics:
         try:
             practice_offset = practices[practice]
@@ -135,11 +139,20 @@ def build_matrices(practice_statistics, practices, dates):
             continue
         date_offset = dates[date]
         try:
-            matrix = matrices[statistic_name]
+            rows, cols, values, integer = coordinates[statistic_name]
         except KeyError:
-            matrix = sparse_matrix(shape, integer=isinstance(value, int))
-            matrices[statistic_name] = matrix
-        matrix[practice_offset, date_offset] = value
-    logger.info("Writing %s practice statistics matrices to SQLite", len(matrices))
-    for statistic_name, matrix in sorted(matrices.items()):
+            # The type of each matrix is determined by the type of the first
+            # value we see for it. We store the values in a list rather than an
+            # array because later values may not be of the same type.
+            rows, cols, values = array("l"), array("l"), []
+            integer = isinstance(value, int)
+            coordinates[statistic_name] = rows, cols, values, integer
+        rows.append(practice_offset)
+        cols.append(date_offset)
+        values.append(value)
+    logger.info("Writing %s practice statistics matrices to SQLite", len(coordinates))
+    for statistic_name, (rows, cols, values, integer) in sorted(coordinates.items()):
+        matrix = sparse_matrix_from_coordinates(
+            shape, rows, cols, values, integer=integer
+        )
         yield statistic_name, finalise_matrix(matrix)
@@ -1,7 +1,9 @@
 """
 Import prescribing data from CSV files into SQLite
 """
-from collections import namedtuple
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import csv
 from itertools import groupby
 import logging
@@ -10,7 +12,7 @@ import sqlite3
 import gzip
 import heapq
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
+from matrixstore.matrix_ops import sparse_matrix_from_coordinates, finalise_matrix
 from matrixstore.serializer import serialize_compressed
 
 from .common import get_prescribing_filename
@@ -22,11 +24,17 @@ logger = logging.getLogger(__name__)
 MatrixRow = namedtuple("MatrixRow", "bnf_code items quantity actual_cost net_cost")
 
 
+# When building matrices in parallel we send each worker all the prescribing
+# for presentations sharing a BNF code prefix of this length (i.e. a chemical
+# substance) as a single batch
+PARTITION_PREFIX_LENGTH = 9
+
+
 class MissingHeaderError(Exception):
     pass
 
 
-def import_prescribing(filename):
+def import_prescribing(filename, workers=1):
     if not os.path.exists(filename):
         raise RuntimeError("No SQLite file at: {}".format(filename))
     connection = sqlite3.connect(filename)
@@ -34,18 +42,25 @@ def import_prescribing(filename):
     connection.execute("PRAGMA synchronous=OFF")
     dates = [date for (date,) in connection.execute("SELECT date FROM date")]
     prescriptions = get_prescriptions_for_dates(dates)
-    write_prescribing(connection, prescriptions)
+    write_prescribing(connection, prescriptions, workers=workers)
     connection.commit()
     connection.close()
 
 
-def write_prescribing(connection, prescriptions):
+def write_prescribing(connection, prescriptions, workers=1):
     cursor = connection.cursor()
     # Map practice codes and date strings to their corresponding row/column
     # offset in the matrix
     practices = dict(cursor.execute("SELECT code, offset FROM practice"))
     dates = dict(cursor.execute("SELECT date, offset FROM date"))
-    matrices = build_matrices(prescriptions, practices, dates)
+    if workers > 1:
+        matrices = build_serialized_matrices_in_parallel(
+            prescriptions, practices, dates, workers
+        )
+    else:
+        matrices = map(
+            serialize_matrix_row, build_matrices(prescriptions, practices, dates)
+        )
     rows = format_as_sql_rows(matrices, connection)
     cursor.executemany(
         """
@@ -138,31 +153,91 @@ def build_matrices(prescriptions, practices, dates):
     shape = (max_row + 1, max_col + 1)
     grouped_by_bnf_code = groupby(prescriptions, lambda row: row[0])
     for bnf_code, row_group in grouped_by_bnf_code:
-        items_matrix = sparse_matrix(shape, integer=True)
-        quantity_matrix = sparse_matrix(shape, integer=False)
-        actual_cost_matrix = sparse_matrix(shape, integer=True)
-        net_cost_matrix = sparse_matrix(shape, integer=True)
+        # Rather than assigning values into sparse matrices one at a time,
+        # which is very slow, we accumulate offsets and values into compact
+        # arrays and then build each matrix in a single operation
+        rows = array("l")
+        cols = array("l")
+        items_values = array("l")
+        quantity_values = array("d")
+        actual_cost_values = array("l")
+        net_cost_values = array("l")
         for _, practice, date, items, quantity, actual_cost, net_cost in row_group:
-            practice_offset = practices[practice]
-            date_offset = dates[date]
-            items_matrix[practice_offset, date_offset] = items
-            quantity_matrix[practice_offset, date_offset] = quantity
-            actual_cost_matrix[practice_offset, date_offset] = actual_cost
-            net_cost_matrix[practice_offset, date_offset] = net_cost
+            rows.append(practices[practice])
+            cols.append(dates[date])
+            items_values.append(items)
+            quantity_values.append(quantity)
+            actual_cost_values.append(actual_cost)
+            net_cost_values.append(net_cost)
         yield MatrixRow(
             bnf_code,
-            finalise_matrix(items_matrix),
-            finalise_matrix(quantity_matrix),
-            finalise_matrix(actual_cost_matrix),
-            finalise_matrix(net_cost_matrix),
+            build_matrix(shape, rows, cols, items_values, integer=True),
+            build_matrix(shape, rows, cols, quantity_values, integer=False),
+            build_matrix(shape, rows, cols, actual_cost_values, integer=True),
+            build_matrix(shape, rows, cols, net_cost_values, integer=True),
         )
 
 
+def build_matrix(shape, rows, cols, values, integer):
+    return finalise_matrix(
+        sparse_matrix_from_coordinates(shape, rows, cols, values, integer=integer)
+    )
+
+
+def serialize_matrix_row(row):
+    """
+    Return a copy of the MatrixRow with each of its matrices serialized and
+    compressed
+    """
+    return MatrixRow(row.bnf_code, *map(serialize_compressed, row[1:]))
+
+
+def build_serialized_matrices(prescriptions, practices, dates):
+    """
+    Build and serialize matrices for the supplied batch of prescriptions,
+    returning a list of MatrixRows
+
+    This is the unit of work performed by each worker process when building
+    in parallel.
+    """
+    return list(
+        map(serialize_matrix_row, build_matrices(prescriptions, practices, dates))
+    )
+
+
+def build_serialized_matrices_in_parallel(prescriptions, practices, dates, workers):
+    """
+    As `build_matrices` followed by `serialize_matrix_row`, but partitions the
+    prescriptions by BNF code prefix and does the building, finalising and
+    compressing in a pool of worker processes
+
+    Results are yielded in the same order as the input. Reading the CSV files
+    still happens in this process because gzipped streams can't be split
+    without reading them, but this is cheap compared to building the matrices.
+    """
+    grouped_by_prefix = groupby(
+        prescriptions, lambda row: row[0][:PARTITION_PREFIX_LENGTH]
+    )
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _, row_group in grouped_by_prefix:
+            pending.append(
+                executor.submit(
+                    build_serialized_matrices, list(row_group), practices, dates
+                )
+            )
+            # Limit the number of batches held in memory at any one time
+            while len(pending) > workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
 def format_as_sql_rows(matrices, connection):
     """
     Given an iterable of MatrixRows (which contain a BNF code plus all
-    prescribing data for that presentation) yield tuples of values ready for
-    insertion into SQLite
+    prescribing data for that presentation, serialized) yield tuples of values
+    ready for insertion into SQLite
     """
     cursor = connection.cursor()
     num_presentations = next(cursor.execute("SELECT COUNT(*) FROM presentation"))[0]
@@ -179,13 +254,7 @@ def format_as_sql_rows(matrices, connection):
             logger.info(
                 "Writing data for %s (%s/%s)", row.bnf_code, count, num_presentations
             )
-        yield (
-            serialize_compressed(row.items),
-            serialize_compressed(row.quantity),
-            serialize_compressed(row.actual_cost),
-            serialize_compressed(row.net_cost),
-            row.bnf_code,
-        )
+        yield (row.items, row.quantity, row.actual_cost, row.net_cost, row.bnf_code)
     logger.info("Finished writing data for %s presentations", count)
 
 
@@ -43,6 +43,19 @@ SCHEMA_SQL = """
         net_cost BLOB
     );
 
+    -- This table contains totals pre-calculated from the `presentation` table
+    -- over every BNF chapter, section, paragraph and chemical (i.e. every
+    -- prefix of a BNF code of length 2, 4, 6 and 9), so we can answer queries
+    -- for these without summing large numbers of matrices at runtime
+    CREATE TABLE bnf_prefix_totals (
+        bnf_code_prefix TEXT,
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+
+        PRIMARY KEY (bnf_code_prefix)
+    );
+
     CREATE TABLE practice_statistic (
         name TEXT,
         -- The "value" column will contain the actual statistics as serialized
@@ -0,0 +1,159 @@
+"""
+Optionally pre-calculate price-per-unit savings for every substitution set (see
+`frontend.price_per_unit`) and write them to the `ppu_savings` table
+
+Savings are otherwise calculated when they're first requested, which is slow,
+especially for dates other than the latest month (which the
+`matrixstore_warm_cache` command calculates in advance).
+
+Like the `group_by_org` stage, this reads which practices belong to the peer
+group used for calculating target prices-per-unit from the database at build
+time. Each row is stored along with a key identifying the inputs to the
+calculation (see `get_savings_key`), so that savings are recalculated at
+runtime if the configuration or the peer group has changed since.
+"""
+import logging
+import os.path
+import sqlite3
+
+import numpy
+import scipy.sparse
+
+from frontend.price_per_unit.savings import (
+    CONFIG_TARGET_CENTILE,
+    CONFIG_TARGET_PEER_GROUP,
+    get_savings,
+    get_savings_key,
+    get_target_ppu,
+)
+from frontend.price_per_unit.substitution_sets import (
+    FORMULATION_SWAPS_FILE,
+    get_substitution_sets_from_bnf_codes,
+)
+from matrixstore.connection import MatrixStore
+from matrixstore.db import get_org_mapping
+from matrixstore.matrix_ops import finalise_matrix
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.serializer import serialize_compressed
+
+from .import_prescribing import should_log_message
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA_SQL = """
+    -- Price-per-unit savings for each substitution set, identified by its
+    -- generic BNF code
+    CREATE TABLE ppu_savings (
+        generic_code TEXT,
+        -- Identifies the inputs used in calculating the savings
+        savings_key TEXT,
+        -- Totals over all presentations in the set
+        quantity BLOB,
+        net_cost BLOB,
+        -- Matrix with a single row giving the target price-per-unit on each
+        -- date
+        target_ppu BLOB,
+        -- Savings available to each practice on each date
+        savings BLOB,
+
+        PRIMARY KEY (savings_key)
+    );
+"""
+
+
+def precalculate_savings(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Trade crash-safety for insert speed
+    connection.execute("PRAGMA synchronous=OFF")
+    matrixstore = MatrixStore(connection)
+    bnf_codes = [
+        bnf_code
+        for (bnf_code,) in matrixstore.query("SELECT bnf_code FROM presentation")
+    ]
+    substitution_sets = get_substitution_sets_from_bnf_codes(
+        bnf_codes, FORMULATION_SWAPS_FILE
+    )
+    mapping = get_org_mapping(CONFIG_TARGET_PEER_GROUP)
+    practice_group_by_org = RowGrouper(
+        (offset, mapping[practice_code])
+        for practice_code, offset in matrixstore.practice_offsets.items()
+        if practice_code in mapping
+    )
+    precalculate_savings_for_db(
+        connection, substitution_sets, practice_group_by_org, CONFIG_TARGET_CENTILE
+    )
+    connection.commit()
+    connection.close()
+
+
+def precalculate_savings_for_db(
+    connection, substitution_sets, practice_group_by_org, target_centile
+):
+    connection.executescript(SCHEMA_SQL)
+    matrixstore = MatrixStore(connection)
+    logger.info(
+        "Calculating price-per-unit savings for %s substitution sets",
+        len(substitution_sets),
+    )
+    cursor = connection.cursor()
+    for n, substitution_set in enumerate(substitution_sets.values(), start=1):
+        bnf_codes = substitution_set.presentations
+        (totals,) = matrixstore.query_one(
+            """
+            SELECT
+              MATRIX_SUM_MANY(quantity, net_cost)
+            FROM
+              presentation
+            WHERE
+              bnf_code IN ({})
+            ORDER BY
+              bnf_code
+            """.format(
+                ",".join(["?"] * len(bnf_codes))
+            ),
+            bnf_codes,
+        )
+        # Nothing in this set was ever prescribed
+        if totals is None:
+            continue
+        quantities, net_costs = totals
+        target_ppu = get_target_ppu(
+            quantities,
+            net_costs,
+            group_by_org=practice_group_by_org,
+            target_centile=target_centile,
+        )
+        savings = get_savings(quantities, net_costs, target_ppu)
+        # Where there's no target price-per-unit (because nothing was
+        # prescribed by the peer group) the savings are NaN. These never count
+        # as savings, so we store them as zeros which take no space.
+        savings[numpy.isnan(savings)] = 0
+        cursor.execute(
+            """
+            INSERT INTO ppu_savings (
+              generic_code, savings_key, quantity, net_cost, target_ppu, savings
+            )
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                substitution_set.id,
+                get_savings_key(
+                    substitution_set, practice_group_by_org, target_centile
+                ),
+                prepare_matrix_value(quantities),
+                prepare_matrix_value(net_costs),
+                serialize_compressed(target_ppu.reshape((1, -1))),
+                prepare_matrix_value(savings),
+            ],
+        )
+        if should_log_message(n):
+            logger.info("Calculated savings for %s (%s)", substitution_set.id, n)
+
+
+def prepare_matrix_value(matrix):
+    matrix = finalise_matrix(scipy.sparse.csc_matrix(matrix))
+    return serialize_compressed(matrix)
@@ -3,6 +3,9 @@ Pre-calculate totals for prescribing over all presentations. We sometimes need
 these values (e.g. to show prescribing of X as a percentage of all prescribing)
 and they're slightly too expensive to calculate at runtime (45-60 seconds).
 
+We also calculate totals over every BNF chapter, section, paragraph and
+chemical so that queries for these don't need to sum thousands of matrices.
+
 The resulting matrices are the same shape as the rest of the matrices and thus
 contain individual totals for each practice and month.
 """
@@ -13,11 +16,19 @@ import sqlite3
 from matrixstore.connection import MatrixStore
 from matrixstore.matrix_ops import is_integer, convert_to_smallest_int_type
 from matrixstore.serializer import serialize_compressed
+from matrixstore.sql_functions import MatrixSumMany
 
 
 logger = logging.getLogger(__name__)
 
 
+# Lengths of the BNF code prefixes which identify chapters, sections,
+# paragraphs and chemicals respectively
+BNF_PREFIX_LENGTHS = (2, 4, 6, 9)
+
+BNF_PREFIX_TOTALS_COLUMNS = ["items", "quantity", "actual_cost"]
+
+
 def precalculate_totals(sqlite_path):
     if not os.path.exists(sqlite_path):
         raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
@@ -35,17 +46,18 @@ def precalculate_totals(sqlite_path):
 def precalculate_totals_for_db(connection):
     matrixstore = MatrixStore(connection)
     logger.info("Summing prescribing over all presentations")
-    values = matrixstore.query_one(
+    (values,) = matrixstore.query_one(
         """
         SELECT
-          MATRIX_SUM(items),
-          MATRIX_SUM(quantity),
-          MATRIX_SUM(actual_cost),
-          MATRIX_SUM(net_cost)
+          MATRIX_SUM_MANY(items, quantity, actual_cost, net_cost)
         FROM
           presentation
         WHERE
           items IS NOT NULL
+        -- Fix the order in which floating point values are summed so that
+        -- files with the same data get the same totals however they were built
+        ORDER BY
+          bnf_code
         """
     )
     logger.info("Writing precalculated totals to db")
@@ -66,6 +78,69 @@ def precalculate_totals_for_db(connection):
         list(map(prepare_matrix_value, values)),
     )
     cursor.execute("RELEASE update_totals")
+    precalculate_bnf_prefix_totals_for_db(connection)
+
+
+def precalculate_bnf_prefix_totals_for_db(connection):
+    matrixstore = MatrixStore(connection)
+    logger.info("Summing prescribing over BNF code prefixes")
+    cursor = connection.cursor()
+    cursor.execute("SAVEPOINT update_bnf_prefix_totals")
+    cursor.execute("DELETE FROM bnf_prefix_totals")
+    # Because presentations are sorted by BNF code, all the presentations
+    # sharing any given prefix arrive consecutively. So we just need one
+    # accumulator per prefix length, which we write out whenever the prefix
+    # changes. This way each matrix gets deserialized only once.
+    accumulators = {}
+    count = 0
+    results = matrixstore.query(
+        """
+        SELECT
+          bnf_code, {}
+        FROM
+          presentation
+        WHERE
+          items IS NOT NULL
+        ORDER BY
+          bnf_code
+        """.format(
+            ", ".join(BNF_PREFIX_TOTALS_COLUMNS)
+        )
+    )
+    for bnf_code, *matrices in results:
+        for length in BNF_PREFIX_LENGTHS:
+            # Codes which are too short don't belong to any prefix of this
+            # length
+            if len(bnf_code) < length:
+                continue
+            prefix = bnf_code[:length]
+            current = accumulators.get(length)
+            if current is None or current[0] != prefix:
+                if current is not None:
+                    write_bnf_prefix_total(cursor, *current)
+                    count += 1
+                current = (prefix, MatrixSumMany())
+                accumulators[length] = current
+            current[1].add(*matrices)
+    for current in accumulators.values():
+        write_bnf_prefix_total(cursor, *current)
+        count += 1
+    logger.info("Wrote totals for %s BNF code prefixes", count)
+    cursor.execute("RELEASE update_bnf_prefix_totals")
+
+
+def write_bnf_prefix_total(cursor, prefix, matrix_sum):
+    cursor.execute(
+        """
+        INSERT INTO
+          bnf_prefix_totals (bnf_code_prefix, {})
+        VALUES
+          (?, ?, ?, ?)
+        """.format(
+            ", ".join(BNF_PREFIX_TOTALS_COLUMNS)
+        ),
+        [prefix] + [prepare_matrix_value(m) for m in matrix_sum.value()],
+    )
 
 
 def prepare_matrix_value(matrix):
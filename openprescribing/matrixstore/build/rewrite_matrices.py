@@ -0,0 +1,59 @@
+"""
+Shared machinery for build stages which rewrite every serialized matrix in an
+existing SQLite file
+"""
+import logging
+
+from .group_by_org import GROUPED_ORG_TYPES, PRESCRIBING_COLUMNS
+from .import_prescribing import should_log_message
+
+
+logger = logging.getLogger(__name__)
+
+
+# Maps each table containing matrices to the column which identifies its rows
+# and the columns which contain matrices
+MATRIX_TABLES = {
+    "presentation": ("bnf_code", ["items", "quantity", "actual_cost", "net_cost"]),
+    "practice_statistic": ("name", ["value"]),
+    "all_presentations": ("rowid", ["items", "quantity", "actual_cost", "net_cost"]),
+    "bnf_prefix_totals": ("bnf_code_prefix", ["items", "quantity", "actual_cost"]),
+    "ppu_savings": ("savings_key", ["quantity", "net_cost", "target_ppu", "savings"]),
+}
+for org_type in GROUPED_ORG_TYPES:
+    MATRIX_TABLES["presentation_by_" + org_type] = ("bnf_code", PRESCRIBING_COLUMNS)
+    MATRIX_TABLES["all_presentations_by_" + org_type] = ("rowid", PRESCRIBING_COLUMNS)
+
+
+def rewrite_matrices(connection, transform, description):
+    """
+    Replace every non-NULL matrix BLOB in the database with the result of
+    calling `transform` on it
+    """
+    cursor = connection.cursor()
+    tables = {name for (name,) in cursor.execute("SELECT name FROM sqlite_master")}
+    for table, (key_column, matrix_columns) in MATRIX_TABLES.items():
+        # Files built by older versions may not have all tables
+        if table not in tables:
+            continue
+        keys = [
+            key
+            for (key,) in cursor.execute(
+                "SELECT {} FROM {}".format(key_column, table)
+            ).fetchall()
+        ]
+        logger.info("%s in %s (%s rows)", description, table, len(keys))
+        select_sql = "SELECT {} FROM {} WHERE {}=?".format(
+            ", ".join(matrix_columns), table, key_column
+        )
+        update_sql = "UPDATE {} SET {} WHERE {}=?".format(
+            table, ", ".join("{}=?".format(c) for c in matrix_columns), key_column
+        )
+        for n, key in enumerate(keys, start=1):
+            values = cursor.execute(select_sql, [key]).fetchone()
+            new_values = [
+                transform(value) if value is not None else None for value in values
+            ]
+            cursor.execute(update_sql, new_values + [key])
+            if should_log_message(n):
+                logger.info("%s: %s %s (%s/%s)", description, table, key, n, len(keys))
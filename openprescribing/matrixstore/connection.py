@@ -1,14 +1,32 @@
+from collections import OrderedDict
 import os.path
 import sqlite3
+import threading
 import urllib.parse
 
-from .serializer import deserialize
-from .sql_functions import MatrixSum
+from .matrix_ops import get_memory_usage
+from .serializer import deserialize, deserialize_columns
+from .sql_functions import (
+    MatrixRowGroupSum,
+    MatrixSum,
+    MatrixSumMany,
+    matrix_nnz,
+    matrix_sum_cols,
+)
+
+
+# The columns in the `presentation` table which contain serialized matrices
+PRESENTATION_MATRIX_COLUMNS = ("items", "quantity", "actual_cost", "net_cost")
+
+MISSING = object()
 
 
 class MatrixStore(object):
-    def __init__(self, sqlite_connection, filename=":memory:"):
+    def __init__(self, sqlite_connection, filename=":memory:", matrix_cache=None):
         self.connection = sqlite_connection
+        # Optional `MatrixCache` instance in which to keep deserialized
+        # matrices fetched via `query_presentations`
+        self.matrix_cache = matrix_cache
         # `cache_key` attributes are used to identify the state of an object for
         # caching purposes. Because we create MatrixStore files with unique
         # names, and because they are immutable once created, we can simply use
@@ -29,9 +47,15 @@ class MatrixStore(object):
         self.dates = sorted_keys(self.date_offsets)
         self.practices = sorted_keys(self.practice_offsets)
         self.connection.create_aggregate("MATRIX_SUM", 1, MatrixSum)
+        self.connection.create_aggregate("MATRIX_SUM_MANY", -1, MatrixSumMany)
+        self.connection.create_function("MATRIX_SUM_COLS", 3, matrix_sum_cols)
+        self.connection.create_function("MATRIX_NNZ", 1, matrix_nnz)
+        self._row_group_sum = MatrixRowGroupSum()
+        self.connection.create_function("MATRIX_ROW_GROUP_SUM", 2, self._row_group_sum)
+        self._org_offsets = {}
 
     @classmethod
-    def from_file(cls, path):
+    def from_file(cls, path, matrix_cache=None):
         if not os.path.exists(path):
             raise RuntimeError("No SQLite file at: " + path)
         encoded_path = urllib.parse.quote(os.path.abspath(path))
@@ -51,7 +75,7 @@ class MatrixStore(object):
         # These files are generated with unique names which we can use as part
         # of a cache key
         filename = os.path.basename(os.path.realpath(path))
-        return cls(connection, filename=filename)
+        return cls(connection, filename=filename, matrix_cache=matrix_cache)
 
     def query(self, sql, params=()):
         for row in self.connection.cursor().execute(sql, params):
@@ -60,10 +84,216 @@ class MatrixStore(object):
     def query_one(self, sql, params=()):
         return next(self.query(sql, params=params))
 
+    def query_columns(self, sql, params=(), cols=slice(None, None)):
+        """
+        As `query` but returns just the matrix columns (i.e. dates) selected by
+        the slice `cols`
+
+        For files built with the `--chunk-by-date` option this avoids
+        decompressing and deserializing the columns we don't need.
+        """
+        for row in self.connection.cursor().execute(sql, params):
+            yield [convert_value_columns(value, cols) for value in row]
+
+    def query_presentations(self, bnf_codes, columns, cols=None):
+        """
+        Yield tuples of the form:
+
+            bnf_code, matrix_for_column_1, matrix_for_column_2, ...
+
+        for each of the supplied BNF codes which exists in the `presentation`
+        table, sorted by BNF code
+
+        If `cols` is supplied then only the matrix columns (i.e. dates)
+        selected by that slice are returned (see `query_columns`).
+
+        Where this instance has a `matrix_cache` we serve as many matrices as
+        possible from there, and only query SQLite for the remainder. Note
+        that matrices returned from the cache are shared between callers and
+        so must not be modified in place.
+        """
+        for column in columns:
+            if column not in PRESENTATION_MATRIX_COLUMNS:
+                raise ValueError("Not a matrix column: {}".format(column))
+        bnf_codes = sorted(set(bnf_codes))
+        if self.matrix_cache is None:
+            return self._query_presentations(bnf_codes, columns, cols)
+        else:
+            return self._query_presentations_with_cache(bnf_codes, columns, cols)
+
+    def _query_presentations(self, bnf_codes, columns, cols):
+        sql = """
+            SELECT bnf_code, {} FROM presentation WHERE bnf_code IN ({})
+            ORDER BY bnf_code
+            """.format(
+            ", ".join(columns), ",".join("?" * len(bnf_codes))
+        )
+        if cols is None:
+            return self.query(sql, bnf_codes)
+        else:
+            return self.query_columns(sql, bnf_codes, cols=cols)
+
+    def _query_presentations_with_cache(self, bnf_codes, columns, cols):
+        cache = self.matrix_cache
+        cached = {}
+        uncached_codes = []
+        for bnf_code in bnf_codes:
+            values = [
+                cache.get(self._matrix_cache_key(bnf_code, column, cols))
+                for column in columns
+            ]
+            if any(value is MISSING for value in values):
+                uncached_codes.append(bnf_code)
+            else:
+                cached[bnf_code] = values
+        if uncached_codes:
+            for bnf_code, *values in self._query_presentations(
+                uncached_codes, columns, cols
+            ):
+                for column, value in zip(columns, values):
+                    cache.set(self._matrix_cache_key(bnf_code, column, cols), value)
+                cached[bnf_code] = values
+        for bnf_code in sorted(cached):
+            yield [bnf_code] + cached[bnf_code]
+
+    def _matrix_cache_key(self, bnf_code, column, cols):
+        key = (self.cache_key, "presentation", bnf_code, column)
+        # Column-sliced matrices are cached separately from the full matrices.
+        # (Slices themselves aren't hashable so we convert them to tuples.)
+        if cols is not None:
+            key += ((cols.start, cols.stop),)
+        return key
+
+    def has_table(self, name):
+        """
+        Return whether the file contains the named table (files built by older
+        versions of the build process may be missing some tables)
+        """
+        result = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", [name]
+        )
+        return result.fetchone() is not None
+
+    def register_row_grouper(self, row_grouper):
+        """
+        Return the ID by which `row_grouper` can be referred to in calls to the
+        `MATRIX_ROW_GROUP_SUM` SQL function
+        """
+        return self._row_group_sum.register(row_grouper)
+
+    def get_org_offsets(self, org_type):
+        """
+        Return a dict mapping the IDs of organisations of type `org_type` to
+        their row offsets within the matrices in the `presentation_by_<org_type>`
+        and `all_presentations_by_<org_type>` tables, or None if the file
+        doesn't contain data grouped by this org type
+        """
+        try:
+            return self._org_offsets[org_type]
+        except KeyError:
+            pass
+        offsets = None
+        if self.has_table("org_offset"):
+            offsets = dict(
+                self.connection.execute(
+                    "SELECT org_id, offset FROM org_offset WHERE org_type=?",
+                    [org_type],
+                )
+            )
+        self._org_offsets[org_type] = offsets or None
+        return self._org_offsets[org_type]
+
     def close(self):
         self.connection.close()
 
 
+class MatrixCache(object):
+    """
+    A least-recently-used cache for deserialized matrices whose size is
+    bounded by the total number of bytes the matrices occupy in memory, rather
+    than by the number of entries
+
+    Deserializing (and decompressing) the same matrices over and over again is
+    one of the more expensive things we do at request time and many pages
+    repeatedly touch the same few hundred presentations, so it's worth keeping
+    recently used matrices around. Each process gets its own instance (see
+    `matrixstore.db`) and keys should include the `cache_key` of the
+    MatrixStore they came from so that entries from different files never get
+    confused.
+
+    A `max_bytes` of zero means nothing ever gets stored.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the value stored under `key` or `MISSING` if there isn't one
+        """
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = get_memory_usage(value)
+        # There's no sense evicting everything else to make room for a single
+        # value which won't fit anyway
+        if size > self.max_bytes:
+            return
+        make_read_only(value)
+        with self._lock:
+            existing = self._entries.pop(key, None)
+            if existing is not None:
+                self.current_bytes -= existing[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "current_bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def make_read_only(matrix):
+    """
+    Mark the arrays underlying a matrix as read-only so that any attempt to
+    modify a shared, cached matrix in place fails loudly
+    """
+    if hasattr(matrix, "data") and hasattr(matrix, "indices"):
+        arrays = (matrix.data, matrix.indices, matrix.indptr)
+    else:
+        arrays = (matrix,)
+    for array in arrays:
+        array.flags.writeable = False
+
+
 def sorted_keys(dictionary):
     sorted_items = sorted(dictionary.items(), key=lambda item: item[1])
     return [key for (key, value) in sorted_items]
@@ -78,3 +308,10 @@ def convert_value(value):
         return deserialize(value)
     else:
         return value
+
+
+def convert_value_columns(value, cols):
+    if isinstance(value, (bytes, memoryview)):
+        return deserialize_columns(value, cols)
+    else:
+        return value
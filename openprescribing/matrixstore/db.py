@@ -2,31 +2,231 @@
 This module provides the primary interface between the MatrixStore and the rest
 of the application.
 
-It makes use of the assumption that data is static throughout the runtime of
-the application and therefore any data imports or updates will require an
-application restart before they take effect.
+MatrixStore files are immutable, so we can keep a single open connection to
+the live file for the lifetime of the process. When the live symlink is
+updated to point at a new file (see `matrixstore_set_live`) each process
+notices this within `settings.MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL` seconds,
+opens and warms the new file, and then swaps it in. Each request sees a single
+consistent file for its whole duration (see `LiveMatrixStore.pin`), so
+requests which are in flight during the swap finish using the old file.
+
+Note that data derived from Postgres (e.g. org membership) is still only
+loaded when a file is first opened, so changes to it won't be seen until the
+next file is made live or the application is restarted.
 """
+import functools
+import logging
+import os.path
+import threading
+import time
+import weakref
+
 from django.conf import settings
+from django.core.signals import request_finished, request_started
 from django.utils.lru_cache import lru_cache
 
 from frontend.models import Practice
 
-from .connection import MatrixStore
+from .connection import MatrixStore, MatrixCache
 from .row_grouper import RowGrouper
 
 
+logger = logging.getLogger(__name__)
+
+
 # Create a memoize decorator (i.e. a decorator which caches the return value
 # for a given set of arguments). Here `maxsize=None` means "don't apply any
 # cache eviction, just keep values for ever"
 memoize = lru_cache(maxsize=None)
 
 
-@memoize
+# Org types for which we build row groupers before swapping in a new file, so
+# that the first requests to use it don't have to
+WARM_ORG_TYPES = ("practice", "ccg", "pcn", "stp", "regional_team")
+
+
+class LiveMatrixStore(object):
+    """
+    Holds the MatrixStore instance for the file which
+    `settings.MATRIXSTORE_LIVE_FILE` points to, replacing it whenever the
+    symlink changes
+    """
+
+    def __init__(self):
+        self.db = None
+        # The resolved path of the file `db` was opened from
+        self.target = None
+        self.last_checked = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self):
+        """
+        Return the MatrixStore pinned to the current thread if there is one,
+        otherwise the most recent live MatrixStore
+        """
+        local = self._local
+        if not getattr(local, "pinned", False):
+            return self.get_latest()
+        if local.db is None:
+            local.db = self.get_latest()
+        return local.db
+
+    def get_latest(self):
+        if self.db is None:
+            # Nothing to fall back to, so every thread has to wait for the
+            # first file to be opened. We don't warm this one as there are no
+            # requests waiting on it yet.
+            with self._lock:
+                if self.db is None:
+                    target = os.path.realpath(self.path)
+                    self._swap(self._open(target), target)
+        elif self._should_check():
+            self._check_for_update()
+        return self.db
+
+    def pin(self):
+        """
+        Make `get` return the same MatrixStore in this thread until `unpin` is
+        called, regardless of any changes to the live file in the meantime
+
+        The file isn't actually opened until it's first needed.
+        """
+        self._local.pinned = True
+        self._local.db = None
+
+    def unpin(self):
+        self._local.pinned = False
+        self._local.db = None
+
+    def reset(self):
+        with self._lock:
+            self.db = None
+            self.target = None
+            self.last_checked = None
+        self.unpin()
+
+    @property
+    def path(self):
+        return settings.MATRIXSTORE_LIVE_FILE
+
+    def _should_check(self):
+        interval = settings.MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL
+        return time.monotonic() - self.last_checked >= interval
+
+    def _check_for_update(self):
+        # If another thread is already checking (or opening a new file) then we
+        # just carry on using the current file
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self.last_checked = time.monotonic()
+            target = os.path.realpath(self.path)
+            if target == self.target:
+                return
+            logger.info("Live MatrixStore changed to %s", target)
+            try:
+                db = self._open(target)
+                self._warm(db)
+            except Exception:
+                # Keep serving the current file rather than failing requests,
+                # and try again after the next interval
+                logger.exception("Failed to open new MatrixStore %s", target)
+                return
+            self._swap(db, target)
+        finally:
+            self._lock.release()
+
+    def _open(self, target):
+        # We open the resolved path, rather than the symlink, so that we know
+        # exactly which file we've got even if the symlink changes again
+        return MatrixStore.from_file(target, matrix_cache=get_matrix_cache())
+
+    def _warm(self, db):
+        # Temporarily pin the new file to this thread so that everything gets
+        # built against it, rather than against the current file
+        local = self._local
+        previous = getattr(local, "pinned", False), getattr(local, "db", None)
+        local.pinned, local.db = True, db
+        try:
+            warm_db()
+        finally:
+            local.pinned, local.db = previous
+
+    def _swap(self, db, target):
+        # We never explicitly close the old file: any requests still using it
+        # hold references to it, and the connection gets closed when the last
+        # of these goes away
+        self.db = db
+        self.target = target
+        self.last_checked = time.monotonic()
+
+
+live_db = LiveMatrixStore()
+
+
 def get_db():
     """
-    Return a singleton instance of the current live version of the MatrixStore
+    Return the current live version of the MatrixStore
+    """
+    return live_db.get()
+
+
+def pin_db_for_request(sender, **kwargs):
+    live_db.pin()
+
+
+def unpin_db_for_request(sender, **kwargs):
+    live_db.unpin()
+
+
+request_started.connect(pin_db_for_request, dispatch_uid="matrixstore_pin_db")
+request_finished.connect(unpin_db_for_request, dispatch_uid="matrixstore_unpin_db")
+
+
+def memoize_per_db(fn):
+    """
+    As `memoize`, but for functions whose results depend on the contents of
+    the live MatrixStore. Results are cached separately for each MatrixStore
+    instance and are discarded along with it, so they get recalculated when a
+    new file goes live.
+    """
+    caches = weakref.WeakKeyDictionary()
+    lock = threading.Lock()
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        db = get_db()
+        with lock:
+            cache = caches.setdefault(db, {})
+        try:
+            return cache[args]
+        except KeyError:
+            pass
+        value = fn(*args)
+        cache[args] = value
+        return value
+
+    wrapper.cache_clear = caches.clear
+    return wrapper
+
+
+def warm_db():
+    """
+    Build the row groupers for the most commonly used org types
+    """
+    for org_type in WARM_ORG_TYPES:
+        get_row_grouper(org_type)
+
+
+@memoize
+def get_matrix_cache():
+    """
+    Return the per-process cache of deserialized matrices, or None if caching
+    is disabled
     """
-    return MatrixStore.from_file(settings.MATRIXSTORE_LIVE_FILE)
+    max_bytes = settings.MATRIXSTORE_MATRIX_CACHE_SIZE
+    return MatrixCache(max_bytes) if max_bytes > 0 else None
 
 
 def org_has_prescribing(org_type, org_id):
@@ -44,42 +244,49 @@ def latest_prescribing_date():
     return get_db().dates[-1]
 
 
-@memoize
+@memoize_per_db
 def get_row_grouper(org_type):
     """
     Return a "row grouper" function which will group the rows of a practice
     level matrix by the supplied `org_type`
 
     Note that the function is memoized so that if org relationships are changed
-    in the database then the application will need to be restarted to see the
-    changes.
+    in the database then these changes won't be seen until a new MatrixStore
+    file goes live (or the application is restarted).
+    """
+    mapping = get_org_mapping(org_type)
+    return RowGrouper(
+        (offset, mapping[practice_code])
+        for practice_code, offset in get_db().practice_offsets.items()
+        if practice_code in mapping
+    )
+
+
+def get_org_mapping(org_type):
+    """
+    Return a dict mapping practice codes to the IDs of the groups of the
+    supplied `org_type` to which they belong
     """
-    # Get the mapping from practice codes to IDs of groups
     if org_type == "practice":
-        mapping = _practice_to_practice_map()
+        return _practice_to_practice_map()
     elif org_type == "standard_practice":
-        mapping = _practice_to_standard_practice_map()
+        return _practice_to_standard_practice_map()
     elif org_type == "ccg":
-        mapping = _practice_to_ccg_map()
+        return _practice_to_ccg_map()
     elif org_type == "standard_ccg":
-        mapping = _standard_practice_to_ccg_map()
+        return _standard_practice_to_ccg_map()
     elif org_type == "pcn":
-        mapping = _practice_to_pcn_map()
+        return _practice_to_pcn_map()
     elif org_type == "stp":
-        mapping = _practice_to_stp_map()
+        return _practice_to_stp_map()
     elif org_type == "regional_team":
-        mapping = _practice_to_regional_team_map()
+        return _practice_to_regional_team_map()
     elif org_type == "all_practices":
-        mapping = _group_all(_practice_to_practice_map())
+        return _group_all(_practice_to_practice_map())
     elif org_type == "all_standard_practices":
-        mapping = _group_all(_practice_to_standard_practice_map())
+        return _group_all(_practice_to_standard_practice_map())
     else:
         raise ValueError("Unhandled org_type: " + org_type)
-    return RowGrouper(
-        (offset, mapping[practice_code])
-        for practice_code, offset in get_db().practice_offsets.items()
-        if practice_code in mapping
-    )
 
 
 def _practice_to_practice_map():
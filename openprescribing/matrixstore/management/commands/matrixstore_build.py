@@ -16,8 +16,14 @@ from matrixstore.build.download_practice_stats import download_practice_stats
 from matrixstore.build.import_practice_stats import import_practice_stats
 from matrixstore.build.download_prescribing import download_prescribing
 from matrixstore.build.import_prescribing import import_prescribing
+from matrixstore.build.append_month import append_month
 from matrixstore.build.update_bnf_map import update_bnf_map
 from matrixstore.build.precalculate_totals import precalculate_totals
+from matrixstore.build.precalculate_savings import (
+    precalculate_savings as precalculate_ppu_savings,
+)
+from matrixstore.build.group_by_org import group_by_org as group_matrices_by_org
+from matrixstore.build.chunk_matrices_by_date import chunk_matrices_by_date
 from matrixstore.build.generate_filename import generate_filename
 
 
@@ -39,11 +45,68 @@ class Command(BaseCommand):
         parser.add_argument(
             "--quiet", help="Don't emit logging output", action="store_true"
         )
+        parser.add_argument(
+            "--chunk-by-date",
+            help=(
+                "Compress each date column of each matrix separately so that "
+                "single months can be read cheaply (produces a larger file)"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--group-by-org",
+            help=(
+                "Also store copies of the prescribing data grouped by CCG, PCN, "
+                "STP and regional team, using the current org structure"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--precalculate-savings",
+            help=(
+                "Also calculate price-per-unit savings for every month, using "
+                "the current org structure"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--workers",
+            help="Number of processes to use when building matrices (default: 1)",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--incremental",
+            help=(
+                "Build by adding the new month's data to the current live file "
+                "(MATRIXSTORE_LIVE_FILE) rather than importing every month"
+            ),
+            action="store_true",
+        )
 
-    def handle(self, end_date, months=None, quiet=False, **kwargs):
+    def handle(
+        self,
+        end_date,
+        months=None,
+        quiet=False,
+        chunk_by_date=False,
+        group_by_org=False,
+        precalculate_savings=False,
+        workers=1,
+        incremental=False,
+        **kwargs
+    ):
         log_level = "INFO" if not quiet else "ERROR"
         with LogToStream("matrixstore", self.stdout, log_level):
-            return build(end_date, months=months)
+            return build(
+                end_date,
+                months=months,
+                chunk_by_date=chunk_by_date,
+                group_by_org=group_by_org,
+                precalculate_savings=precalculate_savings,
+                workers=workers,
+                incremental=incremental,
+            )
 
 
 class LogToStream(object):
@@ -73,16 +136,37 @@ class LogToStream(object):
         self.logger.removeHandler(self.handler)
 
 
-def build(end_date, months=None):
+def build(
+    end_date,
+    months=None,
+    chunk_by_date=False,
+    group_by_org=False,
+    precalculate_savings=False,
+    workers=1,
+    incremental=False,
+):
     directory = settings.MATRIXSTORE_BUILD_DIR
     sqlite_temp = get_temp_filename(os.path.join(directory, "matrixstore.sqlite"))
     init_db(end_date, sqlite_temp, months=months)
-    download_practice_stats(end_date, months=months)
-    import_practice_stats(sqlite_temp)
-    download_prescribing(end_date, months=months)
-    import_prescribing(sqlite_temp)
+    if incremental:
+        # We only need to download the latest month, everything else comes
+        # from the current live file
+        download_practice_stats(end_date, months=1)
+        download_prescribing(end_date, months=1)
+        append_month(settings.MATRIXSTORE_LIVE_FILE, sqlite_temp, workers=workers)
+    else:
+        download_practice_stats(end_date, months=months)
+        import_practice_stats(sqlite_temp)
+        download_prescribing(end_date, months=months)
+        import_prescribing(sqlite_temp, workers=workers)
     update_bnf_map(sqlite_temp)
     precalculate_totals(sqlite_temp)
+    if precalculate_savings:
+        precalculate_ppu_savings(sqlite_temp)
+    if group_by_org:
+        group_matrices_by_org(sqlite_temp)
+    if chunk_by_date:
+        chunk_matrices_by_date(sqlite_temp)
     vacuum_database(sqlite_temp)
     basename = generate_filename(sqlite_temp)
     filename = os.path.join(directory, basename)
@@ -0,0 +1,52 @@
+"""
+Converts an existing MatrixStore file in `MATRIXSTORE_BUILD_DIR` so that its
+matrices use the current serialization format, writing the result as a new
+file alongside the original (which is left untouched)
+"""
+import logging
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from matrixstore.build.common import get_temp_filename
+from matrixstore.build.convert_format import convert_format
+from matrixstore.build.generate_filename import generate_filename
+
+from .matrixstore_build import LogToStream, vacuum_database
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("filename", help="Name of file in MATRIXSTORE_BUILD_DIR")
+        parser.add_argument(
+            "--quiet", help="Don't emit logging output", action="store_true"
+        )
+
+    def handle(self, filename, quiet=False, **kwargs):
+        log_level = "INFO" if not quiet else "ERROR"
+        with LogToStream("matrixstore", self.stdout, log_level):
+            return convert(filename)
+
+
+def convert(filename):
+    directory = settings.MATRIXSTORE_BUILD_DIR
+    source_file = os.path.join(directory, filename)
+    if not os.path.exists(source_file):
+        raise RuntimeError("No such file: {}".format(source_file))
+    sqlite_temp = get_temp_filename(os.path.join(directory, "matrixstore.sqlite"))
+    logger.info("Copying %s", source_file)
+    shutil.copyfile(source_file, sqlite_temp)
+    convert_format(sqlite_temp)
+    vacuum_database(sqlite_temp)
+    basename = generate_filename(sqlite_temp)
+    new_filename = os.path.join(directory, basename)
+    logger.info("Moving file to final location: %s", new_filename)
+    os.rename(sqlite_temp, new_filename)
+    return new_filename
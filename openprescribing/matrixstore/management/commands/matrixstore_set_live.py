@@ -45,8 +45,9 @@ class Command(BaseCommand):
         os.symlink(target_file, temp_file)
         os.rename(temp_file, symlink)
         self.stdout.write(
-            "NOTE: You will need to restart the application in order for this "
-            "change to take effect"
+            "Running processes will switch to the new file within {} seconds".format(
+                settings.MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL
+            )
         )
 
 
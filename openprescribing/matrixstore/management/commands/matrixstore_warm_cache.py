@@ -0,0 +1,171 @@
+"""
+Populates the cache used by `matrixstore.cachelib.memoize` with the
+price-per-unit savings and ghost-branded generics data for the latest month of
+the live MatrixStore, so that the first visitors after a data load don't have
+to wait for it to be calculated
+
+Work is split by org type (for savings over all substitution sets) and by
+substitution set, and can be spread across multiple processes using the
+`--workers` option.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+
+from django import db as django_db
+from django.core.management import BaseCommand
+
+from frontend.ghost_branded_generics import (
+    MIN_GHOST_GENERIC_DELTA,
+    PRESENTATIONS_TO_IGNORE,
+    get_ghost_branded_generic_spending_for_org_type,
+    get_inferred_tariff_prices,
+    get_total_ghost_branded_generic_spending_per_practice,
+)
+from frontend.price_per_unit.savings import (
+    CONFIG_MIN_SAVINGS_FOR_ORG_TYPE,
+    get_quantities_and_net_costs_at_date,
+    get_total_savings_for_all_orgs,
+)
+from frontend.price_per_unit.substitution_sets import get_substitution_sets
+from matrixstore.db import get_db, get_row_grouper, live_db
+
+from .matrixstore_build import LogToStream
+
+
+logger = logging.getLogger(__name__)
+
+
+# Number of substitution sets handled by each task. Small enough that work is
+# spread evenly between workers, large enough that the overhead is negligible.
+SUBSTITUTION_SETS_PER_TASK = 50
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--date",
+            help="Month to warm (YYYY-MM format, default: latest month of data)",
+        )
+        parser.add_argument(
+            "--workers",
+            help="Number of processes to use (default: 1)",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--quiet", help="Don't emit logging output", action="store_true"
+        )
+
+    def handle(self, date=None, workers=1, quiet=False, **kwargs):
+        log_level = "INFO" if not quiet else "ERROR"
+        with LogToStream("matrixstore", self.stdout, log_level):
+            warm_cache(date=date, workers=workers)
+
+
+def warm_cache(date=None, workers=1):
+    # This may be run in the same process which has just updated the live
+    # file, so make sure we're looking at the current version
+    live_db.reset()
+    db = get_db()
+    if date is None:
+        date = db.dates[-1]
+    else:
+        date = date.replace("_", "-") + "-01"
+    if date not in db.date_offsets:
+        raise RuntimeError("No data for {} in live MatrixStore".format(date))
+    generic_codes = sorted(get_substitution_sets().keys())
+    logger.info(
+        "Warming cache for %s (%s substitution sets, %s workers)",
+        date,
+        len(generic_codes),
+        workers,
+    )
+    # Savings for every substitution set and org (from which the totals are
+    # calculated) are the slowest to calculate, so we start on these first.
+    # The quantities and costs for individual substitution sets are used by the
+    # pages for individual presentations.
+    tasks = [
+        ("total savings by {}".format(org_type), warm_total_savings, (date, org_type))
+        for org_type in CONFIG_MIN_SAVINGS_FOR_ORG_TYPE
+    ]
+    tasks.extend(
+        (
+            "substitution sets {}-{}".format(n + 1, n + len(chunk)),
+            warm_substitution_sets,
+            (date, chunk),
+        )
+        for n, chunk in chunked(generic_codes, SUBSTITUTION_SETS_PER_TASK)
+    )
+    tasks.append(("ghost-branded generics", warm_ghost_branded_generics, (date,)))
+    run_tasks(tasks, workers)
+    logger.info("Finished warming cache for %s", date)
+
+
+def chunked(items, size):
+    for n in range(0, len(items), size):
+        yield n, items[n : n + size]
+
+
+def run_tasks(tasks, workers):
+    """
+    Run each `(description, function, args)` task, using a pool of `workers`
+    processes if there is more than one
+    """
+    if workers == 1:
+        for n, (description, function, args) in enumerate(tasks, start=1):
+            function(*args)
+            logger.info("Warmed %s (%s/%s)", description, n, len(tasks))
+        return
+    # Worker processes are forked from this one and mustn't share its database
+    # connection
+    django_db.connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initialise_worker
+    ) as executor:
+        futures = {
+            executor.submit(function, *args): description
+            for (description, function, args) in tasks
+        }
+        for n, future in enumerate(as_completed(futures), start=1):
+            future.result()
+            logger.info("Warmed %s (%s/%s)", futures[future], n, len(tasks))
+
+
+def initialise_worker():
+    # Likewise each worker opens its own connection to the MatrixStore, rather
+    # than using the one it inherited
+    live_db.reset()
+
+
+def warm_substitution_sets(date, generic_codes):
+    db = get_db()
+    substitution_sets = get_substitution_sets()
+    for generic_code in generic_codes:
+        get_quantities_and_net_costs_at_date(db, substitution_sets[generic_code], date)
+
+
+def warm_ghost_branded_generics(date):
+    db = get_db()
+    # There are no prices to compare against if we don't have any tariff data
+    # for this month, in which case there's nothing to cache
+    if not get_inferred_tariff_prices(db, date, PRESENTATIONS_TO_IGNORE):
+        logger.warning("No inferred tariff prices for %s", date)
+        return
+    get_total_ghost_branded_generic_spending_per_practice(
+        db, date, PRESENTATIONS_TO_IGNORE, MIN_GHOST_GENERIC_DELTA
+    )
+    # These are the org types used by the ghost-branded generics API
+    for org_type in ["practice", "ccg"]:
+        get_ghost_branded_generic_spending_for_org_type(
+            db,
+            date,
+            get_row_grouper(org_type),
+            PRESENTATIONS_TO_IGNORE,
+            MIN_GHOST_GENERIC_DELTA,
+        )
+
+
+def warm_total_savings(date, org_type):
+    get_total_savings_for_all_orgs(date, org_type)
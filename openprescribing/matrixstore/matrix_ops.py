@@ -13,6 +13,39 @@ def sparse_matrix(shape, integer=False):
     return scipy.sparse.lil_matrix(shape, dtype=dtype)
 
 
+def sparse_matrix_from_coordinates(shape, rows, cols, values, integer=False):
+    """
+    Create a new sparse matrix (either integer or floating point) from
+    sequences of row offsets, column offsets and values, in a form suitable for
+    passing to `finalise_matrix`
+
+    The sequences may be anything numpy can convert to an array (we use
+    `array.array` instances when building). Each (row, column) pair must
+    appear at most once: converting to CSC format would otherwise sum their
+    values, so we raise a ValueError instead.
+
+    This is much faster than assigning values one at a time to the matrix
+    returned by `sparse_matrix`.
+    """
+    dtype = numpy.int_ if integer else numpy.float_
+    values = numpy.asarray(values).astype(dtype, copy=False)
+    matrix = scipy.sparse.coo_matrix(
+        (values, (numpy.asarray(rows), numpy.asarray(cols))), shape=shape
+    ).tocsc()
+    # Conversion sums the values of any duplicate coordinates into a single
+    # entry, so we can detect them without sorting the coordinates ourselves
+    if matrix.nnz != len(values):
+        raise ValueError(
+            "Duplicate coordinates: {} values for {} distinct cells".format(
+                len(values), matrix.nnz
+            )
+        )
+    # Assigning zero to a cell of a `lil_matrix` leaves it empty, so we remove
+    # any explicit zeros to give identical results
+    matrix.eliminate_zeros()
+    return matrix
+
+
 def finalise_matrix(matrix):
     """
     Return a copy of a sparse matrix in a form suitable for storage
@@ -61,6 +94,16 @@ def convert_to_dense_if_smaller(matrix):
         return matrix
 
 
+def get_memory_usage(matrix):
+    """
+    Return the number of bytes used to store a matrix, whether sparse or dense
+    """
+    if isinstance(matrix, numpy.ndarray):
+        return matrix.nbytes
+    else:
+        return get_sparse_memory_usage(matrix)
+
+
 def get_sparse_memory_usage(matrix):
     """
     Return the number of bytes need to store a sparse matrix
@@ -148,3 +191,55 @@ def get_submatrix(matrix, rows=slice(None, None), cols=slice(None, None)):
     new_matrix.indptr = indptr
     new_matrix._shape = shape
     return new_matrix
+
+
+def nanpercentile_by_column(matrix, q, interpolation="linear"):
+    """
+    Return an array giving the `q`th percentile of each column of `matrix`,
+    ignoring NaNs
+
+    This gives exactly the same results as:
+
+        numpy.nanpercentile(matrix, q, axis=0, interpolation=interpolation)
+
+    but is faster (especially for many small columns) as it avoids numpy's
+    per-column Python overhead and copying of the non-NaN values. Only "linear"
+    and "lower" interpolation are supported.
+    """
+    if interpolation not in ("linear", "lower"):
+        raise ValueError("Unsupported interpolation: {}".format(interpolation))
+    # We work on a column-major copy so that each column is contiguous. NaNs
+    # sort after infinity, so replacing them with infinity leaves the order of
+    # the remaining values (and hence the result) unchanged.
+    matrix = numpy.array(matrix, dtype=numpy.float_, order="F")
+    # Every column is empty, and there are no values to index into below
+    if matrix.shape[0] == 0:
+        return numpy.full(matrix.shape[1], numpy.nan)
+    nans = numpy.isnan(matrix)
+    numpy.copyto(matrix, numpy.inf, where=nans)
+    counts = matrix.shape[0] - numpy.count_nonzero(nans, axis=0)
+    # Columns with no values get NaN, but we calculate a (meaningless) result
+    # for them along with everything else to keep things simple
+    empty = counts == 0
+    counts[empty] = 1
+    # Replicate numpy's arithmetic exactly so the results are identical
+    ranks = (q / 100) * (counts - 1)
+    below = numpy.floor(ranks).astype(numpy.intp)
+    above = below if interpolation == "lower" else numpy.minimum(below + 1, counts - 1)
+    for column, kth in zip(matrix.T, zip(below, above)):
+        column.partition(kth)
+    columns = numpy.arange(matrix.shape[1])
+    if interpolation == "lower":
+        result = matrix[below, columns]
+    else:
+        weights_above = ranks - below
+        weights_below = 1 - weights_above
+        # Infinite values multiplied by zero weights give NaN, as they do in
+        # numpy's implementation
+        with numpy.errstate(invalid="ignore"):
+            result = (
+                matrix[below, columns] * weights_below
+                + matrix[above, columns] * weights_above
+            )
+    result[empty] = numpy.nan
+    return result
@@ -4,6 +4,8 @@ import hashlib
 import numpy
 import scipy.sparse
 
+from matrixstore.matrix_ops import is_integer
+
 
 class RowGrouper(object):
     """
@@ -65,6 +67,19 @@ class RowGrouper(object):
             )
         else:
             self._single_row_groups_selector = None
+        # In the general case we sum groups by multiplying with a "grouping
+        # matrix" which has a row for each group and a 1 in every column which
+        # corresponds to a member of that group. We store it in CSR form, but
+        # don't know how many columns it needs until we see a matrix, so we
+        # just keep its `indices` and `indptr` arrays here.
+        group_sizes = [len(rows) for rows in self._group_selectors.values()]
+        self._grouping_indptr = numpy.concatenate([[0], numpy.cumsum(group_sizes)])
+        self._grouping_indices = numpy.array(
+            [row for rows in self._group_selectors.values() for row in rows],
+            dtype=numpy.int_,
+        )
+        # Maps (number of rows, dtype) pairs to grouping matrices
+        self._grouping_matrices = {}
         # `cache_key` is used to identify the state of this RowGrouper for
         # caching purposes i.e.  RowGrouper instances should have the same
         # cache_key if and only if they have same group configuration
@@ -96,35 +111,44 @@ class RowGrouper(object):
                 )
                 return matrix[row_selector]
 
-        # If we can't take the fast path then build a list of row selectors for
-        # each group we want
+        # Otherwise we do all the summing in a single sparse matrix product
+        grouping_matrix = self._get_grouping_matrix(matrix)
         if group_ids is not None:
-            row_selectors = [self._group_selectors[group_id] for group_id in group_ids]
+            group_offsets = [self.offsets[group_id] for group_id in group_ids]
+            grouping_matrix = grouping_matrix[group_offsets]
+        grouped_output = grouping_matrix @ matrix
+        # We always want to return an `ndarray` even if the input is sparse or
+        # of `matrix` type. See the `is_matrix` docstring for more detail.
+        if scipy.sparse.issparse(grouped_output):
+            return grouped_output.toarray()
         else:
-            row_selectors = self._group_selectors.values()
-
-        # Initialise an array to contain the output
-        rows = len(row_selectors)
-        columns = matrix.shape[1]
-        grouped_output = numpy.empty((rows, columns), dtype=matrix.dtype)
-
-        # This is awkward. We always want to return an `ndarray` even if the
-        # input type is `matrix`. But where the input is a `matrix` the `out`
-        # argument to `numpy.sum` below must be a `matrix` also. So we need a
-        # view on our output array which matches the type of the input array,
-        # while leaving the actual `grouped_output` return value always of type
-        # `ndarray`.  See the `is_matrix` docstring for more detail.
-        if is_matrix(matrix):
-            output_view = numpy.asmatrix(grouped_output)
-        else:
-            output_view = grouped_output
-
-        for row_offset, row_selector in enumerate(row_selectors):
-            # Get the rows to be summed
-            row_group = matrix[row_selector]
-            # Sum them and write the result into the output array
-            numpy.sum(row_group, axis=0, out=output_view[row_offset])
-        return grouped_output
+            return numpy.asarray(grouped_output)
+
+    def _get_grouping_matrix(self, matrix):
+        """
+        Return a grouping matrix which can be multiplied by `matrix`
+
+        Integer matrices get an integer grouping matrix and so produce integer
+        output. Note that this uses the largest integer type (int_) regardless
+        of the type of `matrix`, so that we don't overflow when summing matrices
+        stored using smaller types (e.g. uint8).
+        """
+        dtype = numpy.int_ if is_integer(matrix) else numpy.float_
+        key = (matrix.shape[0], dtype)
+        try:
+            return self._grouping_matrices[key]
+        except KeyError:
+            pass
+        grouping_matrix = scipy.sparse.csr_matrix(
+            (
+                numpy.ones(len(self._grouping_indices), dtype=dtype),
+                self._grouping_indices,
+                self._grouping_indptr,
+            ),
+            shape=(len(self.ids), matrix.shape[0]),
+        )
+        self._grouping_matrices[key] = grouping_matrix
+        return grouping_matrix
 
     def sum_one_group(self, matrix, group_id):
         """
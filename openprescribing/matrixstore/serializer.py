@@ -1,23 +1,152 @@
+"""
+Serializes matrices into a simple, self-describing binary format which can be
+deserialized without copying the underlying data
+
+The format consists of a fixed-size header:
+
+    magic number "MXS" (3 bytes)
+    format version (uint8)
+    matrix kind: dense C-ordered, dense Fortran-ordered, or CSC (uint8)
+    padding (3 bytes)
+    number of rows (uint64)
+    number of columns (uint64)
+
+Followed by one buffer (for dense matrices) or three buffers (the `data`,
+`indices` and `indptr` arrays of CSC matrices), each of the form:
+
+    numpy dtype string e.g. "<i8", null padded (4 bytes)
+    padding (4 bytes)
+    size of buffer in bytes (uint64)
+    raw buffer contents, null padded to a multiple of 8 bytes
+
+Everything is 8-byte aligned so `numpy.frombuffer` can construct arrays
+directly over the serialized data.
+
+Several matrices can be serialized together as a tuple (see `serialize_many`)
+which is how the `MATRIX_SUM_MANY` SQL function returns its results.
+
+Matrices were previously serialized using PyArrow's `SerializationContext`,
+which is now deprecated. We can still read data in that format (assuming a
+version of PyArrow which supports it is installed) but we no longer write it.
+Existing files can be upgraded using the `matrixstore_convert_format` command.
+"""
+import functools
 import struct
 
 import lz4.frame
-import pyarrow
+import numpy
 from scipy.sparse import csc_matrix
 
+from .matrix_ops import get_submatrix
+
 
 # The magic intial bytes which tell us that a given binary chunk is LZ4
 # compressed data
 LZ4_MAGIC_NUMBER = struct.pack("<I", 0x184D2204)
 
-context = pyarrow.SerializationContext()
+# The magic initial bytes which tell us that a given binary chunk is a matrix
+# stored column-by-column (see `serialize_chunked_by_column`)
+COLUMN_CHUNKED_MAGIC_NUMBER = b"MXC1"
+
+# The magic initial bytes which tell us that a given binary chunk is a matrix
+# in the format described above
+MATRIX_MAGIC_NUMBER = b"MXS"
 
+# The magic initial bytes which tell us that a given binary chunk is a tuple of
+# matrices (see `serialize_many`)
+TUPLE_MAGIC_NUMBER = b"MXT1"
 
-def serialize_csc(matrix):
+# Increment this if the format changes, and make sure `deserialize` can still
+# read the previous versions
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct("<3sBB3xQQ")
+BUFFER_HEADER = struct.Struct("<4s4xQ")
+ALIGNMENT = 8
+
+DENSE_C_ORDER = 0
+DENSE_F_ORDER = 1
+CSC = 2
+
+
+def serialize(matrix):
     """
-    Decompose a matrix in Compressed Sparse Column format into more basic data
-    types (tuples and numpy arrays) which PyArrow knows how to serialize
+    Serialize a dense numpy matrix or a Compressed Sparse Column matrix
     """
-    return ((matrix.data, matrix.indices, matrix.indptr), matrix.shape)
+    if isinstance(matrix, csc_matrix):
+        kind = CSC
+        buffers = [matrix.data, matrix.indices, matrix.indptr]
+    elif isinstance(matrix, numpy.ndarray) and matrix.ndim == 2:
+        if matrix.flags.c_contiguous:
+            kind = DENSE_C_ORDER
+        elif matrix.flags.f_contiguous:
+            kind = DENSE_F_ORDER
+        else:
+            kind = DENSE_C_ORDER
+            matrix = numpy.ascontiguousarray(matrix)
+        buffers = [matrix]
+    else:
+        raise TypeError("Can't serialize objects of type {}".format(type(matrix)))
+    rows, columns = matrix.shape
+    parts = [HEADER.pack(MATRIX_MAGIC_NUMBER, FORMAT_VERSION, kind, rows, columns)]
+    for buffer in buffers:
+        buffer_bytes = _get_bytes(buffer)
+        parts.append(
+            BUFFER_HEADER.pack(buffer.dtype.str.encode("ascii"), buffer_bytes.nbytes)
+        )
+        parts.append(buffer_bytes)
+        padding = _padded_size(buffer_bytes.nbytes) - buffer_bytes.nbytes
+        parts.append(b"\0" * padding)
+    return b"".join(parts)
+
+
+def _get_bytes(array):
+    """
+    Return a byte-level view on the contents of an array, without copying
+    """
+    if not array.flags.c_contiguous:
+        if array.flags.f_contiguous:
+            # The transpose of a Fortran-ordered array is C-ordered with the
+            # same memory layout
+            array = array.T
+        else:
+            array = numpy.ascontiguousarray(array)
+    return memoryview(array).cast("B")
+
+
+def _padded_size(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def serialize_compressed(matrix):
+    """
+    Serialize a matrix (as above) and compress the result using LZ4
+    """
+    data = serialize(matrix)
+    # See commit comments for details of how this compression level was chosen
+    return lz4.frame.compress(data, compression_level=10, return_bytearray=True)
+
+
+def serialize_many(matrices):
+    """
+    Serialize a sequence of matrices (any of which may be None) so that they
+    deserialize as a tuple. The layout is:
+
+        magic number (4 bytes)
+        number of matrices, N (uint32)
+        N + 1 offsets, relative to the end of the header (uint64)
+        N serialized matrices (zero length where the matrix is None)
+
+    Offsets are all multiples of 8 so the matrices remain aligned.
+    """
+    parts = [serialize(matrix) if matrix is not None else b"" for matrix in matrices]
+    offsets = [0]
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+    header = TUPLE_MAGIC_NUMBER + struct.pack(
+        "<I{}Q".format(len(parts) + 1), len(parts), *offsets
+    )
+    return b"".join([header] + parts)
 
 
 def deserialize_csc(args):
@@ -37,39 +166,195 @@ def deserialize_csc(args):
     return matrix
 
 
-# Register a custom PyArrow serialization context which knows how to handle
-# Compressed Sparse Column (csc) matrices
-context.register_type(
-    csc_matrix,
-    "csc",
-    custom_serializer=serialize_csc,
-    custom_deserializer=deserialize_csc,
-)
+def serialize_chunked_by_column(matrix):
+    """
+    Serialize a matrix as a sequence of individually compressed, single-column
+    chunks preceded by an index of their offsets
 
+    This takes more space than `serialize_compressed` but it means that
+    individual columns (i.e. dates) can be read without decompressing and
+    deserializing the entire matrix. The layout is:
 
-def serialize(obj):
+        magic number (4 bytes)
+        number of columns, N (uint32)
+        N + 1 chunk offsets, relative to the end of the header (uint64)
+        N compressed chunks
     """
-    Serialize an arbitrary Python object using our custom PyArrow context
+    num_columns = matrix.shape[1]
+    chunks = [
+        serialize_compressed(_get_column(matrix, column))
+        for column in range(num_columns)
+    ]
+    offsets = [0]
+    for chunk in chunks:
+        offsets.append(offsets[-1] + len(chunk))
+    header = COLUMN_CHUNKED_MAGIC_NUMBER + struct.pack(
+        "<I{}Q".format(num_columns + 1), num_columns, *offsets
+    )
+    return b"".join([header] + chunks)
+
+
+def _get_column(matrix, column):
+    if isinstance(matrix, csc_matrix):
+        return get_submatrix(matrix, cols=slice(column, column + 1))
+    else:
+        return numpy.ascontiguousarray(matrix[:, column : column + 1])
+
+
+def deserialize(data):
     """
-    return context.serialize(obj).to_buffer()
+    Deserialize binary data, automatically detecting compressed and chunked
+    data and handling it as necessary
 
+    Note that, because the returned arrays share memory with the supplied data
+    wherever possible, they are read-only.
+    """
+    view = memoryview(data)
+    magic_number = view[:4]
+    if magic_number == COLUMN_CHUNKED_MAGIC_NUMBER:
+        return deserialize_columns(data)
+    if magic_number == TUPLE_MAGIC_NUMBER:
+        return _deserialize_many(view)
+    if magic_number == LZ4_MAGIC_NUMBER:
+        # Decompressing to `bytes` rather than `bytearray` saves a copy
+        data = lz4.frame.decompress(data)
+        view = memoryview(data)
+    if view[:3] == MATRIX_MAGIC_NUMBER:
+        return _deserialize_matrix(view)
+    else:
+        return _deserialize_legacy(data)
 
-def serialize_compressed(obj):
+
+def _deserialize_matrix(view):
+    _, version, kind, rows, columns = HEADER.unpack_from(view, 0)
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported matrix format version: {}".format(version))
+    offset = HEADER.size
+    buffers = []
+    for _ in range(3 if kind == CSC else 1):
+        dtype_str, nbytes = BUFFER_HEADER.unpack_from(view, offset)
+        offset += BUFFER_HEADER.size
+        dtype = numpy.dtype(dtype_str.rstrip(b"\0").decode("ascii"))
+        buffers.append(numpy.frombuffer(view[offset : offset + nbytes], dtype=dtype))
+        offset += _padded_size(nbytes)
+    if kind == CSC:
+        return deserialize_csc((buffers, (rows, columns)))
+    elif kind == DENSE_C_ORDER:
+        return buffers[0].reshape((rows, columns))
+    elif kind == DENSE_F_ORDER:
+        return buffers[0].reshape((rows, columns), order="F")
+    else:
+        raise ValueError("Unknown matrix kind: {}".format(kind))
+
+
+def _deserialize_many(view):
+    (count,) = struct.unpack_from("<I", view, 4)
+    offsets = struct.unpack_from("<{}Q".format(count + 1), view, 8)
+    data_start = 8 + 8 * (count + 1)
+    matrices = []
+    for start, end in zip(offsets, offsets[1:]):
+        if start == end:
+            matrices.append(None)
+        else:
+            matrices.append(
+                _deserialize_matrix(view[data_start + start : data_start + end])
+            )
+    return tuple(matrices)
+
+
+def _deserialize_legacy(data):
     """
-    Serialize an arbitrary Python object using our custom PyArrow context and
-    compress the result using LZ4
+    Deserialize data written by the old PyArrow-based serializer
     """
-    data = context.serialize(obj).to_buffer()
-    # See commit comments for details of how this compression level was chosen
-    return lz4.frame.compress(data, compression_level=10, return_bytearray=True)
+    return _get_legacy_context().deserialize(data)
 
 
-def deserialize(data):
+@functools.lru_cache(maxsize=None)
+def _get_legacy_context():
+    # PyArrow is only needed to read files which haven't yet been converted to
+    # the current format so we import it lazily
+    try:
+        import pyarrow
+
+        context = pyarrow.SerializationContext()
+    except (ImportError, AttributeError):
+        raise RuntimeError(
+            "Reading matrices in the legacy PyArrow format requires a version of "
+            "PyArrow with SerializationContext support. Upgrade the file using "
+            "the `matrixstore_convert_format` command."
+        )
+    # Register a custom PyArrow serialization context which knows how to handle
+    # Compressed Sparse Column (csc) matrices
+    context.register_type(
+        csc_matrix,
+        "csc",
+        custom_serializer=_serialize_csc_legacy,
+        custom_deserializer=deserialize_csc,
+    )
+    return context
+
+
+def _serialize_csc_legacy(matrix):
     """
-    Deserialize binary data using our custom PyArrow context, automatically
-    detecting compressed data and decompressing if necessary
+    Decompose a matrix in Compressed Sparse Column format into more basic data
+    types (tuples and numpy arrays) which PyArrow knows how to serialize
     """
-    magic_number = memoryview(data)[:4]
-    if magic_number == LZ4_MAGIC_NUMBER:
-        data = lz4.frame.decompress(data, return_bytearray=True)
-    return context.deserialize(data)
+    return ((matrix.data, matrix.indices, matrix.indptr), matrix.shape)
+
+
+def deserialize_columns(data, cols=slice(None, None)):
+    """
+    Deserialize just the columns given by the slice `cols` from a serialized
+    matrix
+
+    For matrices serialized with `serialize_chunked_by_column` only the
+    requested columns are decompressed; for anything else we have to
+    deserialize the entire matrix and then slice it.
+    """
+    if cols.step not in (None, 1):
+        raise ValueError("Column slices must be contiguous")
+    view = memoryview(data)
+    if view[:4] != COLUMN_CHUNKED_MAGIC_NUMBER:
+        return get_submatrix(deserialize(data), cols=cols)
+    (num_columns,) = struct.unpack_from("<I", view, 4)
+    offsets = struct.unpack_from("<{}Q".format(num_columns + 1), view, 8)
+    data_start = 8 + 8 * (num_columns + 1)
+    start, stop, _ = cols.indices(num_columns)
+    columns = [
+        deserialize(
+            view[data_start + offsets[column] : data_start + offsets[column + 1]]
+        )
+        for column in range(start, max(start, stop))
+    ]
+    if not columns:
+        raise ValueError("No columns selected")
+    if len(columns) == 1:
+        return columns[0]
+    if isinstance(columns[0], csc_matrix):
+        return _hstack_csc(columns)
+    else:
+        return numpy.hstack(columns)
+
+
+def _hstack_csc(columns):
+    """
+    Join a list of CSC matrices side-by-side, skipping the checks that
+    `scipy.sparse.hstack` performs as we know the matrices are well formed
+    """
+    indptr = [numpy.zeros(1, dtype=columns[0].indptr.dtype)]
+    offset = 0
+    for column in columns:
+        indptr.append(column.indptr[1:] + offset)
+        offset += column.indptr[-1]
+    num_rows = columns[0].shape[0]
+    num_columns = sum(column.shape[1] for column in columns)
+    return deserialize_csc(
+        (
+            (
+                numpy.concatenate([column.data for column in columns]),
+                numpy.concatenate([column.indices for column in columns]),
+                numpy.concatenate(indptr),
+            ),
+            (num_rows, num_columns),
+        )
+    )
@@ -1,7 +1,8 @@
+import numpy
 from scipy.sparse import csc_matrix, _sparsetools
 
-from .matrix_ops import zeros_like
-from .serializer import serialize, deserialize
+from .matrix_ops import is_integer, zeros_like
+from .serializer import serialize, serialize_many, deserialize, deserialize_columns
 
 
 class MatrixSum(object):
@@ -10,10 +11,18 @@ class MatrixSum(object):
 
     Note the `step` and `finalize` methods are what allow this class to be used
     as an SQLite custom aggregation function.
+
+    By default we accumulate using the largest integer or floating point type
+    (see `zeros_like`). Callers who know the result can't overflow a smaller
+    type (e.g. int32 or float32) can supply that as `dtype` to halve the memory
+    we have to touch on each addition.
     """
 
     accumulator = None
 
+    def __init__(self, dtype=None):
+        self.dtype = dtype
+
     def step(self, value):
         if value is not None:
             self.add(deserialize(value))
@@ -22,7 +31,12 @@ class MatrixSum(object):
         if self.accumulator is None:
             # We need this to be in Fortran (i.e. column-major) order for the
             # fast addition path below to work
-            self.accumulator = zeros_like(matrix, order="F")
+            if self.dtype is None:
+                self.accumulator = zeros_like(matrix, order="F")
+            else:
+                self.accumulator = numpy.zeros(
+                    matrix.shape, dtype=self.dtype, order="F"
+                )
         if isinstance(matrix, csc_matrix):
             fast_in_place_add(self.accumulator, matrix)
         else:
@@ -38,6 +52,123 @@ class MatrixSum(object):
             return serialize(self.accumulator)
 
 
+class MatrixSumMany(object):
+    """
+    Sums several columns of matrices at once, so that e.g.
+
+        SELECT MATRIX_SUM_MANY(items, quantity, actual_cost) FROM presentation
+
+    returns a single value which deserializes to a tuple of three matrices.
+    This is equivalent to calling `MATRIX_SUM` on each column, but SQLite only
+    has to call back into Python once per row rather than once per column.
+
+    It can also be used directly to sum rows of matrices as they're streamed
+    from a query, and `dtypes` can be supplied to choose the type of each
+    column's accumulator, as with `MatrixSum`.
+
+    As with `MatrixSum`, NULL values are ignored. Columns which contain only
+    NULLs give None in the result.
+    """
+
+    sums = None
+
+    def __init__(self, dtypes=None):
+        self.dtypes = dtypes
+
+    def step(self, *values):
+        for matrix_sum, value in zip(self._get_sums(len(values)), values):
+            matrix_sum.step(value)
+
+    def add(self, *matrices):
+        for matrix_sum, matrix in zip(self._get_sums(len(matrices)), matrices):
+            if matrix is not None:
+                matrix_sum.add(matrix)
+
+    def _get_sums(self, count):
+        if self.sums is None:
+            dtypes = self.dtypes if self.dtypes is not None else [None] * count
+            self.sums = [MatrixSum(dtype) for dtype in dtypes]
+        if len(self.sums) != count:
+            raise ValueError(
+                "Expected {} matrices, got {}".format(len(self.sums), count)
+            )
+        return self.sums
+
+    def value(self):
+        if self.sums is None:
+            raise ValueError("No values added")
+        return tuple(matrix_sum.accumulator for matrix_sum in self.sums)
+
+    def finalize(self):
+        if self.sums is not None:
+            return serialize_many(self.value())
+
+
+def matrix_sum_cols(value, start, end):
+    """
+    Implements `MATRIX_SUM_COLS(matrix, start, end)` which returns a
+    single-column matrix giving the total for each row over the columns (i.e.
+    dates) from `start` up to, but not including, `end`
+
+    Where there's just one column this simply selects that column. For files
+    built with the `--chunk-by-date` option only the required columns get
+    decompressed.
+    """
+    if value is None:
+        return None
+    matrix = deserialize_columns(value, slice(start, end))
+    dtype = numpy.int_ if is_integer(matrix) else numpy.float_
+    # Sparse matrices give a 2-dimensional result and dense ones a
+    # 1-dimensional one, so we reshape to make them consistent
+    totals = numpy.asarray(matrix.sum(axis=1)).astype(dtype, copy=False)
+    return serialize(totals.reshape((-1, 1)))
+
+
+def matrix_nnz(value):
+    """
+    Implements `MATRIX_NNZ(matrix)` which returns the number of non-zero
+    values in the matrix
+    """
+    if value is None:
+        return None
+    matrix = deserialize(value)
+    if isinstance(matrix, csc_matrix):
+        return int(matrix.count_nonzero())
+    else:
+        return int(numpy.count_nonzero(matrix))
+
+
+class MatrixRowGroupSum(object):
+    """
+    Implements `MATRIX_ROW_GROUP_SUM(matrix, grouper_id)` which sums the rows
+    of a matrix using a `RowGrouper`
+
+    As we can't pass Python objects into SQL, row groupers have to be
+    registered first (see `MatrixStore.register_row_grouper`) and are then
+    referred to by the integer ID this returns.
+    """
+
+    def __init__(self):
+        self.row_groupers = {}
+        self.ids = {}
+
+    def register(self, row_grouper):
+        try:
+            return self.ids[row_grouper.cache_key]
+        except KeyError:
+            pass
+        grouper_id = len(self.row_groupers)
+        self.row_groupers[grouper_id] = row_grouper
+        self.ids[row_grouper.cache_key] = grouper_id
+        return grouper_id
+
+    def __call__(self, value, grouper_id):
+        if value is None:
+            return None
+        row_grouper = self.row_groupers[grouper_id]
+        return serialize(row_grouper.sum(deserialize(value)))
+
+
 def fast_in_place_add(ndarray, matrix):
     """
     Performs fast in-place addition of a sparse CSC matrix to an ndarray of the
@@ -58,6 +189,11 @@ def fast_in_place_add(ndarray, matrix):
     # on the underlying data.
     transposed = ndarray.transpose()
     rows, columns = transposed.shape
+    data = matrix.data
+    # The underlying routine won't add values into an array of a smaller type
+    # so, where the caller has asked for one, we have to convert them first
+    if not numpy.can_cast(data.dtype, ndarray.dtype):
+        data = data.astype(ndarray.dtype)
     _sparsetools.csr_todense(
-        rows, columns, matrix.indptr, matrix.indices, matrix.data, transposed
+        rows, columns, matrix.indptr, matrix.indices, data, transposed
     )
@@ -0,0 +1,81 @@
+"""
+Benchmarks the construction of matrices from prescribing and practice
+statistics data, comparing the current implementation with the original one
+which assigned values into `lil_matrix` objects one cell at a time
+
+Invoke with:
+./manage.py shell -c 'from matrixstore.tests.benchmark_build_matrices import benchmark; benchmark()'
+"""
+import time
+
+from matrixstore.build import import_practice_stats, import_prescribing
+from matrixstore.build.init_db import generate_dates
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.build.test_import_practice_stats import (
+    build_practice_stats_matrices_with_lil,
+)
+from matrixstore.tests.build.test_import_prescribing import (
+    build_prescribing_matrices_with_lil,
+)
+from matrixstore.tests.import_test_data_fast import (
+    _dicts_to_csv,
+    _get_active_practice_codes,
+)
+
+
+def benchmark(num_months=60, num_practices=200, num_presentations=100):
+    factory = DataFactory()
+    factory.create_all(
+        start_date="2015-01-01",
+        num_months=num_months,
+        num_practices=num_practices,
+        num_presentations=num_presentations,
+    )
+    dates = generate_dates(factory.months[-1][:7], months=num_months)
+    practices = {
+        code: offset
+        for offset, code in enumerate(_get_active_practice_codes(factory, dates))
+    }
+    date_offsets = {date: offset for offset, date in enumerate(dates)}
+    prescribing = get_prescribing(factory)
+    practice_statistics = get_practice_statistics(factory)
+    for name, functions, data in [
+        (
+            "prescribing",
+            [build_prescribing_matrices_with_lil, import_prescribing.build_matrices],
+            prescribing,
+        ),
+        (
+            "practice statistics",
+            [
+                build_practice_stats_matrices_with_lil,
+                import_practice_stats.build_matrices,
+            ],
+            practice_statistics,
+        ),
+    ]:
+        for label, function in zip(["before", "after"], functions):
+            start = time.time()
+            for _ in function(data, practices, date_offsets):
+                pass
+            duration = time.time() - start
+            print(
+                "{name} ({label}): {rate:,.0f} rows/sec".format(
+                    name=name, label=label, rate=len(data) / duration
+                )
+            )
+
+
+def get_prescribing(factory):
+    prescribing = sorted(
+        factory.prescribing, key=lambda p: (p["bnf_code"], p["practice"], p["month"])
+    )
+    return list(import_prescribing.parse_prescribing_csv(_dicts_to_csv(prescribing)))
+
+
+def get_practice_statistics(factory):
+    return list(
+        import_practice_stats.parse_practice_statistics_csv(
+            _dicts_to_csv(factory.practice_statistics)
+        )
+    )
@@ -0,0 +1,50 @@
+"""
+Benchmarks `RowGrouper.sum`, comparing it with the original implementation
+which looped over each group in turn
+
+Invoke with:
+./manage.py shell -c 'from matrixstore.tests.benchmark_row_grouper import benchmark; benchmark()'
+"""
+import time
+
+import numpy
+import scipy.sparse
+
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.test_row_grouper import sum_by_looping_over_groups
+
+
+def benchmark(num_practices=7000, num_groups=1250, num_dates=60, repeat=20):
+    """
+    Compare `RowGrouper.sum` with the original looping implementation using
+    roughly the number of practices and PCNs we have in practice
+    """
+    rng = numpy.random.RandomState(507)
+    row_grouper = RowGrouper(
+        (row, "group_%04d" % group)
+        for row, group in enumerate(rng.randint(num_groups, size=num_practices))
+    )
+    shape = (num_practices, num_dates)
+    matrices = [
+        ("dense", rng.randint(1000, size=shape)),
+        (
+            "sparse",
+            scipy.sparse.random(
+                *shape, density=0.05, format="csc", random_state=rng
+            ).astype(numpy.float_),
+        ),
+    ]
+    for name, matrix in matrices:
+        for label, function in [
+            ("before", lambda: sum_by_looping_over_groups(row_grouper, matrix)),
+            ("after", lambda: row_grouper.sum(matrix)),
+        ]:
+            start = time.time()
+            for _ in range(repeat):
+                function()
+            duration = time.time() - start
+            print(
+                "{name} ({label}): {ms:.2f}ms per matrix".format(
+                    name=name, label=label, ms=duration / repeat * 1000
+                )
+            )
@@ -0,0 +1,75 @@
+import sqlite3
+
+from django.test import SimpleTestCase
+
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import (
+    append_test_data_fast,
+    import_test_data_fast,
+)
+
+
+class TestAppendMonth(SimpleTestCase):
+    def setUp(self):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 4)
+        practices = factory.create_practices(3)
+        presentations = factory.create_presentations(4)
+        factory.create_prescribing(presentations, practices, months)
+        factory.create_practice_statistics(practices, months)
+        # A practice which closes after the first month, and so should be
+        # dropped from the new file
+        closed_practice = factory.create_practice()
+        factory.create_prescription(presentations[0], closed_practice, months[0])
+        factory.create_statistics_for_one_practice_and_month(closed_practice, months[0])
+        # A practice which opens in the final month, and so will be new to the
+        # new file
+        new_practice = factory.create_practice()
+        factory.create_prescription(presentations[1], new_practice, months[3])
+        factory.create_statistics_for_one_practice_and_month(new_practice, months[3])
+        # A presentation only prescribed in the first month, which should be
+        # dropped from the new file, and one only prescribed in the final month
+        old_presentation = factory.create_presentation()
+        factory.create_prescription(old_presentation, practices[0], months[0])
+        new_presentation = factory.create_presentation()
+        factory.create_prescription(new_presentation, practices[1], months[3])
+        # A presentation which changes its BNF code in the final month
+        presentation_to_update = factory.create_presentation()
+        factory.create_prescribing([presentation_to_update], practices, months[:3])
+        updated_presentation = factory.update_bnf_code(presentation_to_update)
+        factory.create_prescribing([updated_presentation], practices, months[3:])
+        self.factory = factory
+
+    def test_appending_month_matches_full_build(self):
+        previous = sqlite3.connect(":memory:")
+        import_test_data_fast(previous, self.factory, "2019-03", months=3)
+        expected = sqlite3.connect(":memory:")
+        import_test_data_fast(expected, self.factory, "2019-04", months=3)
+        appended = sqlite3.connect(":memory:")
+        append_test_data_fast(previous, appended, self.factory, "2019-04", months=3)
+        for table, order_by in [
+            ("date", "offset"),
+            ("practice", "offset"),
+            ("presentation", "bnf_code"),
+            ("practice_statistic", "name"),
+            ("all_presentations", "rowid"),
+        ]:
+            with self.subTest(table=table):
+                self.assertEqual(
+                    get_contents(appended, table, order_by),
+                    get_contents(expected, table, order_by),
+                )
+        for connection in [previous, expected, appended]:
+            connection.close()
+
+    def test_appending_non_consecutive_month_raises_error(self):
+        previous = sqlite3.connect(":memory:")
+        import_test_data_fast(previous, self.factory, "2019-02", months=2)
+        appended = sqlite3.connect(":memory:")
+        with self.assertRaises(RuntimeError):
+            append_test_data_fast(previous, appended, self.factory, "2019-04", months=3)
+
+
+def get_contents(connection, table, order_by):
+    sql = "SELECT * FROM {} ORDER BY {}".format(table, order_by)
+    return list(connection.execute(sql))
@@ -0,0 +1,42 @@
+import sqlite3
+
+import lz4.frame
+import numpy
+import scipy.sparse
+from django.test import SimpleTestCase
+
+from matrixstore.build.convert_format import convert_value
+from matrixstore.serializer import (
+    COLUMN_CHUNKED_MAGIC_NUMBER,
+    MATRIX_MAGIC_NUMBER,
+    deserialize,
+    serialize_chunked_by_column,
+)
+from matrixstore.tests.test_read_existing_file import TestReadExistingFile
+
+
+class TestConvertFormat(SimpleTestCase):
+    def test_legacy_values_are_converted(self):
+        connection = sqlite3.connect(TestReadExistingFile.fixture_db_path)
+        for key, value in connection.execute("SELECT key, value FROM data"):
+            with self.subTest(key=key):
+                new_value = convert_value(value)
+                decompressed = lz4.frame.decompress(new_value)
+                self.assertEqual(decompressed[:3], MATRIX_MAGIC_NUMBER)
+                self.assertEqual(
+                    to_array(deserialize(new_value)).tolist(),
+                    to_array(deserialize(value)).tolist(),
+                )
+        connection.close()
+
+    def test_chunked_values_stay_chunked(self):
+        matrix = scipy.sparse.csc_matrix(numpy.eye(4))
+        new_value = convert_value(serialize_chunked_by_column(matrix))
+        self.assertEqual(new_value[:4], COLUMN_CHUNKED_MAGIC_NUMBER)
+        self.assertEqual(
+            deserialize(new_value).toarray().tolist(), numpy.eye(4).tolist()
+        )
+
+
+def to_array(matrix):
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
@@ -0,0 +1,83 @@
+import sqlite3
+
+from django.test import SimpleTestCase
+
+from matrixstore.build.group_by_org import group_by_org_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestGroupByOrg(SimpleTestCase):
+    def setUp(self):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(5)
+        presentations = factory.create_presentations(4)
+        factory.create_prescribing(presentations, practices, months)
+        connection = sqlite3.connect(":memory:")
+        import_test_data_fast(connection, factory, "2019-03", months=3)
+        # The final practice doesn't belong to any CCG
+        self.mappings = {
+            "ccg": {
+                practices[0]["code"]: "CCG2",
+                practices[1]["code"]: "CCG1",
+                practices[2]["code"]: "CCG2",
+                practices[3]["code"]: "CCG1",
+            },
+            "stp": {practice["code"]: "STP1" for practice in practices},
+            "pcn": {},
+        }
+        group_by_org_for_db(connection, self.mappings)
+        self.matrixstore = MatrixStore(connection)
+
+    def tearDown(self):
+        self.matrixstore.close()
+
+    def test_grouped_matrices_match_row_grouper(self):
+        for org_type in ["ccg", "stp"]:
+            mapping = self.mappings[org_type]
+            row_grouper = RowGrouper(
+                (offset, mapping[code])
+                for code, offset in self.matrixstore.practice_offsets.items()
+                if code in mapping
+            )
+            offsets = self.matrixstore.get_org_offsets(org_type)
+            self.assertEqual(offsets, row_grouper.offsets)
+            for table, key_column in [
+                ("presentation", "bnf_code"),
+                ("all_presentations", "1"),
+            ]:
+                with self.subTest(org_type=org_type, table=table):
+                    rows = self.matrixstore.query(
+                        """
+                        SELECT items, quantity, actual_cost, net_cost FROM {table}
+                        ORDER BY {key_column}
+                        """.format(
+                            table=table, key_column=key_column
+                        )
+                    )
+                    grouped_rows = self.matrixstore.query(
+                        """
+                        SELECT items, quantity, actual_cost, net_cost
+                        FROM {table}_by_{org_type} ORDER BY {key_column}
+                        """.format(
+                            table=table, org_type=org_type, key_column=key_column
+                        )
+                    )
+                    for row, grouped_row in zip(rows, grouped_rows):
+                        for matrix, grouped_matrix in zip(row, grouped_row):
+                            # Avoid overflowing small integer types when summing
+                            expected = row_grouper.sum(to_dense(matrix).astype(float))
+                            self.assertEqual(
+                                to_dense(grouped_matrix).tolist(), expected.tolist()
+                            )
+
+    def test_org_types_without_orgs_are_not_grouped(self):
+        self.assertIsNone(self.matrixstore.get_org_offsets("pcn"))
+        self.assertIsNone(self.matrixstore.get_org_offsets("regional_team"))
+
+
+def to_dense(matrix):
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
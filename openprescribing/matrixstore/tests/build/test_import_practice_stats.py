@@ -0,0 +1,57 @@
+from django.test import SimpleTestCase
+
+from matrixstore.build.import_practice_stats import build_matrices
+from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
+
+from .test_import_prescribing import assert_matrices_identical
+
+
+class TestImportPracticeStats(SimpleTestCase):
+    def test_build_matrices_matches_lil_implementation(self):
+        practices = {"ABC001": 0, "ABC002": 1, "ABC003": 2}
+        dates = {"2019-01-01": 0, "2019-02-01": 1}
+        practice_statistics = [
+            ("total_list_size", "ABC001", "2019-01-01", 1200),
+            ("total_list_size", "ABC002", "2019-01-01", 0),
+            ("total_list_size", "ABC003", "2019-02-01", 1500),
+            ("total_list_size", "XYZ999", "2019-02-01", 1500),
+            ("star_pu.statins_cost", "ABC001", "2019-01-01", 0),
+            ("star_pu.statins_cost", "ABC002", "2019-01-01", 10.5),
+            ("star_pu.statins_cost", "ABC003", "2019-02-01", 20.25),
+            ("astro_pu_cost", "ABC001", "2019-01-01", 1.5),
+            ("astro_pu_cost", "ABC001", "2019-02-01", 2.5),
+            ("astro_pu_cost", "ABC002", "2019-01-01", 3.5),
+            ("astro_pu_cost", "ABC002", "2019-02-01", 4.5),
+            ("astro_pu_cost", "ABC003", "2019-01-01", 5.5),
+        ]
+        expected = build_practice_stats_matrices_with_lil(
+            practice_statistics, practices, dates
+        )
+        results = build_matrices(practice_statistics, practices, dates)
+        for (expected_name, expected_matrix), (name, matrix) in zip(expected, results):
+            self.assertEqual(name, expected_name)
+            assert_matrices_identical(self, matrix, expected_matrix)
+
+
+def build_practice_stats_matrices_with_lil(practice_statistics, practices, dates):
+    """
+    The original implementation of `import_practice_stats.build_matrices`
+    """
+    max_row = max(practices.values())
+    max_col = max(dates.values())
+    shape = (max_row + 1, max_col + 1)
+    matrices = {}
+    for statistic_name, practice, date, value in practice_statistics:
+        try:
+            practice_offset = practices[practice]
+        except KeyError:
+            continue
+        date_offset = dates[date]
+        try:
+            matrix = matrices[statistic_name]
+        except KeyError:
+            matrix = sparse_matrix(shape, integer=isinstance(value, int))
+            matrices[statistic_name] = matrix
+        matrix[practice_offset, date_offset] = value
+    for statistic_name, matrix in sorted(matrices.items()):
+        yield statistic_name, finalise_matrix(matrix)
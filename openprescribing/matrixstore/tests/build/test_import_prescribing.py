@@ -0,0 +1,86 @@
+from itertools import groupby
+import sqlite3
+
+from django.test import SimpleTestCase
+
+from matrixstore.build.import_prescribing import MatrixRow, build_matrices
+from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestImportPrescribing(SimpleTestCase):
+    def test_parallel_build_matches_serial_build(self):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(4)
+        presentations = factory.create_presentations(6)
+        factory.create_prescribing(presentations, practices, months)
+        serial = build_database(factory, workers=1)
+        parallel = build_database(factory, workers=2)
+        self.assertEqual(serial, parallel)
+
+    def test_build_matrices_matches_lil_implementation(self):
+        practices = {"ABC001": 0, "ABC002": 1, "ABC003": 2}
+        dates = {"2019-01-01": 0, "2019-02-01": 1}
+        prescriptions = [
+            ("0101", "ABC001", "2019-01-01", 1, 2.5, 300, 290),
+            ("0101", "ABC003", "2019-02-01", 2, 0.0, 0, 10),
+            ("0202", "ABC001", "2019-01-01", 3, 1.0, 100000, 99000),
+            ("0202", "ABC002", "2019-01-01", 4, 1.5, 200, 190),
+            ("0202", "ABC002", "2019-02-01", 5, 2.0, 200, 190),
+            ("0202", "ABC003", "2019-01-01", 6, 2.5, 200, 190),
+            ("0202", "ABC003", "2019-02-01", 7, 3.0, 200, 190),
+        ]
+        expected = build_prescribing_matrices_with_lil(prescriptions, practices, dates)
+        results = build_matrices(prescriptions, practices, dates)
+        for expected_row, row in zip(expected, results):
+            self.assertEqual(row.bnf_code, expected_row.bnf_code)
+            for matrix, expected_matrix in zip(row[1:], expected_row[1:]):
+                assert_matrices_identical(self, matrix, expected_matrix)
+
+
+def assert_matrices_identical(test_case, matrix, expected_matrix):
+    test_case.assertEqual(type(matrix), type(expected_matrix))
+    test_case.assertEqual(matrix.dtype, expected_matrix.dtype)
+    if hasattr(matrix, "toarray"):
+        test_case.assertEqual(matrix.nnz, expected_matrix.nnz)
+        matrix, expected_matrix = matrix.toarray(), expected_matrix.toarray()
+    test_case.assertEqual(matrix.tolist(), expected_matrix.tolist())
+
+
+def build_database(factory, workers):
+    connection = sqlite3.connect(":memory:")
+    import_test_data_fast(connection, factory, "2019-03", months=3, workers=workers)
+    dump = list(connection.iterdump())
+    connection.close()
+    return dump
+
+
+def build_prescribing_matrices_with_lil(prescriptions, practices, dates):
+    """
+    The original implementation of `import_prescribing.build_matrices`
+    """
+    max_row = max(practices.values())
+    max_col = max(dates.values())
+    shape = (max_row + 1, max_col + 1)
+    grouped_by_bnf_code = groupby(prescriptions, lambda row: row[0])
+    for bnf_code, row_group in grouped_by_bnf_code:
+        items_matrix = sparse_matrix(shape, integer=True)
+        quantity_matrix = sparse_matrix(shape, integer=False)
+        actual_cost_matrix = sparse_matrix(shape, integer=True)
+        net_cost_matrix = sparse_matrix(shape, integer=True)
+        for _, practice, date, items, quantity, actual_cost, net_cost in row_group:
+            practice_offset = practices[practice]
+            date_offset = dates[date]
+            items_matrix[practice_offset, date_offset] = items
+            quantity_matrix[practice_offset, date_offset] = quantity
+            actual_cost_matrix[practice_offset, date_offset] = actual_cost
+            net_cost_matrix[practice_offset, date_offset] = net_cost
+        yield MatrixRow(
+            bnf_code,
+            finalise_matrix(items_matrix),
+            finalise_matrix(quantity_matrix),
+            finalise_matrix(actual_cost_matrix),
+            finalise_matrix(net_cost_matrix),
+        )
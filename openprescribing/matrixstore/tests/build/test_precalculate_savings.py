@@ -0,0 +1,133 @@
+import sqlite3
+
+from django.test import SimpleTestCase
+import numpy
+
+from frontend.price_per_unit.savings import (
+    get_precalculated_savings_for_sets,
+    get_savings_for_sets,
+)
+from frontend.price_per_unit.substitution_sets import DictWithCacheID, SubstitutionSet
+from frontend.tests.price_per_unit.test_savings import (
+    invent_brands_from_generic_bnf_code,
+    invent_generic_bnf_code,
+)
+from matrixstore.build.precalculate_savings import precalculate_savings_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestPrecalculateSavings(SimpleTestCase):
+    def setUp(self):
+        factory = DataFactory()
+        self.months = factory.create_months("2020-01-01", 3)
+        practices = factory.create_practices(6)
+        substitution_sets = []
+        for i in range(3):
+            generic_code = invent_generic_bnf_code(i)
+            bnf_codes = [generic_code] + invent_brands_from_generic_bnf_code(
+                generic_code
+            )
+            for bnf_code in bnf_codes:
+                factory.create_presentation(bnf_code=bnf_code)
+            substitution_sets.append(SubstitutionSet(generic_code, bnf_codes))
+        factory.create_prescribing(factory.presentations, practices, self.months)
+        # A set with no prescribing at all
+        generic_code = invent_generic_bnf_code(3)
+        substitution_sets.append(
+            SubstitutionSet(
+                generic_code, invent_brands_from_generic_bnf_code(generic_code)
+            )
+        )
+        self.substitution_sets = substitution_sets
+        self.matrixstore = MatrixStore(create_connection(factory))
+        # The final practice doesn't belong to the peer group
+        self.practice_group_by_org = RowGrouper(
+            (offset, code)
+            for code, offset in self.matrixstore.practice_offsets.items()
+            if code != practices[-1]["code"]
+        )
+        # Precalculate savings for all but the first set, so we exercise
+        # combining precalculated savings with those calculated on the fly
+        connection = create_connection(factory)
+        precalculate_savings_for_db(
+            connection,
+            DictWithCacheID([(s.id, s) for s in substitution_sets[1:]]),
+            self.practice_group_by_org,
+            target_centile=10,
+        )
+        self.matrixstore_with_savings = MatrixStore(connection)
+
+    def tearDown(self):
+        self.matrixstore.close()
+        self.matrixstore_with_savings.close()
+
+    def test_savings_match_those_calculated_on_the_fly(self):
+        for month in self.months:
+            date = month[:10]
+            with self.subTest(date=date):
+                expected = get_savings_for_sets(
+                    self.matrixstore,
+                    self.substitution_sets,
+                    date,
+                    self.practice_group_by_org,
+                    10,
+                )
+                results = get_savings_for_sets(
+                    self.matrixstore_with_savings,
+                    self.substitution_sets,
+                    date,
+                    self.practice_group_by_org,
+                    10,
+                )
+                for result, expected_result in zip(results, expected):
+                    numpy.testing.assert_allclose(result, expected_result)
+
+    def test_precalculated_savings_are_found(self):
+        date = self.months[0][:10]
+        precalculated = get_precalculated_savings_for_sets(
+            self.matrixstore_with_savings,
+            self.substitution_sets,
+            date,
+            self.practice_group_by_org,
+            10,
+        )
+        # The first set wasn't precalculated and the last has no prescribing
+        self.assertEqual(sorted(precalculated.keys()), [1, 2])
+
+    def test_savings_with_different_inputs_are_ignored(self):
+        date = self.months[0][:10]
+        different_group_by_org = RowGrouper(
+            (offset, code) for code, offset in self.matrixstore.practice_offsets.items()
+        )
+        for practice_group_by_org, target_centile in [
+            (self.practice_group_by_org, 20),
+            (different_group_by_org, 10),
+        ]:
+            precalculated = get_precalculated_savings_for_sets(
+                self.matrixstore_with_savings,
+                self.substitution_sets,
+                date,
+                practice_group_by_org,
+                target_centile,
+            )
+            self.assertEqual(precalculated, {})
+
+    def test_files_without_savings_are_handled(self):
+        date = self.months[0][:10]
+        precalculated = get_precalculated_savings_for_sets(
+            self.matrixstore,
+            self.substitution_sets,
+            date,
+            self.practice_group_by_org,
+            10,
+        )
+        self.assertEqual(precalculated, {})
+
+
+def create_connection(factory):
+    connection = sqlite3.connect(":memory:")
+    import_test_data_fast(connection, factory, "2020-03", months=3)
+    return connection
@@ -235,6 +235,47 @@ class TestMatrixStoreBuild(SimpleTestCase):
             # Check there are no additional values that we weren't expecting
             self.assertEqual(get_value.nonzero_values, len(totals))
 
+    def test_bnf_prefix_totals(self):
+        bnf_codes = [
+            bnf_code
+            for (bnf_code,) in self.connection.execute(
+                "SELECT bnf_code FROM presentation"
+            )
+        ]
+        expected_prefixes = {
+            bnf_code[:length] for bnf_code in bnf_codes for length in (2, 4, 6, 9)
+        }
+        results = self.connection.execute(
+            """
+            SELECT bnf_code_prefix, items, quantity, actual_cost
+            FROM bnf_prefix_totals
+            """
+        )
+        prefixes = set()
+        for prefix, *values in results:
+            prefixes.add(prefix)
+            expected_values = self.connection.execute(
+                """
+                SELECT items, quantity, actual_cost FROM presentation
+                WHERE bnf_code LIKE ? ORDER BY bnf_code
+                """,
+                [prefix + "%"],
+            )
+            totals = [0, 0, 0]
+            for row in expected_values:
+                # Cast to float to avoid overflowing small integer types
+                totals = [
+                    total + to_dense(deserialize(value)).astype(numpy.float_)
+                    for total, value in zip(totals, row)
+                ]
+            for value, total in zip(values, totals):
+                self.assertEqual(to_dense(deserialize(value)).tolist(), total.tolist())
+        self.assertEqual(prefixes, expected_prefixes)
+
+
+def to_dense(matrix):
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
+
 
 class TestMatrixStoreBuildEndToEnd(TestMatrixStoreBuild):
     """
@@ -0,0 +1,70 @@
+import warnings
+
+from django.core.cache import CacheKeyWarning, cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+import mock
+
+from frontend.models import PCT, Practice
+from frontend.price_per_unit.savings import get_total_savings_for_org
+from frontend.tests.price_per_unit.test_savings import (
+    invent_brands_from_generic_bnf_code,
+    invent_generic_bnf_code,
+)
+from matrixstore.tests.contextmanagers import (
+    patched_global_matrixstore_from_data_factory,
+)
+from matrixstore.tests.data_factory import DataFactory
+
+
+# The in-memory cache backend warns that our binary cache keys won't be
+# compatible with memcached, but we really don't care
+warnings.simplefilter("ignore", CacheKeyWarning)
+LOCMEM_CACHE_SETTING = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHE_SETTING)
+class TestMatrixStoreWarmCache(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        factory = DataFactory()
+        factory.create_months("2020-01-01", 2)
+        factory.create_practices(5)
+        for i in range(3):
+            generic_code = invent_generic_bnf_code(i)
+            for bnf_code in [generic_code] + invent_brands_from_generic_bnf_code(
+                generic_code
+            ):
+                factory.create_presentation(bnf_code=bnf_code)
+        factory.create_prescribing(
+            factory.presentations, factory.practices, factory.months
+        )
+        ccg = PCT.objects.create(name="CCG1", code="ABC", org_type="CCG")
+        for practice in factory.practices:
+            Practice.objects.create(
+                name=practice["name"], code=practice["code"], setting=4, ccg=ccg
+            )
+        cls.factory = factory
+
+    def test_warms_savings_for_latest_month(self):
+        practice_code = self.factory.practices[0]["code"]
+        date = self.factory.months[-1][:10]
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            expected = get_total_savings_for_org(date, "practice", practice_code)
+            cache.clear()
+            call_command("matrixstore_warm_cache", quiet=True)
+            # If the savings were cached then we shouldn't need to calculate
+            # them again
+            with mock.patch(
+                "frontend.price_per_unit.savings.get_target_ppu",
+                side_effect=AssertionError("Savings not cached"),
+            ):
+                result = get_total_savings_for_org(date, "practice", practice_code)
+        self.assertEqual(result, expected)
+
+    def test_rejects_month_with_no_data(self):
+        with patched_global_matrixstore_from_data_factory(self.factory):
+            with self.assertRaises(RuntimeError):
+                call_command("matrixstore_warm_cache", date="2019-01", quiet=True)
@@ -14,9 +14,10 @@ from matrixstore.build.update_bnf_map import (
     delete_presentations_with_no_prescribing,
 )
 from matrixstore.build.precalculate_totals import precalculate_totals_for_db
+from matrixstore.build.append_month import append_month_for_db
 
 
-def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None):
+def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None, workers=1):
     """
     Imports the data in `data_factory` into the supplied SQLite connection
     without touching any external services such as BigQuery or Google Cloud
@@ -32,7 +33,33 @@ def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None):
 
     init_db(sqlite_conn, data_factory, dates)
     import_practice_stats(sqlite_conn, data_factory, dates)
-    import_prescribing(sqlite_conn, data_factory, dates)
+    import_prescribing(sqlite_conn, data_factory, dates, workers=workers)
+    update_bnf_map(sqlite_conn, data_factory)
+    precalculate_totals_for_db(sqlite_conn)
+
+    sqlite_conn.isolation_level = previous_isolation_level
+    sqlite_conn.commit()
+
+
+def append_test_data_fast(
+    previous_sqlite_conn, sqlite_conn, data_factory, end_date, months=None
+):
+    """
+    As above, but takes all but the latest month of data from an existing
+    MatrixStore (as created by `import_test_data_fast`) and only imports the
+    latest month from `data_factory`
+    """
+    dates = generate_dates(end_date, months=months)
+    previous_isolation_level = sqlite_conn.isolation_level
+    sqlite_conn.isolation_level = None
+
+    init_db(sqlite_conn, data_factory, dates)
+    append_month_for_db(
+        previous_sqlite_conn,
+        sqlite_conn,
+        _get_prescribing(data_factory, dates[-1:]),
+        _get_practice_statistics(data_factory, dates[-1:]),
+    )
     update_bnf_map(sqlite_conn, data_factory)
     precalculate_totals_for_db(sqlite_conn)
 
@@ -50,6 +77,11 @@ def init_db(sqlite_conn, data_factory, dates):
 
 
 def import_practice_stats(sqlite_conn, data_factory, dates):
+    practice_statistics = _get_practice_statistics(data_factory, dates)
+    write_practice_stats(sqlite_conn, practice_statistics)
+
+
+def _get_practice_statistics(data_factory, dates):
     filtered_practice_stats = _filter_by_date(data_factory.practice_statistics, dates)
     filtered_practice_stats = list(filtered_practice_stats)
     if filtered_practice_stats:
@@ -59,17 +91,21 @@ def import_practice_stats(sqlite_conn, data_factory, dates):
         practice_statistics = parse_practice_statistics_csv(practice_statistics_csv)
     else:
         practice_statistics = []
-    write_practice_stats(sqlite_conn, practice_statistics)
+    return practice_statistics
+
+
+def import_prescribing(sqlite_conn, data_factory, dates, workers=1):
+    prescribing = _get_prescribing(data_factory, dates)
+    write_prescribing(sqlite_conn, prescribing, workers=workers)
 
 
-def import_prescribing(sqlite_conn, data_factory, dates):
+def _get_prescribing(data_factory, dates):
     filtered_prescribing = _filter_by_date(data_factory.prescribing, dates)
     sorted_prescribing = sorted(
         filtered_prescribing, key=lambda p: (p["bnf_code"], p["practice"], p["month"])
     )
     prescribing_csv = _dicts_to_csv(sorted_prescribing)
-    prescribing = parse_prescribing_csv(prescribing_csv)
-    write_prescribing(sqlite_conn, prescribing)
+    return parse_prescribing_csv(prescribing_csv)
 
 
 def update_bnf_map(sqlite_conn, data_factory):
@@ -32,13 +32,13 @@ def patch_global_matrixstore(matrixstore):
     mocked = patcher.start()
     mocked.return_value = matrixstore
     # There are memoized functions so we clear any previously memoized value
-    db.get_db.cache_clear()
+    db.live_db.reset()
     db.get_row_grouper.cache_clear()
     get_substitution_sets.cache_clear()
 
     def stop_patching():
         patcher.stop()
-        db.get_db.cache_clear()
+        db.live_db.reset()
         db.get_row_grouper.cache_clear()
         get_substitution_sets.cache_clear()
         matrixstore.close()
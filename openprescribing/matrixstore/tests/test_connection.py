@@ -3,6 +3,11 @@ import numbers
 
 from django.test import SimpleTestCase
 
+import numpy
+
+from matrixstore.build.chunk_matrices_by_date import chunk_matrices_by_date_for_db
+from matrixstore.connection import MatrixCache, MISSING
+from matrixstore.matrix_ops import get_submatrix
 from matrixstore.tests.data_factory import DataFactory
 from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
 
@@ -15,6 +20,8 @@ class TestMatrixStoreConnection(SimpleTestCase):
             start_date="2018-06-01", num_months=6, num_practices=6, num_presentations=6
         )
         cls.matrixstore = matrixstore_from_data_factory(cls.factory)
+        cls.chunked_matrixstore = matrixstore_from_data_factory(cls.factory)
+        chunk_matrices_by_date_for_db(cls.chunked_matrixstore.connection)
 
     def test_practice_offsets(self):
         practice_codes = sorted(p["code"] for p in self.factory.practices)
@@ -70,6 +77,123 @@ class TestMatrixStoreConnection(SimpleTestCase):
                 expected_value = items_dict[practice, date]
                 self.assertEqual(value, expected_value)
 
+    def test_query_presentations(self):
+        bnf_codes = [p["bnf_code"] for p in self.factory.presentations][:3]
+        results = list(
+            self.matrixstore.query_presentations(
+                bnf_codes + ["not_a_bnf_code"], ["items", "net_cost"]
+            )
+        )
+        expected = list(
+            self.matrixstore.query(
+                """
+                SELECT bnf_code, items, net_cost FROM presentation
+                WHERE bnf_code IN (?, ?, ?) ORDER BY bnf_code
+                """,
+                bnf_codes,
+            )
+        )
+        self.assertEqual(len(results), len(expected))
+        for row, expected_row in zip(results, expected):
+            self.assertEqual(row[0], expected_row[0])
+            for matrix, expected_matrix in zip(row[1:], expected_row[1:]):
+                self.assertEqual(matrix.tolist(), expected_matrix.tolist())
+
+    def test_query_presentations_with_cache(self):
+        bnf_codes = [p["bnf_code"] for p in self.factory.presentations][:3]
+        expected = list(self.matrixstore.query_presentations(bnf_codes, ["items"]))
+        cache = MatrixCache(1024 ** 2)
+        self.matrixstore.matrix_cache = cache
+        try:
+            first = list(self.matrixstore.query_presentations(bnf_codes, ["items"]))
+            second = list(self.matrixstore.query_presentations(bnf_codes, ["items"]))
+        finally:
+            self.matrixstore.matrix_cache = None
+        self.assertEqual(cache.misses, len(expected))
+        self.assertEqual(cache.hits, len(expected))
+        for rows in [first, second]:
+            self.assertEqual([row[0] for row in rows], [row[0] for row in expected])
+            for (_, matrix), (_, expected_matrix) in zip(rows, expected):
+                self.assertEqual(matrix.tolist(), expected_matrix.tolist())
+        # Check that the same objects are returned each time
+        for (_, matrix), (_, cached_matrix) in zip(first, second):
+            self.assertIs(matrix, cached_matrix)
+
+    def test_query_columns(self):
+        sql = "SELECT bnf_code, quantity FROM presentation ORDER BY bnf_code"
+        cols = slice(2, 3)
+        expected = [
+            (bnf_code, to_array(get_submatrix(quantity, cols=cols)).tolist())
+            for bnf_code, quantity in self.matrixstore.query(sql)
+        ]
+        for matrixstore in [self.matrixstore, self.chunked_matrixstore]:
+            results = [
+                (bnf_code, to_array(quantity).tolist())
+                for bnf_code, quantity in matrixstore.query_columns(sql, cols=cols)
+            ]
+            self.assertEqual(results, expected)
+
+    def test_chunked_matrixstore_gives_same_results(self):
+        sql = "SELECT items, net_cost FROM presentation ORDER BY bnf_code"
+        expected = [
+            [to_array(value).tolist() for value in row]
+            for row in self.matrixstore.query(sql)
+        ]
+        results = [
+            [to_array(value).tolist() for value in row]
+            for row in self.chunked_matrixstore.query(sql)
+        ]
+        self.assertEqual(results, expected)
+
+    def test_query_presentations_rejects_non_matrix_columns(self):
+        with self.assertRaises(ValueError):
+            list(self.matrixstore.query_presentations(["0101"], ["bnf_code"]))
+
     @classmethod
     def tearDownClass(cls):
         cls.matrixstore.close()
+        cls.chunked_matrixstore.close()
+
+
+def to_array(value):
+    if hasattr(value, "toarray"):
+        value = value.toarray()
+    return value
+
+
+class TestMatrixCache(SimpleTestCase):
+    def test_evicts_least_recently_used_when_over_size(self):
+        # Each matrix is 8 x 8 bytes = 64 bytes
+        matrices = {key: numpy.zeros((8, 1), dtype=numpy.int64) for key in "abc"}
+        cache = MatrixCache(128)
+        cache.set("a", matrices["a"])
+        cache.set("b", matrices["b"])
+        # Touch "a" so "b" becomes the least recently used entry
+        self.assertIs(cache.get("a"), matrices["a"])
+        cache.set("c", matrices["c"])
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertIs(cache.get("c"), matrices["c"])
+        self.assertEqual(
+            cache.stats(),
+            {
+                "hits": 2,
+                "misses": 1,
+                "evictions": 1,
+                "entries": 2,
+                "current_bytes": 128,
+                "max_bytes": 128,
+            },
+        )
+
+    def test_values_larger_than_cache_are_not_stored(self):
+        cache = MatrixCache(8)
+        cache.set("a", numpy.zeros((8, 1), dtype=numpy.int64))
+        self.assertIs(cache.get("a"), MISSING)
+        self.assertEqual(cache.current_bytes, 0)
+
+    def test_cached_values_are_read_only(self):
+        cache = MatrixCache(1024)
+        matrix = numpy.zeros((8, 1))
+        cache.set("a", matrix)
+        with self.assertRaises(ValueError):
+            cache.get("a")[0, 0] = 1
@@ -0,0 +1,111 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+from django.test import SimpleTestCase, override_settings
+import mock
+
+from matrixstore import db
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestLiveMatrixStore(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tempdir = tempfile.mkdtemp()
+        cls.live_file = os.path.join(cls.tempdir, "matrixstore_live.sqlite")
+        # Two files, with different numbers of practices so we can tell them
+        # apart
+        cls.files = {}
+        for name, num_practices in [("old", 2), ("new", 3)]:
+            factory = DataFactory()
+            months = factory.create_months("2019-01-01", 2)
+            practices = factory.create_practices(num_practices)
+            presentations = factory.create_presentations(2)
+            factory.create_prescribing(presentations, practices, months)
+            path = os.path.join(cls.tempdir, "matrixstore_{}.sqlite".format(name))
+            connection = sqlite3.connect(path)
+            import_test_data_fast(connection, factory, "2019-02", months=2)
+            connection.commit()
+            connection.close()
+            cls.files[name] = path
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.set_live("old")
+        self.live_db = db.LiveMatrixStore()
+        # Warming requires Postgres so we check it gets called, but don't
+        # actually do it
+        patcher = mock.patch("matrixstore.db.warm_db")
+        self.warm_db = patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_override = override_settings(
+            MATRIXSTORE_LIVE_FILE=self.live_file,
+            MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL=0,
+            MATRIXSTORE_MATRIX_CACHE_SIZE=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def set_live(self, name):
+        temp_link = self.live_file + ".tmp"
+        os.symlink(self.files[name], temp_link)
+        os.rename(temp_link, self.live_file)
+
+    def assertIsFile(self, matrixstore, name):
+        expected = os.path.basename(self.files[name]).encode("utf8")
+        self.assertEqual(matrixstore.cache_key, expected)
+
+    def test_switches_to_new_file(self):
+        self.assertIsFile(self.live_db.get(), "old")
+        self.warm_db.assert_not_called()
+        self.set_live("new")
+        self.assertIsFile(self.live_db.get(), "new")
+        self.warm_db.assert_called_once_with()
+
+    def test_checks_are_throttled(self):
+        with override_settings(MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL=3600):
+            self.assertIsFile(self.live_db.get(), "old")
+            self.set_live("new")
+            self.assertIsFile(self.live_db.get(), "old")
+
+    def test_pinned_file_is_kept_until_unpinned(self):
+        self.live_db.pin()
+        self.assertIsFile(self.live_db.get(), "old")
+        self.set_live("new")
+        self.assertIsFile(self.live_db.get(), "old")
+        # Other threads see the new file
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.live_db.get()))
+        thread.start()
+        thread.join()
+        self.assertIsFile(results[0], "new")
+        self.live_db.unpin()
+        self.assertIsFile(self.live_db.get(), "new")
+
+    def test_keeps_current_file_if_new_file_cannot_be_opened(self):
+        self.assertIsFile(self.live_db.get(), "old")
+        self.warm_db.side_effect = RuntimeError("Failed to warm")
+        self.set_live("new")
+        with self.assertLogs("matrixstore.db", level="ERROR"):
+            self.assertIsFile(self.live_db.get(), "old")
+        self.warm_db.side_effect = None
+        self.assertIsFile(self.live_db.get(), "new")
+
+    def test_memoize_per_db_recalculates_for_new_file(self):
+        @db.memoize_per_db
+        def get_num_practices():
+            return len(db.get_db().practices)
+
+        with mock.patch("matrixstore.db.live_db", self.live_db):
+            self.assertEqual(get_num_practices(), 2)
+            self.set_live("new")
+            self.assertEqual(get_num_practices(), 3)
@@ -1,4 +1,5 @@
 import random
+import warnings
 
 import numpy
 from scipy.sparse import spmatrix as SparseMatrixBase
@@ -8,7 +9,9 @@ from django.test import SimpleTestCase
 from matrixstore.matrix_ops import (
     convert_to_smallest_int_type,
     finalise_matrix,
+    nanpercentile_by_column,
     sparse_matrix,
+    sparse_matrix_from_coordinates,
 )
 
 
@@ -95,3 +98,73 @@ class TestFinaliseMatrix(SimpleTestCase):
             i = int(n / cols)
             j = n % cols
             yield i, j
+
+
+class TestSparseMatrixFromCoordinates(SimpleTestCase):
+    def test_matches_assigning_values(self):
+        coords = [(0, 0, 5), (2, 1, 0), (1, 3, 7), (2, 2, 1)]
+        expected = sparse_matrix((3, 4), integer=True)
+        for row, col, value in coords:
+            expected[row, col] = value
+        rows, cols, values = zip(*coords)
+        matrix = sparse_matrix_from_coordinates(
+            (3, 4), rows, cols, values, integer=True
+        )
+        self.assertEqual(matrix.nnz, expected.nnz)
+        self.assertEqual(matrix.toarray().tolist(), expected.toarray().tolist())
+
+    def test_rejects_duplicate_coordinates(self):
+        with self.assertRaises(ValueError):
+            sparse_matrix_from_coordinates((2, 2), [0, 1, 0], [1, 1, 1], [1, 2, 3])
+
+
+class TestNanpercentileByColumn(SimpleTestCase):
+    def setUp(self):
+        self.random = numpy.random.RandomState(27)
+
+    def test_matches_numpy_nanpercentile(self):
+        for _ in range(50):
+            matrix = self._random_matrix()
+            for q in [0, 10, 33.3, 50, 100]:
+                for interpolation in ["linear", "lower"]:
+                    # numpy warns about columns which are entirely NaN
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("ignore", RuntimeWarning)
+                        expected = numpy.nanpercentile(
+                            matrix, q, axis=0, interpolation=interpolation
+                        )
+                    result = nanpercentile_by_column(matrix, q, interpolation)
+                    # NaNs never compare equal, so we check them separately
+                    self.assertEqual(
+                        numpy.nan_to_num(result).tolist(),
+                        numpy.nan_to_num(expected).tolist(),
+                    )
+                    self.assertEqual(
+                        numpy.isnan(result).tolist(), numpy.isnan(expected).tolist()
+                    )
+
+    def test_matrix_with_no_rows(self):
+        matrix = numpy.empty((0, 3))
+        for interpolation in ["linear", "lower"]:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                expected = numpy.nanpercentile(
+                    matrix, 50, axis=0, interpolation=interpolation
+                )
+            result = nanpercentile_by_column(matrix, 50, interpolation)
+            self.assertEqual(result.shape, (3,))
+            self.assertTrue(numpy.isnan(result).all())
+            self.assertTrue(numpy.isnan(expected).all())
+
+    def test_rejects_unsupported_interpolation(self):
+        with self.assertRaises(ValueError):
+            nanpercentile_by_column(self._random_matrix(), 50, "nearest")
+
+    def _random_matrix(self):
+        rows = self.random.randint(1, 30)
+        cols = self.random.randint(1, 6)
+        # Rounding gives us some repeated values
+        matrix = numpy.round(self.random.exponential(size=(rows, cols)), 1)
+        matrix[self.random.rand(rows, cols) < self.random.rand()] = numpy.nan
+        matrix[self.random.rand(rows, cols) < 0.05] = numpy.inf
+        return matrix
@@ -20,11 +20,10 @@ class TestReadExistingFile(SimpleTestCase):
     This tests that we can still correctly read serialized matrices (sparse,
     dense, compressed and uncompressed) from an SQLite fixture created by a
     previous version of the software. This should catch any backwards
-    incompatibilities introduced by upgrading our dependencies, in particular
-    PyArrow. The fixture file can be regenerated by calling the
-    `create_fixture` class method on this class i.e by running:
+    incompatibilities introduced by upgrading our dependencies.
 
-    ./manage.py shell -c 'import matrixstore.tests.test_read_existing_file as t; t.TestReadExistingFile.create_fixture()'
+    This fixture was written by the old PyArrow-based serializer and so can no
+    longer be regenerated. See `TestReadExistingFileV1` for the current format.
     """
 
     fixture_db_path = "matrixstore/tests/fixtures/read_existing_file.sqlite"
@@ -88,6 +87,13 @@ class TestReadExistingFile(SimpleTestCase):
 
     @classmethod
     def create_fixture(cls):
+        raise RuntimeError(
+            "This fixture was created by the legacy PyArrow serializer and "
+            "can't be regenerated"
+        )
+
+    @classmethod
+    def _create_fixture(cls):
         temp_db_path = cls.fixture_db_path + ".tmp"
         if os.path.exists(temp_db_path):
             os.unlink(temp_db_path)
@@ -137,3 +143,20 @@ class TestReadExistingFile(SimpleTestCase):
             [sys.executable, "-m", "pip", "freeze", "-qqq"]
         )
         yield "installed_packages", installed_packages
+
+
+class TestReadExistingFileV1(TestReadExistingFile):
+    """
+    As above, but for matrices written in version 1 of our own serialization
+    format. The fixture file can be regenerated by calling the
+    `create_fixture` class method on this class i.e by running:
+
+    ./manage.py shell -c 'import matrixstore.tests.test_read_existing_file as t; t.TestReadExistingFileV1.create_fixture()'
+    """
+
+    fixture_db_path = "matrixstore/tests/fixtures/read_existing_file_v1.sqlite"
+    fixture_json_path = "matrixstore/tests/fixtures/read_existing_file_v1.json"
+
+    @classmethod
+    def create_fixture(cls):
+        cls._create_fixture()
@@ -6,7 +6,7 @@ from django.test import SimpleTestCase
 import numpy
 
 from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
-from matrixstore.row_grouper import RowGrouper
+from matrixstore.row_grouper import RowGrouper, is_matrix
 
 
 class TestGrouper(SimpleTestCase):
@@ -183,6 +183,24 @@ class TestGrouper(SimpleTestCase):
                         value = row_grouper.get_group(matrix, group_id)
                         self.assertEqual(to_list_of_lists(value), expected_value)
 
+    def test_sum_matches_looping_over_groups(self):
+        """
+        Tests that `sum` gives the same results as the original implementation
+        which looped over each group in turn
+        """
+        test_cases = product(self.get_group_definitions(), self.get_matrices())
+        for (group_name, group_definition), (matrix_name, matrix) in test_cases:
+            with self.subTest(matrix=matrix_name, group=group_name):
+                row_grouper = RowGrouper(group_definition)
+                values = to_list_of_lists(row_grouper.sum(matrix))
+                expected_values = sum_by_looping_over_groups(row_grouper, matrix)
+                self.assertTrue(numpy.allclose(values, expected_values))
+
+    def test_sum_does_not_overflow_small_integer_types(self):
+        matrix = numpy.array([[200, 1], [200, 2]], dtype=numpy.uint8)
+        row_grouper = RowGrouper([(0, "a"), (1, "a")])
+        self.assertEqual(row_grouper.sum(matrix).tolist(), [[400, 3]])
+
     def sum_rows_by_group(self, group_definition, matrix, group_ids=None):
         """
         Given a group definition and a matrix, calculate the column-wise totals
@@ -276,6 +294,23 @@ class TestGrouper(SimpleTestCase):
         ]
 
 
+def sum_by_looping_over_groups(row_grouper, matrix):
+    """
+    The original implementation of `RowGrouper.sum` (without its fast path for
+    single-row groups), kept for comparison
+    """
+    row_selectors = row_grouper._group_selectors.values()
+    grouped_output = numpy.empty((len(row_selectors), matrix.shape[1]))
+    if is_matrix(matrix):
+        output_view = numpy.asmatrix(grouped_output)
+    else:
+        output_view = grouped_output
+    for row_offset, row_selector in enumerate(row_selectors):
+        row_group = matrix[row_selector]
+        numpy.sum(row_group, axis=0, out=output_view[row_offset])
+    return grouped_output
+
+
 def to_list_of_lists(matrix):
     """
     Convert a 2D matrix into a list of lists
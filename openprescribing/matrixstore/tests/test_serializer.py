@@ -5,20 +5,29 @@ import scipy.sparse
 
 from django.test import SimpleTestCase
 
-from matrixstore.serializer import serialize, serialize_compressed, deserialize
+from matrixstore.serializer import (
+    serialize,
+    serialize_compressed,
+    serialize_chunked_by_column,
+    serialize_many,
+    deserialize,
+    deserialize_columns,
+)
 
 
 class TestSerializer(SimpleTestCase):
     def test_simple_serialisation(self):
-        obj = {"hello": 123}
-        self.assertEqual(deserialize(serialize(obj)), obj)
+        obj = numpy.arange(12, dtype=numpy.int32).reshape((3, 4))
+        new_obj = deserialize(serialize(obj))
+        self.assertEqual(new_obj.dtype, obj.dtype)
+        self.assertEqual(new_obj.tolist(), obj.tolist())
 
     def test_simple_serialisation_with_compression(self):
-        obj = {"hello": "world" * 256}
+        obj = numpy.zeros((256, 4))
         data = serialize(obj)
         compressed_data = serialize_compressed(obj)
         self.assertLess(len(compressed_data), len(data))
-        self.assertEqual(deserialize(compressed_data), obj)
+        self.assertEqual(deserialize(compressed_data).tolist(), obj.tolist())
 
     def test_matrix_serialisation(self):
         obj = scipy.sparse.csc_matrix((5, 4))
@@ -30,19 +39,81 @@ class TestSerializer(SimpleTestCase):
         new_obj = deserialize(serialize(obj))
         self.assertEqual(obj.dtype, new_obj.dtype)
 
+    def test_fortran_order_is_preserved(self):
+        obj = numpy.asfortranarray(numpy.arange(12, dtype=numpy.float_).reshape(3, 4))
+        new_obj = deserialize(serialize(obj))
+        self.assertTrue(new_obj.flags.f_contiguous)
+        self.assertEqual(new_obj.tolist(), obj.tolist())
+
+    def test_deserialized_matrices_are_read_only(self):
+        dense = numpy.arange(12).reshape((3, 4))
+        sparse = scipy.sparse.csc_matrix(dense)
+        self.assertFalse(deserialize(serialize(dense)).flags.writeable)
+        self.assertFalse(deserialize(serialize(sparse)).data.flags.writeable)
+
+    def test_non_matrices_are_rejected(self):
+        for obj in [{"hello": 123}, numpy.arange(4), scipy.sparse.csr_matrix((2, 2))]:
+            with self.subTest(obj=obj):
+                with self.assertRaises(TypeError):
+                    serialize(obj)
+
     def test_sqlite_roundtrip(self):
-        obj = {"hello": 123}
+        obj = numpy.arange(12, dtype=numpy.uint8).reshape((4, 3))
         data = serialize(obj)
         new_data = roundtrip_through_sqlite(data)
         new_obj = deserialize(new_data)
-        self.assertEqual(new_obj, obj)
+        self.assertEqual(new_obj.tolist(), obj.tolist())
 
     def test_sqlite_roundtrip_with_compression(self):
-        obj = {"hello": "world" * 256}
+        obj = scipy.sparse.csc_matrix(numpy.eye(64))
         data = serialize_compressed(obj)
         new_data = roundtrip_through_sqlite(data)
         new_obj = deserialize(new_data)
-        self.assertEqual(new_obj, obj)
+        self.assertEqual(new_obj.toarray().tolist(), obj.toarray().tolist())
+
+    def test_chunked_by_column_roundtrip(self):
+        dense = numpy.arange(24, dtype=numpy.uint16).reshape((6, 4))
+        dense[2:4] = 0
+        sparse = scipy.sparse.csc_matrix(dense)
+        for obj in [dense, sparse]:
+            with self.subTest(type=type(obj).__name__):
+                data = roundtrip_through_sqlite(serialize_chunked_by_column(obj))
+                new_obj = deserialize(data)
+                self.assertEqual(type(new_obj), type(obj))
+                self.assertEqual(new_obj.dtype, obj.dtype)
+                self.assertEqual(new_obj.shape, obj.shape)
+                self.assertEqual(to_array(new_obj).tolist(), dense.tolist())
+
+    def test_deserialize_columns(self):
+        dense = numpy.arange(24, dtype=numpy.float_).reshape((6, 4))
+        dense[1:5] = 0
+        sparse = scipy.sparse.csc_matrix(dense)
+        column_slices = [slice(0, 1), slice(3, 4), slice(1, 3), slice(None, None)]
+        for obj in [dense, sparse]:
+            for data in [serialize_compressed(obj), serialize_chunked_by_column(obj)]:
+                for cols in column_slices:
+                    with self.subTest(type=type(obj).__name__, cols=cols):
+                        value = deserialize_columns(data, cols)
+                        self.assertEqual(type(value), type(obj))
+                        self.assertEqual(
+                            to_array(value).tolist(), dense[:, cols].tolist()
+                        )
+
+    def test_serialize_many_roundtrip(self):
+        dense = numpy.arange(12, dtype=numpy.uint8).reshape((4, 3))
+        sparse = scipy.sparse.csc_matrix(numpy.eye(4, 3))
+        data = roundtrip_through_sqlite(serialize_many([dense, None, sparse]))
+        value = deserialize(data)
+        self.assertIsInstance(value, tuple)
+        self.assertEqual(len(value), 3)
+        self.assertEqual(value[0].dtype, dense.dtype)
+        self.assertEqual(value[0].tolist(), dense.tolist())
+        self.assertIsNone(value[1])
+        self.assertEqual(value[2].toarray().tolist(), sparse.toarray().tolist())
+
+
+def to_array(matrix):
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
 
 
 def roundtrip_through_sqlite(value):
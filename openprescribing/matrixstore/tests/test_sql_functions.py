@@ -1,9 +1,24 @@
+import sqlite3
+
 from django.test import SimpleTestCase
 
 import numpy
 import scipy.sparse
 
-from matrixstore.sql_functions import fast_in_place_add, MatrixSum
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.serializer import (
+    deserialize,
+    serialize,
+    serialize_chunked_by_column,
+)
+from matrixstore.sql_functions import (
+    fast_in_place_add,
+    matrix_nnz,
+    matrix_sum_cols,
+    MatrixRowGroupSum,
+    MatrixSum,
+    MatrixSumMany,
+)
 
 
 class TestMatrixSum(SimpleTestCase):
@@ -36,3 +51,169 @@ class TestMatrixSum(SimpleTestCase):
         self.assertEqual(
             accumulator.tolist(), [[1, 0, 2], [0, 0, 4], [1, 5, 6], [5, 5, 2]]
         )
+
+    def test_smaller_accumulator_type(self):
+        matrix = numpy.array([[1.5, 0], [0, 2.5]])
+        matrix_sum = MatrixSum(dtype=numpy.float32)
+        matrix_sum.add(matrix)
+        matrix_sum.add(scipy.sparse.csc_matrix(matrix))
+        value = matrix_sum.value()
+        self.assertEqual(value.dtype, numpy.float32)
+        self.assertEqual(value.tolist(), [[3.0, 0.0], [0.0, 5.0]])
+
+
+class TestMatrixSumMany(SimpleTestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.create_aggregate("MATRIX_SUM", 1, MatrixSum)
+        self.connection.create_aggregate("MATRIX_SUM_MANY", -1, MatrixSumMany)
+        self.connection.execute("CREATE TABLE data (a BLOB, b BLOB, c BLOB)")
+        rows = [
+            (numpy.array([[1, 0], [2, 3]]), numpy.array([[0.5, 1.0], [0, 0]]), None),
+            (
+                scipy.sparse.csc_matrix(numpy.array([[0, 4], [0, 1]])),
+                scipy.sparse.csc_matrix(numpy.array([[1.5, 0], [0, 2.0]])),
+                None,
+            ),
+        ]
+        self.connection.executemany(
+            "INSERT INTO data VALUES (?, ?, ?)",
+            [
+                [serialize(matrix) if matrix is not None else None for matrix in row]
+                for row in rows
+            ],
+        )
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_matches_matrix_sum(self):
+        (value,) = self.connection.execute(
+            "SELECT MATRIX_SUM_MANY(a, b, c) FROM data"
+        ).fetchone()
+        a, b, c = deserialize(value)
+        expected_a, expected_b = [
+            deserialize(value)
+            for value in self.connection.execute(
+                "SELECT MATRIX_SUM(a), MATRIX_SUM(b) FROM data"
+            ).fetchone()
+        ]
+        self.assertEqual(a.dtype, expected_a.dtype)
+        self.assertEqual(a.tolist(), expected_a.tolist())
+        self.assertEqual(b.dtype, expected_b.dtype)
+        self.assertEqual(b.tolist(), expected_b.tolist())
+        self.assertIsNone(c)
+
+    def test_no_rows(self):
+        result = self.connection.execute(
+            "SELECT MATRIX_SUM_MANY(a, b, c) FROM data WHERE 0"
+        ).fetchone()
+        self.assertEqual(result, (None,))
+
+    def test_streaming_with_dtypes(self):
+        matrix_sum = MatrixSumMany(dtypes=[numpy.int32, None])
+        matrix_sum.add(numpy.array([[1, 2]]), numpy.array([[0.5, 1.5]]))
+        matrix_sum.add(numpy.array([[3, 4]]), None)
+        a, b = matrix_sum.value()
+        self.assertEqual(a.dtype, numpy.int32)
+        self.assertEqual(a.tolist(), [[4, 6]])
+        self.assertEqual(b.dtype, numpy.float_)
+        self.assertEqual(b.tolist(), [[0.5, 1.5]])
+
+    def test_value_error_on_mismatched_columns(self):
+        matrix_sum = MatrixSumMany()
+        matrix_sum.add(numpy.array([[1]]), numpy.array([[2]]))
+        with self.assertRaises(ValueError):
+            matrix_sum.add(numpy.array([[1]]))
+
+
+class TestMatrixFunctions(SimpleTestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.create_aggregate("MATRIX_SUM", 1, MatrixSum)
+        self.connection.create_function("MATRIX_SUM_COLS", 3, matrix_sum_cols)
+        self.connection.create_function("MATRIX_NNZ", 1, matrix_nnz)
+        self.row_group_sum = MatrixRowGroupSum()
+        self.connection.create_function("MATRIX_ROW_GROUP_SUM", 2, self.row_group_sum)
+        self.connection.execute("CREATE TABLE data (value BLOB)")
+        self.matrices = [
+            numpy.array([[1, 0, 2], [0, 0, 0], [0, 4, 5], [2, 3, 2]]),
+            scipy.sparse.csc_matrix(numpy.array([[0.5, 0, 0], [0, 0, 4], [1, 1, 1]])),
+        ]
+
+    def tearDown(self):
+        self.connection.close()
+
+    def query_one_value(self, sql, matrix, params=()):
+        (value,) = self.connection.execute(
+            sql, [serialize(matrix) if matrix is not None else None] + list(params)
+        ).fetchone()
+        return value
+
+    def test_sum_cols(self):
+        for matrix in self.matrices:
+            value = self.query_one_value(
+                "SELECT MATRIX_SUM_COLS(?, ?, ?)", matrix, [1, 3]
+            )
+            result = deserialize(value)
+            expected = numpy.asarray(matrix[:, 1:3].sum(axis=1)).reshape((-1, 1))
+            self.assertIsInstance(result, numpy.ndarray)
+            self.assertEqual(result.tolist(), expected.tolist())
+
+    def test_sum_cols_with_single_column(self):
+        matrix = self.matrices[0]
+        value = self.query_one_value("SELECT MATRIX_SUM_COLS(?, ?, ?)", matrix, [2, 3])
+        result = deserialize(value)
+        self.assertEqual(result.dtype, numpy.int_)
+        self.assertEqual(result.tolist(), [[2], [0], [5], [2]])
+
+    def test_sum_cols_with_chunked_matrix(self):
+        matrix = self.matrices[1]
+        (value,) = self.connection.execute(
+            "SELECT MATRIX_SUM_COLS(?, 0, 2)", [serialize_chunked_by_column(matrix)]
+        ).fetchone()
+        self.assertEqual(deserialize(value).tolist(), [[0.5], [0.0], [2.0]])
+
+    def test_sum_cols_can_be_summed(self):
+        matrix = numpy.array([[1, 2], [3, 4]])
+        self.connection.executemany(
+            "INSERT INTO data VALUES (?)", [[serialize(matrix)], [serialize(matrix)]]
+        )
+        (value,) = self.connection.execute(
+            "SELECT MATRIX_SUM(MATRIX_SUM_COLS(value, 1, 2)) FROM data"
+        ).fetchone()
+        self.assertEqual(deserialize(value).tolist(), [[4], [8]])
+
+    def test_nnz(self):
+        self.assertEqual(
+            self.query_one_value("SELECT MATRIX_NNZ(?)", self.matrices[0]), 7
+        )
+        self.assertEqual(
+            self.query_one_value("SELECT MATRIX_NNZ(?)", self.matrices[1]), 5
+        )
+
+    def test_row_group_sum(self):
+        row_grouper = RowGrouper([(0, "a"), (1, "b"), (2, "a"), (3, "b")])
+        grouper_id = self.row_group_sum.register(row_grouper)
+        matrix = self.matrices[0]
+        value = self.query_one_value(
+            "SELECT MATRIX_ROW_GROUP_SUM(?, ?)", matrix, [grouper_id]
+        )
+        self.assertEqual(deserialize(value).tolist(), row_grouper.sum(matrix).tolist())
+
+    def test_row_groupers_registered_once(self):
+        row_grouper = RowGrouper([(0, "a"), (1, "b")])
+        other_row_grouper = RowGrouper([(0, "a"), (1, "a")])
+        grouper_id = self.row_group_sum.register(row_grouper)
+        self.assertEqual(
+            self.row_group_sum.register(RowGrouper([(0, "a"), (1, "b")])), grouper_id
+        )
+        self.assertNotEqual(self.row_group_sum.register(other_row_grouper), grouper_id)
+
+    def test_null_values(self):
+        for sql, params in [
+            ("SELECT MATRIX_SUM_COLS(?, 0, 1)", []),
+            ("SELECT MATRIX_NNZ(?)", []),
+            ("SELECT MATRIX_ROW_GROUP_SUM(?, 0)", []),
+        ]:
+            self.assertIsNone(self.query_one_value(sql, None, params))
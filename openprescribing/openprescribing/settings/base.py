@@ -395,6 +395,21 @@ CACHES = {
 }
 
 
+# Upper limit on the memory (in bytes) which each process will use to keep
+# recently used MatrixStore matrices in deserialized form (see
+# `matrixstore.connection.MatrixCache`). Setting this to zero disables the
+# cache.
+MATRIXSTORE_MATRIX_CACHE_SIZE = int(
+    utils.get_env_setting("MATRIXSTORE_MATRIX_CACHE_SIZE", default=512 * 1024 ** 2)
+)
+
+# How often (in seconds) each process checks whether the MATRIXSTORE_LIVE_FILE
+# symlink has been changed to point at a new file (see `matrixstore.db`)
+MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL = int(
+    utils.get_env_setting("MATRIXSTORE_LIVE_FILE_CHECK_INTERVAL", default=30)
+)
+
+
 # The git sha of the currently running version of the code (will be empty in
 # development). We set this conditionally so that if it isn't defined any
 # attempt to access it will blow up with an attribute error, rather than
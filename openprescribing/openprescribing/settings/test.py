@@ -90,6 +90,10 @@ MATRIXSTORE_BUILD_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_build")
 # This is expected to be a symlink to a file in MATRIXSTORE_BUILD_DIR
 MATRIXSTORE_LIVE_FILE = os.path.join(MATRIXSTORE_BUILD_DIR, "matrixstore_live.sqlite")
 
+# Test MatrixStores are all in-memory and so share a cache key, which means
+# they can't safely share a matrix cache
+MATRIXSTORE_MATRIX_CACHE_SIZE = 0
+
 SLACK_SENDING_ACTIVE = False
 
 # Running with a different storage backend in test is not ideal but it's what